@@ -36,6 +36,37 @@ def eigpow(A, pow, axes=[-2,-1], lim=None, lim0=None, copy=True, fallback="eigki
 			raise ValueError("Unknown fallback in eigpow: '%s'" % str(fallback))
 	return A
 
+def eigpow_packed(A, pow, axes=[-2,-1], lim=None, lim0=None):
+	"""Like eigpow with fallback="scalar", but returns the result in the
+	compact form used by matmul_packed: P[m*(m+1)/2,...], the upper triangle
+	of each symmetric m*m result matrix in row-major order (11 12 13 22 23 33
+	for m = 3), and mask[...], which is True for scalar fallback pixels. For
+	these only P[0] is nonzero. A is not modified."""
+	core = get_core(A.dtype)
+	if lim  is None: lim  = 1e-6
+	if lim0 is None: lim0 = np.finfo(A.dtype).tiny**0.5
+	axes = [i if i >= 0 else A.ndim+i for i in axes]
+	m    = A.shape[axes[0]]
+	rest = tuple(np.delete(A.shape, axes))
+	Af   = np.ascontiguousarray(utils.partial_flatten(A, axes, pos=-1))
+	P    = np.zeros((m*(m+1)//2,)+rest, A.dtype)
+	mask = np.zeros(rest, np.int8)
+	core.eigpow_packed(Af.T, pow, lim, lim0, P.reshape(len(P),-1).T, mask.reshape(-1))
+	return P, mask.view(bool)
+
+def matmul_packed(P, mask, B, axes=[0]):
+	"""Multiply B by the packed symmetric matrices (P, mask) returned by
+	eigpow_packed, overwriting B. axes gives the position of the vector
+	axis in B, and the remaining axes of B must match those of P[0]. B is
+	also returned for convenience."""
+	core = get_core(B.dtype)
+	Bf = utils.partial_flatten(B, axes, pos=-1)
+	Bc = np.ascontiguousarray(Bf)
+	core.matmul_packed(P.reshape(len(P),-1).T, mask.reshape(-1).view(np.int8), Bc.T)
+	if not np.shares_memory(Bc, B):
+		B[...] = utils.partial_expand(Bc, B.shape, axes, pos=-1)
+	return B
+
 def eigflip(A, axes=[-2,-1], inplace=False):
 	core = get_core(A.dtype)
 	if not inplace: A = np.array(A)
@@ -118,3 +149,24 @@ matmul_sym   = wrap_mm_m("matmul_multi_sym", vec2mat=True)
 solve_multi  = wrap_mm_m("solve_multi")
 solve_masked = wrap_mm_m("solve_masked")
 
+
+def packed_test(ny=20, nx=30, seed=1):
+	"""Check that matmul_packed with the output of eigpow_packed matches
+	matmul with the output of eigpow using the scalar fallback, also for
+	singular pixels that need the fallback."""
+	rng = np.random.RandomState(seed)
+	for dtype, tol in [(np.float64, 1e-10), (np.float32, 1e-4)]:
+		V = rng.standard_normal((3,3,ny,nx))
+		A = np.einsum("aiyx,biyx->abyx", V, V) + np.eye(3)[:,:,None,None]*0.1
+		# Make some pixels T-only, which is singular
+		A[:,:,:5] = 0; A[0,0,:5] = rng.uniform(1,2,(5,nx))
+		A = A.astype(dtype)
+		m = rng.standard_normal((3,ny,nx)).astype(dtype)
+		ref = matmul(eigpow(A, -1, axes=[0,1], lim=1e-3, fallback="scalar"), m, axes=[0,1])
+		P, mask = eigpow_packed(A, -1, axes=[0,1], lim=1e-3)
+		assert np.all(mask[:5]) and not np.any(mask[5:])
+		res = matmul_packed(P, mask, m.copy())
+		assert np.max(np.abs(res-ref)) <= tol*np.max(np.abs(ref))
+		# Also with the vector axis last
+		res = matmul_packed(P, mask, np.moveaxis(m,0,-1).copy(), axes=[-1])
+		assert np.max(np.abs(np.moveaxis(res,-1,0)-ref)) <= tol*np.max(np.abs(ref))
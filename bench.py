@@ -19,13 +19,30 @@ The individual entries are also avilable by indexing stats like
 a dictionary: stats["foo"]["time"].mean, .std, .n, .last
 return the mean, standard deviation, number of hits and
 last value for the execution time for category "foo", for example.
+
+Marks can be nested. The module-global tree object records the time
+spent in each chain of nested categories, like "A_P/A_P_map", and
+str(tree) shows them as an indented tree. Memory measurements are the
+most expensive part of a mark, and can be turned off by setting
+memprobe = False. gather(comm) collects the per-task totals of each
+category, and str() of the result shows their min, mean and max across
+tasks. Finally, start_trace() makes every mark also be recorded as an
+event, which write_trace writes in the chrome trace event format.
 """
-import time, numpy as np
+import time, json, threading, numpy as np
 from collections import defaultdict
 from . import memory
 try: clockfun = time.clock
 except: clockfun = time.process_time
 
+# Whether mark should measure memory use. Turning this off skips the mem
+# and leak columns, but makes marks much cheaper.
+memprobe = True
+# List of (name, path, start, duration, thread) for each finished mark
+# while tracing is active, or None when it is not.
+trace    = None
+_local   = threading.local()
+
 class Value:
 	def __init__(self, n=0, v=0, vv=0):
 		self.n  = n
@@ -99,20 +116,125 @@ class Register(defaultdict):
 		with open(fname,"w") as f:
 			f.write(str(self)+"\n")
 
+class Tree(Register):
+	"""A Register keyed by the path of nested categories, like "A_P/A_P_map".
+	Its string representation shows the nesting by indentation, with the
+	total time and cpu time spent in each path."""
+	def __init__(self, fmt=[("time","%6.2f","%6.3f",1),("cpu","%6.2f","%6.3f",1)], sep="/"):
+		Register.__init__(self, fmt)
+		self.sep = sep
+	def __repr__(self):
+		if len(self) == 0: return ""
+		paths  = sorted(self, key=lambda path: path.split(self.sep))
+		labels = ["  "*path.count(self.sep) + path.split(self.sep)[-1] for path in paths]
+		name_dig = max([len(label) for label in labels])
+		nhit_dig = max([len("%d" % self[path]["time"].n) for path in paths])
+		lines = ["%-*s %*s %9s %9s %9s" % (name_dig, "", nhit_dig, "n", "total", "mean", "cpu")]
+		for path, label in zip(paths, labels):
+			t, c = self[path]["time"], self[path]["cpu"]
+			lines.append("%-*s %*d %9.3f %9.4f %9.3f" % (name_dig, label, nhit_dig, t.n, t.v, t.mean, c.v))
+		return "\n".join(lines)
+
+class RankStats(dict):
+	"""Per-task totals for each category, as returned by gather. self[name][field]
+	is an array with one entry per task, which is zero for tasks that never
+	entered that category. str() shows the min, mean and max across tasks
+	of the total time, as well as the imbalance max/mean."""
+	def __repr__(self):
+		if len(self) == 0: return ""
+		names = sorted(self, key=lambda name: -np.max(self[name]["time"]))
+		name_dig = max([len(name) for name in names])
+		lines = ["%-*s %9s %9s %9s %6s" % (name_dig, "", "min", "mean", "max", "imbal")]
+		for name in names:
+			t = self[name]["time"]
+			mean = np.mean(t)
+			lines.append("%-*s %9.3f %9.3f %9.3f %6.2f" % (name_dig, name, np.min(t), mean, np.max(t), np.max(t)/mean if mean > 0 else 1.0))
+		return "\n".join(lines)
+
 stats = Register()
+tree  = Tree()
+
+def get_stack():
+	"""Returns the stack of currently active marks for this thread"""
+	try: return _local.stack
+	except AttributeError:
+		_local.stack = []
+		return _local.stack
 
 class mark:
 	def __init__(self, name):
 		self.name = name
 	def __enter__(self):
+		stack = get_stack()
+		self.path   = stack[-1].path + tree.sep + self.name if len(stack) > 0 else self.name
+		stack.append(self)
 		self.time1  = time.time()
 		self.clock1 = clockfun()
-		self.mem1   = memory.current()
+		self.probe  = memprobe
+		if self.probe: self.mem1 = memory.current()
+		return self
 	def __exit__(self, type, value, traceback):
 		self.time2  = time.time()
 		self.clock2 = clockfun()
-		self.mem2   = memory.current()
-		stats.add(self.name, self.time2 -self.time1, self.clock2-self.clock1, self.mem1, self.mem2-self.mem1)
+		dtime, dclock = self.time2-self.time1, self.clock2-self.clock1
+		if self.probe:
+			self.mem2 = memory.current()
+			stats.add(self.name, dtime, dclock, self.mem1, self.mem2-self.mem1)
+		else:
+			stats.add(self.name, dtime, dclock)
+		tree.add(self.path, dtime, dclock)
+		stack = get_stack()
+		if len(stack) > 0 and stack[-1] is self: stack.pop()
+		if trace is not None:
+			trace.append((self.name, self.path, self.time1, dtime, threading.current_thread().ident))
+	@property
+	def time(self): return self.time2-self.time1
+
+def gather(comm, reg=None, fields=["time","cpu"]):
+	"""Collect the total of each of the given fields for each category in
+	reg (stats by default) from all tasks in comm. Returns a RankStats."""
+	if reg is None: reg = stats
+	mine = {name: [reg[name][fields[0]].n] + [reg[name][field].v for field in fields] for name in list(reg)}
+	alls = comm.allgather(mine)
+	res  = RankStats()
+	for name in sorted(set().union(*alls)):
+		vals = np.array([a.get(name, [0]*(len(fields)+1)) for a in alls], dtype=float)
+		res[name] = {"n": vals[:,0]}
+		for i, field in enumerate(fields):
+			res[name][field] = vals[:,i+1]
+	return res
+
+def start_trace():
+	"""Start recording an event for each finished mark, for use with write_trace"""
+	global trace
+	trace = []
+
+def stop_trace():
+	"""Stop recording events. Returns the events recorded so far."""
+	global trace
+	events, trace = trace, None
+	return events
+
+def write_trace(fname, comm=None, events=None):
+	"""Write the recorded events (or the ones given) to fname in the chrome trace
+	event format, which can be viewed in chrome://tracing or ui.perfetto.dev.
+	If comm is specified, the events of all tasks are gathered and written by
+	the first task, with the task number as the process id."""
+	if events is None: events = list(trace or [])
+	if comm is not None:
+		all_events = comm.gather(events, root=0)
+		if comm.rank != 0: return
+	else: all_events = [events]
+	t0  = min([e[2] for evs in all_events for e in evs] or [0])
+	out = []
+	for pid, evs in enumerate(all_events):
+		tids = {}
+		for name, path, t1, dt, thread in evs:
+			out.append({"name": name, "cat": path.split(tree.sep)[0], "ph": "X", "pid": pid,
+				"tid": tids.setdefault(thread, len(tids)), "ts": (t1-t0)*1e6, "dur": dt*1e6,
+				"args": {"path": path}})
+	with open(fname, "w") as f:
+		json.dump({"traceEvents": out, "displayTimeUnit": "ms"}, f)
 
 class show:
 	def __init__(self, name, display=True):
@@ -2,7 +2,7 @@
 When c is more developed, it might completely replace this
 module. For now, it is used as a part of the implementation."""
 from __future__ import division, print_function
-import numpy as np, warnings
+import numpy as np, warnings, collections, re
 import astropy.coordinates as c, astropy.units as u
 from .. import utils, bunch, config
 # Optional dependencies are imported in the functions that
@@ -12,6 +12,9 @@ try: basestring
 except: basestring = str
 
 config.default("iers_fallback", "none", "How to handle missing iers data. 'none' raises an exception, 'nearest' issues a warning but uses the closest available data.")
+config.default("ephem_interpol_tol", 1e-3, "Maximum error in arcseconds when interpolating the positions of ephemeris objects for object-centered coordinate systems. 0 disables the interpolation.")
+config.default("ephem_interpol_window", 1.0, "Length in days of the time windows the positions of ephemeris objects are interpolated in.")
+config.default("transform_dets_bsize", 1e6, "Max number of detector-samples transform_dets handles at a time. Larger values use more memory.")
 
 default_site = bunch.Bunch(
 	lat  = -22.9585,
@@ -67,6 +70,88 @@ def transform(from_sys, to_sys, coords, time=55500, site=None, pol=None, mag=Non
 			else: res[off+i] = meta.mag
 	return res
 
+def transform_dets(from_sys, to_sys, bore, offsets, time=55500, site=None, pol=True, min_size=0.1*utils.degree, tol=None, bsize=None):
+	"""Transforms the pointing of many detectors at once. bore[2,nsamp] is the
+	boresight pointing in from_sys at each time[nsamp], and offsets[ndet,2] are
+	the detector offsets, which are added to it. Returns [{ra,dec[,ang]},ndet,nsamp],
+	like transform(from_sys, to_sys, bore+offsets[di,:,None], time=time, site=site, pol=pol)
+	would for each detector.
+
+	Only the corners of the bounding box of the offsets (which is at least
+	min_size wide) are transformed with transform_raw, so the expensive parts
+	of the transformation are shared by all the detectors at each sample. The
+	corners define a projective map of the sphere for each sample, which is then
+	applied to each detector. It is exact for rotations, and the error from
+	the rest, like aberration and refraction, is second order in the size of
+	the detector array. The polarization angle is found analytically from the
+	same map. Boresight-relative systems are not supported, since they depend
+	on the pointing of each detector.
+
+	If tol (radians) is specified, the position error is measured for the detector
+	farthest from the corners on a few samples, and if it exceeds tol, each detector
+	is transformed with transform instead. The detectors are processed in blocks
+	of at most bsize detector-samples to limit the memory use."""
+	bsize   = config.get("transform_dets_bsize", bsize)
+	bore    = np.asarray(bore, dtype=float)[:2]
+	offsets = np.asarray(offsets, dtype=float)[:,:2]
+	time    = np.asarray(time) + np.zeros(bore.shape[1])
+	ndet, nsamp = len(offsets), bore.shape[1]
+	res     = np.zeros((3 if pol else 2, ndet, nsamp))
+	dblock  = max(1, int(bsize)//max(1,nsamp))
+	# Transform the corners of the offset bounding box, which has the shape
+	# [{ra,dec},4,nsamp]
+	omin, omax = np.min(offsets,0), np.max(offsets,0)
+	half    = np.maximum((omax-omin)/2, min_size/2)
+	corners = (omin+omax)/2 + half*np.array([[-1,-1],[1,-1],[1,1],[-1,1]])
+	iref    = bore[:,None,:] + corners.T[:,:,None]
+	oref    = transform_raw(from_sys, to_sys, iref, time=time[None], site=site)
+	# Find the matrices A[nsamp,3,3] that map the first three input corners to
+	# the output ones, scaled such that the fourth one is mapped correctly too
+	vi, vo  = utils.ang2rect(iref, zenith=False), utils.ang2rect(oref, zenith=False)
+	V, W    = vi[:,:3].transpose(2,0,1), vo[:,:3].transpose(2,0,1)
+	a       = np.linalg.solve(V, vi[:,3].T[:,:,None])[:,:,0]
+	b       = np.linalg.solve(W, vo[:,3].T[:,:,None])[:,:,0]
+	A       = np.einsum("tij,tj,tjk->tik", W, b/a, np.linalg.inv(V))
+	del vi, vo, V, W
+	if tol is not None and ndet > 0:
+		# The error is largest far from the corners, so check the worst detector
+		# on a few samples
+		di    = np.argmax(np.min(np.sum((offsets[:,None]-corners[None])**2,-1),1))
+		step  = max(1, nsamp//20)
+		ipos  = bore[:,::step]+offsets[di,:,None]
+		exact = transform_raw(from_sys, to_sys, ipos, time=time[::step], site=site)
+		approx= apply_dets_map(A[::step], ipos[:,None], pol=False)[:,0]
+		if np.max(utils.angdist(exact, approx)) > tol:
+			for di in range(ndet):
+				res[:,di] = transform(from_sys, to_sys, bore+offsets[di,:,None], time=time, site=site, pol=pol)[:len(res)]
+			return res
+	# Apply the maps to each block of detectors
+	for d1 in range(0, ndet, dblock):
+		d2 = min(d1+dblock, ndet)
+		res[:,d1:d2] = apply_dets_map(A, bore[:,None,:] + offsets[d1:d2].T[:,:,None], pol=pol)
+	if pol:
+		# Fix the polarization convention, as in transform
+		ihand = get_handedness(getsys_base(from_sys))
+		ohand = get_handedness(getsys_base(to_sys))
+		if ihand != ohand: res[2] -= np.pi
+		if ohand != 'L':   res[2] *= -1
+	return res
+
+def apply_dets_map(A, ipos, pol=True):
+	"""Apply the per-sample maps A[nsamp,3,3] from transform_dets to the input
+	positions ipos[{ra,dec},ndet,nsamp]. Returns [{ra,dec[,ang]},ndet,nsamp],
+	where ang is not yet corrected for the handedness of the systems."""
+	opos    = utils.rect2ang(np.einsum("tij,jdt->idt", A, utils.ang2rect(ipos, zenith=False)), zenith=False)
+	if not pol: return opos
+	# The polarization angle is the angle of the direction of increasing ra
+	# after it has been mapped, measured like transform_meta does
+	dirs    = np.einsum("tij,jdt->idt", A, [-np.sin(ipos[0]), np.cos(ipos[0]), ipos[0]*0])
+	ora, odec = opos
+	ang     = np.arctan2(
+			-dirs[0]*np.sin(odec)*np.cos(ora) - dirs[1]*np.sin(odec)*np.sin(ora) + dirs[2]*np.cos(odec),
+			-dirs[0]*np.sin(ora) + dirs[1]*np.cos(ora))
+	return np.concatenate([opos, ang[None]])
+
 def transform_meta(transfun, coords, fields=["ang","mag"], offset=5e-7):
 	"""Computes metadata for the coordinate transformation functor
 	transfun applied to the coordinate array coords[2,...],
@@ -315,6 +400,21 @@ def get_handedness(sys):
 	if sys in ["altaz","tele","bore"]: return 'R'
 	else: return 'L'
 
+def getsys_base(sys):
+	"""Returns the base system of sys in our expanded coordinate system syntax
+	(see getsys_full), without evaluating its reference point."""
+	if isinstance(sys, basestring): sys = sys.split(":",1)[0]
+	else:
+		try: sys = list(sys)[0]
+		except TypeError: pass
+	if sys == "sidelobe": sys = "bore"
+	return getsys(sys)
+
+def is_bore_relative(sys):
+	"""Returns whether the system sys depends on the boresight pointing."""
+	if not isinstance(sys, basestring): return getsys_base(sys) == "bore"
+	return any([tok == "sidelobe" or getsys(tok) == "bore" for tok in re.split("[:/]", sys) if tok.lower() in str2sys or tok == "sidelobe"])
+
 def getsys_full(sys, time=None, site=default_site, bore=None):
 	"""Handles our expanded coordinate system syntax: base[:ref[:refsys]].
 	This allows a system to be recentered on a given position or object.
@@ -372,7 +472,7 @@ def getsys_full(sys, time=None, site=default_site, bore=None):
 				r = transform_raw(refsys, base, r[:,None], time=time, site=site, bore=bore)
 			except ValueError:
 				# Otherwise, treat as an ephemeris object
-				r = ephem_pos(r, time)
+				r = ephem_pos_interpol(r, time)
 				r = transform_raw("equ", base, r, time=time, site=site, bore=bore)
 			ref_expanded += list(r)
 			prevsys = refsys
@@ -399,6 +499,81 @@ def ephem_pos(name, mjd):
 			res[1,i] = float(obj.a_dec)
 		return res.reshape((2,)+djd.shape)
 
+class EphemInterpol:
+	"""Cubic spline interpolation of the equatorial position of the ephemeris
+	object name in the time range [t1,t2] (mjd). Starting from nmin intervals,
+	the sample spacing is halved until the interpolation error at the midpoints
+	between the samples is below tol (radians) or maxlevel is reached."""
+	def __init__(self, name, t1, t2, tol=1e-3*utils.arcsec, nmin=16, npad=2, maxlevel=12):
+		self.name = name
+		dt    = (t2-t1)/nmin
+		# Pad the range so that the spline boundary conditions don't matter inside it
+		times = t1 + (np.arange(nmin+2*npad+1)-npad)*dt
+		pos   = ephem_pos(name, times)
+		for level in range(maxlevel):
+			self.t0, self.dt, self.pos = times[0], dt, pos
+			self.pos[0] = utils.unwind(self.pos[0])
+			mid_times = times[:-1]+dt/2
+			mid_pos   = ephem_pos(name, mid_times)
+			inner     = (mid_times > t1) & (mid_times < t2)
+			self.err  = np.max(utils.angdist(self(mid_times[inner]), mid_pos[:,inner]))
+			if self.err < tol: break
+			# Refine by adding the midpoints to our samples
+			times = np.concatenate([times[:,None], np.concatenate([mid_times,[np.nan]])[:,None]],1).reshape(-1)[:-1]
+			pos   = np.concatenate([pos[:,:,None], np.concatenate([mid_pos,[[np.nan],[np.nan]]],1)[:,:,None]],2).reshape(2,-1)[:,:-1]
+			dt   /= 2
+	def __call__(self, mjd):
+		mjd = np.asarray(mjd)
+		res = utils.interpol(self.pos, ((mjd-self.t0)/self.dt)[None], order=3)
+		res[0] %= 2*np.pi
+		return res
+
+class EphemCache:
+	"""A least-recently-used cache of EphemInterpols for up to maxsize
+	(object, time window) combinations."""
+	def __init__(self, maxsize=64):
+		self.maxsize = maxsize
+		self.data    = collections.OrderedDict()
+	def get(self, name, t1, t2, tol):
+		"""Returns an EphemInterpol for object name in the time window [t1,t2]
+		with the given tolerance, building it if necessary."""
+		key = (name, t1, t2, tol)
+		try:
+			ip = self.data.pop(key)
+		except KeyError:
+			ip = EphemInterpol(name, t1, t2, tol=tol)
+		self.data[key] = ip
+		while len(self.data) > self.maxsize:
+			self.data.popitem(last=False)
+		return ip
+	def clear(self): self.data.clear()
+
+# The interpolators used by ephem_pos_interpol
+ephem_cache = EphemCache()
+
+def ephem_pos_interpol(name, mjd, tol=None, window=None):
+	"""As ephem_pos, but interpolates the position from samples computed for
+	whole time windows of the given length (days), with a maximum error of tol
+	(arcseconds). These default to the ephem_interpol_window and ephem_interpol_tol
+	settings. The interpolators are cached, so repeated calls for the same
+	object and times, for example for different detectors or when computing
+	polarization angles with transform_meta, only call pyephem once."""
+	tol    = config.get("ephem_interpol_tol", tol)*utils.arcsec
+	window = config.get("ephem_interpol_window", window)
+	mjd    = np.asarray(mjd)
+	if mjd.ndim == 0 or mjd.size == 0 or tol <= 0: return ephem_pos(name, mjd)
+	flat   = mjd.reshape(-1)
+	wins   = np.floor(flat/window).astype(int)
+	w1, w2 = np.min(wins), np.max(wins)
+	if w1 == w2:
+		res = ephem_cache.get(name, w1*window, (w1+1)*window, tol)(flat)
+	else:
+		res = np.empty((2,flat.size))
+		for w in range(w1, w2+1):
+			mask = wins == w
+			if np.any(mask): res[:,mask] = ephem_cache.get(name, w*window, (w+1)*window, tol)(flat[mask])
+	return res.reshape((2,)+mjd.shape)
+
 def interpol_pos(from_sys, to_sys, name_or_pos, mjd, site=default_site, dt=10):
 	"""Given the name of an ephemeris object or a [ra,dec]-type position
 	in radians in from_sys, compute its position in the specified coordinate system for
@@ -438,3 +613,50 @@ coord_names = {
 	"tele":["az","alt"],
 	"bore":["az","alt"],
 	}
+
+def ephem_pos_interpol_test(names=["Moon","Jupiter","Sun"], nsamp=2000):
+	"""Check that ephem_pos_interpol agrees with ephem_pos to within
+	ephem_interpol_tol across a window boundary, and that the interpolators
+	are reused by repeated calls."""
+	tol    = config.get("ephem_interpol_tol")
+	window = config.get("ephem_interpol_window")
+	mjd    = 57000 + window*np.linspace(0.7, 1.3, nsamp)
+	for name in names:
+		ref  = ephem_pos(name, mjd)
+		res  = ephem_pos_interpol(name, mjd)
+		err  = np.max(utils.angdist(ref, res))/utils.arcsec
+		assert err <= tol, "%s interpolation error %g arcsec > %g" % (name, err, tol)
+		keys = list(ephem_cache.data.keys())
+		assert len([key for key in keys if key[0] == name]) == 2
+		assert np.array_equal(ephem_pos_interpol(name, mjd), res)
+		assert list(ephem_cache.data.keys()) == keys
+	# Scalars and disabled interpolation fall back on ephem_pos
+	assert np.allclose(ephem_pos_interpol("Moon", mjd[0]), ephem_pos("Moon", mjd[0]))
+	assert np.array_equal(ephem_pos_interpol("Moon", mjd[:10], tol=0), ephem_pos("Moon", mjd[:10]))
+
+def transform_dets_test(ndet=20, nsamp=1000, seed=1):
+	"""Check transform_dets against transforming each detector with transform,
+	for several systems, block sizes and with the tol fallback."""
+	rng   = np.random.RandomState(seed)
+	site  = default_site
+	t     = 57000.3 + np.arange(nsamp)/400./86400
+	bore  = np.array([150*utils.degree+0.3*np.sin(np.arange(nsamp)/300.), np.full(nsamp, 45*utils.degree)])
+	def check(osys, offs, ptol, atol, **kwargs):
+		ref = np.array([transform("hor", osys, bore+o[:,None], time=t, site=site, pol=True) for o in offs]).transpose(1,0,2)
+		res = transform_dets("hor", osys, bore, offs, time=t, site=site, **kwargs)
+		assert res.shape == ref.shape
+		perr = np.max(utils.angdist(ref[:2], res[:2]))
+		aerr = np.max(np.abs(utils.rewind(ref[2]-res[2])))
+		assert perr <= ptol and aerr <= atol, "%s pos err %g arcsec ang err %g deg" % (osys, perr/utils.arcsec, aerr/utils.degree)
+		return res
+	# A 1.2 degree wide array is good to better than 0.1 arcsec
+	offs = rng.uniform(-0.6, 0.6, (ndet,2))*utils.degree
+	for osys in ["cel", "gal", "hor:Moon/0_0"]:
+		res = check(osys, offs, 0.1*utils.arcsec, 1e-3*utils.degree)
+		# The block size only affects the memory use
+		assert np.array_equal(res, transform_dets("hor", osys, bore, offs, time=t, site=site, bsize=7*nsamp))
+	# Without pol only the positions are returned
+	assert transform_dets("hor", "cel", bore, offs, time=t, site=site, pol=False).shape == (2,ndet,nsamp)
+	# A 20 degree wide array is not, but with tol the exact transform is used
+	offs = rng.uniform(-10, 10, (ndet,2))*utils.degree
+	check("cel", offs, 1e-6*utils.arcsec, 1e-6*utils.degree, tol=0.1*utils.arcsec)
@@ -32,12 +32,15 @@ And projecting back:
 
 The complication is that sends and receives have to happen at the same time.
 The easiest way to do this is via alltoallv, which requires the use of
-flattened arrays.
+flattened arrays. But most tasks only overlap with a few others, so by
+default we instead exchange the flattened buffers with nonblocking sends
+and receives to just those tasks (see the dmap_exchange config setting).
 """
 from __future__ import division, print_function
-import numpy as np, copy, os, re, operator
-from . import enmap, utils, zipper, mpi
+import numpy as np, copy, os, re, operator, time
+from . import enmap, utils, zipper, mpi, config, bunch, retile
 from astropy.wcs import WCS
+from astropy.io import fits
 
 try: xrange
 except: xrange = range
@@ -468,12 +471,16 @@ for opname in ["__iadd__", "__iand__", idivop, "__ifloordiv__",
 		"__irshift__", "__isub__", "__itruediv__", "__ixor__"]:
 	setattr(Workspace, opname, makefun(opname, True))
 
+config.default("dmap_exchange", "sparse", "How dmaps move data between workspaces and tiles. 'sparse': nonblocking sends and receives to only the tasks we overlap with, using persistent buffers. 'alltoallv': a global alltoallv with freshly allocated buffers.")
 class Bufmap:
 	"""This class encapsulates the information needed to transer data
 	between a list of numpy arrays and an mpi alltoallv buffer, as well
 	as the parameters for alltoallv. It is a helper class for DGeometry
 	and DMap. It does not handle the scomplicated construction of
-	the info objects itself."""
+	the info objects itself.
+
+	For the sparse exchange the buffers are allocated once per dtype and
+	kept, so a Bufmap must not be used by several transfers at once."""
 	def __init__(self, data_info, buf_info=None, buf_shape=None):
 		try:
 			for key in ["data_info","buf_info","buf_shape"]:
@@ -496,10 +503,15 @@ class Bufmap:
 	def buf2buf(self, source_buf, target_bufmap, target_buf, comm):
 		"""Transfer data from one buffer to another using MPI."""
 		comm.Alltoallv((source_buf, self.buf_info),(target_buf,target_bufmap.buf_info))
-	def data2data(self, source_data, target_bufmap, target_data, comm):
+	def data2data(self, source_data, target_bufmap, target_data, comm, method=None):
 		"""Transfer data from one configuration (as described by this
 		bufmap) to another (as described by target_bufmap), allocating
 		buffers internally as needed."""
+		method = config.get("dmap_exchange", method)
+		if method == "sparse":
+			return self.data2data_sparse(source_data, target_bufmap, target_data, comm)
+		elif method != "alltoallv":
+			raise ValueError("Unknown dmap exchange method '%s'" % str(method))
 		# Use dtype.name here to work around mpi4py's inability to handle
 		# numpy's several equivalent descriptions of the same dtype. This
 		# prevents errors like "KeyError '<f'"
@@ -508,6 +520,69 @@ class Bufmap:
 		self.data2buf(source_data, source_buffer)
 		self.buf2buf(source_buffer, target_bufmap, target_buffer, comm)
 		target_bufmap.buf2data(target_buffer, target_data)
+	def data2data_sparse(self, source_data, target_bufmap, target_data, comm, tag=4711):
+		"""Like data2data, but only communicates with the tasks we share
+		data with, using nonblocking point-to-point messages and our persistent
+		buffers. Receives are posted first, each peer's part of the buffer is sent
+		as soon as it is packed, and the local part is accumulated while the
+		remote parts are in flight. The remote parts are then accumulated in
+		task order, so the result does not depend on message arrival order."""
+		source_buffer = self.get_buffer(source_data[0].dtype)
+		target_buffer = target_bufmap.get_buffer(target_data[0].dtype)
+		rank = comm.rank
+		rreqs = {}
+		for id, bslice, info in target_bufmap.segments():
+			if id != rank: rreqs[id] = comm.Irecv(target_buffer[bslice], source=id, tag=tag)
+		sreqs, local = [], None
+		for id, bslice, info in self.segments():
+			for ind, dslice, bs in info:
+				source_buffer[bs] = source_data[ind][dslice].reshape(-1)
+			if id != rank: sreqs.append(comm.Isend(source_buffer[bslice], dest=id, tag=tag))
+			else: local = bslice
+		for d in target_data: d[:] = 0
+		for id, bslice, info in target_bufmap.segments():
+			if id != rank: continue
+			target_buffer[bslice] = source_buffer[local]
+			target_bufmap.buf2data_segment(target_buffer, target_data, info)
+		for id, bslice, info in target_bufmap.segments():
+			if id == rank: continue
+			rreqs[id].Wait()
+			target_bufmap.buf2data_segment(target_buffer, target_data, info)
+		for req in sreqs: req.Wait()
+	def buf2data_segment(self, buf, data, info):
+		"""Accumulate the part of buf described by the data_info entries info
+		into data, without zeroing data first."""
+		for ind, dslice, bslice in info:
+			data[ind][dslice] += buf[bslice].reshape(data[ind][dslice].shape)
+	def segments(self):
+		"""Returns a list of (id, buf_slice, info) for each task we exchange a
+		nonzero amount of data with, where info are our data_info entries
+		for that task. This is derived from buf_info and cached."""
+		try: return self._segments
+		except AttributeError: pass
+		counts, offs = [np.asarray(a) for a in self.buf_info]
+		segs = []
+		for id in np.where(counts > 0)[0]:
+			bslice = slice(offs[id], offs[id]+counts[id])
+			info   = [e for e in self.data_info if e[2].start >= bslice.start and e[2].stop <= bslice.stop and e[2].stop > e[2].start]
+			segs.append((int(id), bslice, info))
+		self._segments = segs
+		return segs
+	def get_buffer(self, dtype):
+		"""Returns our persistent buffer for the given dtype, allocating it
+		the first time it is needed."""
+		# See data2data for why we use the name
+		name = np.dtype(dtype).name
+		try: buffers = self._buffers
+		except AttributeError: buffers = self._buffers = {}
+		if name not in buffers:
+			buffers[name] = np.zeros(self.buf_shape, name)
+		return buffers[name]
+	def __getstate__(self):
+		# Don't copy the cached buffers and segments along with the rest
+		return {key: val for key, val in self.__dict__.items() if key not in ["_buffers","_segments"]}
+	def __setstate__(self, state):
+		self.__dict__.update(state)
 	def slice_helper(self, newlen, oldlen):
 		"""Returns a new Bufmap with buffer slices scaled by newlen/oldlen.
 		This is used for defining slice operations."""
@@ -516,16 +591,55 @@ class Bufmap:
 		data_info = [(ind,dslice,slice(bslice.start*newlen//oldlen,bslice.stop*newlen//oldlen)) for ind,dslice,bslice in self.data_info]
 		return Bufmap(data_info, buf_info, buf_shape)
 
+def exchange_bench(shape=(3,4000,8000), tshape=(240,240), wshape=(600,1200), nrep=10, comm=None, seed=0):
+	"""Compare the speed of the sparse and alltoallv exchanges used by work2tile
+	and tile2work. Each task gets a workspace of shape wshape in a band of the
+	map that depends on its rank, like it would for scans sorted by position.
+	Run it with many tasks, for example
+	  mpirun -n 256 python -c "from enlib import dmap; print(dmap.exchange_bench())"
+	Returns {method: (work2tile, tile2work)} with the max time per call
+	across tasks, on all tasks."""
+	if comm is None: comm = mpi.COMM_WORLD
+	ny, nx = shape[-2:]
+	wy, wx = min(wshape[0],ny), min(wshape[1],nx)
+	rng = np.random.RandomState(seed+comm.rank)
+	y0  = int((ny-wy)*(comm.rank+rng.uniform())/comm.size)
+	x0  = rng.randint(0, nx-wx+1)
+	geo = DGeometry(shape=shape, bbpix=[[y0,x0],[y0+wy,x0+wx]], tshape=tshape, dtype=np.float32, comm=comm)
+	m   = zeros(geo)
+	res, ref = {}, None
+	for method in ["alltoallv", "sparse"]:
+		work = geo.build_work()
+		for w in work.maps: w[:] = 1
+		times = np.zeros(2)
+		for i in range(nrep):
+			comm.Barrier()
+			t1 = time.time()
+			geo.work_bufinfo.data2data(work.maps, geo.tile_bufinfo, m.tiles, comm, method=method)
+			t2 = time.time()
+			geo.tile_bufinfo.data2data(m.tiles, geo.work_bufinfo, work.maps, comm, method=method)
+			t3 = time.time()
+			times += [t2-t1, t3-t2]
+		res[method] = tuple(utils.allreduce(times/nrep, comm, op=mpi.MAX))
+		# Make sure the methods agree
+		if ref is None: ref = work
+		else: assert all([np.all(a == b) for a, b in zip(ref.maps, work.maps)])
+	return res
+
+config.default("dmap_io", "stream", "How dmaps are read from and written to single files. 'stream': each task reads and writes its own tiles directly at their place in the file, so no task holds more than its own tiles. 'root': assemble the full map on the first task. Files that can't be streamed (compressed, scaled or chunked) always use 'root'.")
 def write_map(name, map, ext="fits", merged=True):
 	if not merged:
 		# Write as individual tiles in directory of the specified name
 		utils.mkdir(name)
 		for pos, tile in zip(map.loc_pos,map.tiles):
 			enmap.write_map(name + "/tile%03d_%03d.%s" % (tuple(pos)+(ext,)), tile)
+	elif config.get("dmap_io") == "stream" and stream_writable(name, map.dtype):
+		# Write to a single file, with each task writing its own tiles directly
+		# into it. Only the header is handled by the first task.
+		write_map_stream(name, map)
 	else:
-		# Write to a single file. This currently creates the full map
-		# in memory while writing. It is unclear how to avoid this
-		# without bypassing pyfits or becoming super-slow.
+		# Write to a single file. This creates the full map in memory on
+		# the first task while writing.
 		if map.comm.rank == 0:
 			canvas = enmap.zeros(map.shape, map.wcs, np.dtype(map.dtype).name)
 		else:
@@ -536,36 +650,30 @@ def write_map(name, map, ext="fits", merged=True):
 
 def read_map(name, bbpix=None, bbox=None, tshape=None, comm=None, pixbox=None):
 	if comm is None: comm = mpi.COMM_WORLD
+	layout = None
+	if not os.path.isdir(name) and pixbox is None and config.get("dmap_io") == "stream":
+		layout = read_stream_layout(name, comm)
 	if os.path.isdir(name):
 		if pixbox is not None: raise NotImplementedError("dmap.read_map with a pixbox is not implemented for dmaps that are stored as tiles on disk")
-		# Find the number of tiles in the map
-		entries = os.listdir(name)
-		nrow, ncol = 0,0
-		for entry in entries:
-			match = re.search(r'^tile(\d+)_(\d+).([^.]+)$', entry)
-			if match:
-				nrow = max(nrow,1+int(match.group(1)))
-				ncol = max(ncol,1+int(match.group(2)))
-				ext  = match.group(3)
-		# Build the list of tile files
-		tfiles = [["" for c in range(ncol)] for r in range(nrow)]
-		for entry in entries:
+		# Find the tile file extension
+		ext = None
+		for entry in os.listdir(name):
 			match = re.search(r'^tile(\d+)_(\d+).([^.]+)$', entry)
-			if match: tfiles[int(match.group(1))][int(match.group(2))] = entry
-		if nrow == 0: raise IOError("'%s' is not a valid dmap file" % name)
-		# Find the tile size and map extent
-		tile1 = enmap.read_map(name+"/"+tfiles[0][0])
-		tile2 = enmap.read_map(name+"/"+tfiles[-1][-1])
-		npre, tshape = tile1.shape[:-2], tile1.shape[-2:]
-		wcs = tile1.wcs
-		shape = npre + (tile1.shape[-2]*(nrow-1)+tile2.shape[-2],tile1.shape[-1]*(ncol-1)+tile2.shape[-1])
-		dtype = tile1.dtype
-		# Construct our dmap and read our tiles
-		map = Dmap(geometry(shape, wcs, bbpix=bbpix, bbox=bbox, tshape=tshape, dtype=dtype, comm=comm))
+			if match: ext = match.group(3)
+		if ext is None: raise IOError("'%s' is not a valid dmap file" % name)
+		# Get the tile layout from the tile index, and read our tiles. Each
+		# is only read once, so don't bother caching them.
+		store = retile.TileStore(name + "/tile%(y)03d_%(x)03d." + ext)
+		geo   = store.geometry((0,0))
+		map = Dmap(geometry(geo.shape, geo.wcs, bbpix=bbpix, bbox=bbox, tshape=geo.tshape, dtype=geo.dtype, comm=comm))
 		for pos, tile in zip(map.loc_pos,map.tiles):
-			tile[:] = enmap.read_map(name+"/"+tfiles[pos[0]][pos[1]])
+			tile[:] = store.read(pos[0], pos[1], cache=False)
+	elif layout is not None:
+		# Map is in a single file that each task can read its own tiles from directly
+		map = read_map_stream(name, layout, bbpix=bbpix, bbox=bbox, tshape=tshape, comm=comm)
 	else:
-		# Map is in a single file. This is very memory-wasteful - 30 GB for an advact map
+		# Map is in a single file, and we could not read it directly. This is very
+		# memory-wasteful - 30 GB for an advact map
 		# Get map info
 		if comm.rank == 0:
 			canvas = enmap.read_map(name, pixbox=pixbox)
@@ -617,6 +725,169 @@ def dmap2enmap(dmap, emap, root=0):
 		if dmap.comm.rank == root:
 			emap[...,box[0,0]:box[1,0],box[0,1]:box[1,1]] = data
 
+fits_bitpix = {"uint8": 8, "int16": 16, "int32": 32, "int64": 64, "float32": -32, "float64": -64}
+
+def stream_fmt(name):
+	"""The single-file format enmap.write_map would use for name."""
+	return "hdf" if name.endswith(".hdf") else "fits"
+
+def stream_writable(name, dtype):
+	"""Whether a map with the given dtype can be written to the single file
+	name with write_map_stream."""
+	dtype = np.dtype(dtype)
+	if stream_fmt(name) == "fits":
+		return dtype.name in fits_bitpix and not name.endswith(".gz")
+	try: import h5py
+	except ImportError: return False
+	return dtype.kind in "biufc"
+
+def write_map_stream(name, map, root=0):
+	"""Write map to the single fits or hdf file name, with each task writing
+	its own tiles directly to their place in the file. Only the header is
+	written by the root task, so no task needs more memory than its tiles."""
+	if map.comm.rank == root:
+		utils.mkdir(os.path.dirname(name))
+		if stream_fmt(name) == "hdf": layout = create_hdf_stream(name, map.shape, map.wcs, map.dtype)
+		else: layout = create_fits_stream(name, map.shape, map.wcs, map.dtype)
+	else: layout = None
+	layout = map.comm.bcast(layout, root=root)
+	write_tiles_raw(name, map, layout)
+	map.comm.Barrier()
+
+def read_map_stream(name, layout, bbpix=None, bbox=None, tshape=None, comm=None):
+	"""Read a Dmap from the single fits or hdf file name, with each task reading
+	its own tiles directly from the file. layout must be the result of
+	read_stream_layout."""
+	if comm is None: comm = mpi.COMM_WORLD
+	wcs   = WCS(fits.Header.fromstring(layout.header)).sub(2)
+	# Use the name to get a native byte order
+	dtype = np.dtype(layout.dtype).name
+	map   = Dmap(geometry(layout.shape, wcs, bbpix=bbpix, bbox=bbox, tshape=tshape, dtype=dtype, comm=comm))
+	read_tiles_raw(name, map, layout)
+	return map
+
+def read_stream_layout(name, comm, root=0):
+	"""Find where the pixels of the single-file map name are stored. Returns a
+	bunch with the shape, on-disk dtype, byte offset and fits header of the map,
+	or None if the map can't be read directly (for example because it is
+	compressed, scaled or chunked). The root task does the work, and the
+	result is broadcast to all tasks."""
+	layout = None
+	if comm.rank == root:
+		try:
+			if stream_fmt(name) == "hdf": layout = read_hdf_layout(name)
+			else: layout = read_fits_layout(name)
+		except (IOError, OSError, KeyError, ImportError):
+			layout = None
+	return comm.bcast(layout, root=root)
+
+def create_fits_stream(name, shape, wcs, dtype):
+	"""Write the header of a fits map with the given geometry and dtype to name,
+	and make room for its data. Returns the layout of the data in the file."""
+	# This mirrors the header enmap.write_map would make
+	header = wcs.to_header(relax=True)
+	header.insert(0, ("SIMPLE",True))
+	header.insert(1, ("BITPIX",fits_bitpix[np.dtype(dtype).name]))
+	header.insert(2, ("NAXIS",len(shape)))
+	for i, s in enumerate(shape[::-1]):
+		header.insert(3+i, ("NAXIS%d"%(i+1),s))
+	hstr   = header.tostring()
+	fdtype = np.dtype(dtype).newbyteorder(">")
+	nbyte  = np.product(shape, dtype=int)*fdtype.itemsize
+	with open(name, "wb") as f:
+		f.write(hstr.encode("ascii"))
+		# The data must be padded to whole fits blocks. truncate fills with zeros
+		f.truncate(len(hstr) + (nbyte+2879)//2880*2880)
+	return bunch.Bunch(shape=tuple(shape), dtype=fdtype.str, offset=len(hstr), header=hstr)
+
+def create_hdf_stream(name, shape, wcs, dtype):
+	"""Create an hdf map file with the given geometry and dtype in the same
+	format as enmap.write_map, with space for the data allocated but not written.
+	Returns the layout of the data in the file."""
+	import h5py
+	dtype = np.dtype(dtype)
+	with h5py.File(name, "w") as hfile:
+		# Allocate a contiguous dataset up front so it has a fixed offset
+		plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+		plist.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+		plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
+		dset  = h5py.h5d.create(hfile.id, b"data", h5py.h5t.py_create(dtype), h5py.h5s.create_simple(tuple(shape)), dcpl=plist)
+		offset= dset.get_offset()
+		header = wcs.to_header()
+		for key in header:
+			hfile["wcs/"+key] = header[key]
+	return bunch.Bunch(shape=tuple(shape), dtype=dtype.str, offset=offset, header=header.tostring())
+
+def read_fits_layout(name):
+	"""Returns the layout of the data in the fits map name, or None
+	if it can't be read directly."""
+	with open(name, "rb") as f:
+		# Compressed files don't start with a plain header
+		if f.read(6) != b"SIMPLE": return None
+	with fits.open(name, do_not_scale_image_data=True) as hdus:
+		header = hdus[0].header
+		offset = hdus.fileinfo(0)["datLoc"]
+	dtypes = {bitpix: dname for dname, bitpix in fits_bitpix.items()}
+	if header["NAXIS"] < 2 or header["BITPIX"] not in dtypes: return None
+	if header.get("BSCALE",1) != 1 or header.get("BZERO",0) != 0: return None
+	shape  = tuple([header["NAXIS%d"%(i+1)] for i in range(header["NAXIS"])][::-1])
+	fdtype = np.dtype(dtypes[header["BITPIX"]]).newbyteorder(">")
+	return bunch.Bunch(shape=shape, dtype=fdtype.str, offset=offset, header=header.tostring())
+
+def read_hdf_layout(name):
+	"""Returns the layout of the data in the hdf map name, or None
+	if it can't be read directly."""
+	import h5py
+	with h5py.File(name, "r") as hfile:
+		dset   = hfile["data"]
+		# Chunked and unallocated datasets don't have an offset
+		offset = dset.id.get_offset()
+		if offset is None or dset.ndim < 2: return None
+		header = fits.Header()
+		for key in hfile["wcs"]:
+			val = hfile["wcs/"+key][()]
+			if isinstance(val, bytes): val = val.decode()
+			header[key] = val
+		return bunch.Bunch(shape=dset.shape, dtype=dset.dtype.str, offset=offset, header=header.tostring())
+
+def raw_tile_chunks(shape, box, itemsize):
+	"""Yields (offset, pre_index, row_slice) for each contiguous run of a tile
+	covering the pixel box [{from,to},{y,x}] in a C-ordered array with the given
+	shape. offset is in bytes, and the indices are into the tile reshaped
+	to [npre,ny,nx]."""
+	npre   = np.product(shape[:-2], dtype=int)
+	ny, nx = shape[-2:]
+	(y1,x1),(y2,x2) = box
+	# Rows are only contiguous when the tile spans the full width of the map
+	step = max(y2-y1,1) if x1 == 0 and x2 == nx else 1
+	for pi in range(npre):
+		for y in range(y1, y2, step):
+			yield ((pi*ny+y)*nx+x1)*itemsize, pi, slice(y-y1,y-y1+step)
+
+def write_tiles_raw(name, dmap, layout):
+	"""Write our tiles into their place in the existing file name, which
+	has the given layout."""
+	fdtype = np.dtype(layout.dtype)
+	with open(name, "r+b") as f:
+		for ind, tile in zip(dmap.loc_inds, dmap.tiles):
+			data = np.ascontiguousarray(tile, dtype=fdtype).reshape((-1,)+tile.shape[-2:])
+			for off, pi, ys in raw_tile_chunks(layout.shape, dmap.geometry.tile_boxes[ind], fdtype.itemsize):
+				f.seek(layout.offset+off)
+				f.write(data[pi,ys].tobytes())
+
+def read_tiles_raw(name, dmap, layout):
+	"""Read our tiles from their place in the file name, which has
+	the given layout."""
+	fdtype = np.dtype(layout.dtype)
+	with open(name, "rb") as f:
+		for ind, tile in zip(dmap.loc_inds, dmap.tiles):
+			data = np.empty((np.product(tile.shape[:-2], dtype=int),)+tile.shape[-2:], fdtype)
+			for off, pi, ys in raw_tile_chunks(layout.shape, dmap.geometry.tile_boxes[ind], fdtype.itemsize):
+				f.seek(layout.offset+off)
+				rows = data[pi,ys]
+				rows[:] = np.frombuffer(f.read(rows.nbytes), fdtype).reshape(rows.shape)
+			tile[:] = data.reshape(tile.shape)
+
 def box2pix(shape, wcs, box):
 	"""Convert one or several bounding boxes of shape [2,2] or [n,2,2]
 	into pixel counding boxes in standard python half-open format.
@@ -5,7 +5,7 @@ an object containing the paths to all the files corresponding to that "id".
 For example, for the actpol data set, querying with "1376512459.1376536951.ar1"
 would respond with an object giving the location of the TOD, cuts, gains, etc.
 for that id."""
-import glob, shlex, pipes, re, itertools
+import glob, shlex, pipes, re, itertools, string
 from . import bunch
 
 class Basedb:
@@ -56,6 +56,12 @@ class FormatDB(Basedb):
 			name, format  = toks[0], toks[1:]
 			self.rules.append({"name":name, "format": format})
 			self.static[name] = format
+		# The variables our @var blocks select on. The rules that apply to an
+		# id only depend on these, so plans are cached by their values
+		self.selector_vars = sorted(set([rule["name"][1:] for rule in self.rules if rule["name"][0] == "@" and rule["name"] not in ["@end","@else"]]))
+		self.plans = {}
+		self.infos = {}
+		self.keys  = {}
 	def __getitem__(self, id):
 		return self.query(id)
 	def query(self, id, multi=True):
@@ -63,9 +69,102 @@ class FormatDB(Basedb):
 		toks    = id.split(":")
 		id  = toks[0]
 		tag = toks[1] if len(toks) > 1 else None
-		info = {name: fun(id) for name, fun in self.funcs}
+		info = self.get_info(id)
+		rules, assigns = self.plan(info)
+		# The format variables with each set of assignments applied, as needed
+		infos = [None]*len(assigns)
 		res = bunch.Bunch()
-		selected=[True]
+		for name, formats, ai in rules:
+			if infos[ai] is None: infos[ai] = dict(info, **assigns[ai])
+			tmp = [fmt.format(**infos[ai]) for fmt in formats]
+			res[name] = tmp if multi else tmp[0]
+		res.id  = id
+		res.tag = tag
+		# Apply override if specified:
+		if self.override and self.override != "none":
+			info = dict(info, **assigns[-1])
+			for tok in self.override.split(","):
+				name, val = tok.split(":")
+				val = val.format(**info)
+				res[name] = [val] if multi else val
+		return res
+	def query_many(self, ids, multi=True):
+		"""Query several ids at once. Returns a bunch of lists with one entry
+		per id, with the same names as the results of query, and None for ids
+		a name isn't defined for. This is much faster than calling query for
+		each id, as ids that share a plan are formatted together, formats that
+		don't depend on the id are only formatted once per plan, and the
+		results of the funcs are remembered between calls."""
+		nid    = len(ids)
+		toks   = [id.split(":") for id in ids]
+		tags   = [tok[1] if len(tok) > 1 else None for tok in toks]
+		ids    = [tok[0] for tok in toks]
+		infos  = [self.get_info(name) for name in ids]
+		# Group the ids by the plan that applies to them
+		groups = {}
+		for i, name in enumerate(ids):
+			try: key = self.keys[name]
+			except KeyError: key = self.keys[name] = self.plan_key(infos[i])
+			if key not in groups: groups[key] = self.plan(infos[i]) + ([],)
+			groups[key][2].append(i)
+		res = bunch.Bunch()
+		def col(name):
+			if name not in res: res[name] = [None]*nid
+			return res[name]
+		for rules, assigns, inds in groups.values():
+			for name, formats, ai in rules:
+				vals = [self.format_many(fmt, infos, inds, assigns[ai]) for fmt in formats]
+				vals = [list(v) for v in zip(*vals)] if multi else vals[0]
+				out  = col(name)
+				for i, val in zip(inds, vals): out[i] = val
+		res.id  = ids
+		res.tag = tags
+		# Apply override if specified:
+		if self.override and self.override != "none":
+			for rules, assigns, inds in groups.values():
+				for tok in self.override.split(","):
+					name, fmt = tok.split(":")
+					vals = self.format_many(fmt, infos, inds, assigns[-1])
+					out  = col(name)
+					for i, val in zip(inds, vals): out[i] = [val] if multi else val
+		return res
+	def get_info(self, id):
+		"""The format variables for id, as given by our funcs. These are
+		remembered, since they are often expensive to evaluate. The
+		corresponding plan keys are remembered in self.keys by query_many."""
+		try: return self.infos[id]
+		except KeyError:
+			info = {name: fun(id) for name, fun in self.funcs}
+			self.infos[id] = info
+			return info
+	def format_many(self, fmt, infos, inds, assign):
+		"""Evaluate fmt for each infos[inds] with the variable assignments
+		assign applied. The assigned variables are substituted first, so
+		formats that only depend on them are only evaluated once."""
+		parts, variable = [], False
+		for literal, field, spec, conv in string.Formatter().parse(fmt):
+			parts.append(literal.replace("{","{{").replace("}","}}"))
+			if field is None: continue
+			name  = re.split(r"[.\[]", field)[0]
+			field = "{" + field + ("!"+conv if conv else "") + (":"+spec if spec else "") + "}"
+			if name in assign:
+				parts.append(field.format(**assign).replace("{","{{").replace("}","}}"))
+			else:
+				parts.append(field)
+				variable = True
+		fmt = "".join(parts)
+		if not variable: return [fmt.format()]*len(inds)
+		return [fmt.format(**infos[i]) for i in inds]
+	def plan(self, info):
+		"""Find the rules that apply for the format variables info. Returns
+		a list of (name, formats, ai) for each selected rule, and a list of
+		the successive sets of variable assignments, where ai is the index of
+		the one in effect for the rule. The last one is in effect at the end.
+		This only depends on the values of the selector variables, so the
+		result is cached by those."""
+		key = self.plan_key(info)
+		if key in self.plans: return self.plans[key]
+		assigns, rules, selected = [{}], [], [True]
 		for rule in self.rules:
 			name, format = rule["name"], rule["format"]
 			if name[0] == "@":
@@ -76,30 +175,58 @@ class FormatDB(Basedb):
 					selected[-1] = not selected[-1]
 				else:
 					# General format @var:case case case ...
-					match = False
-					for case in format:
-						match |= ("{%s}"%name[1:]).format(**info) == case
-					selected.append(match)
-					#selected.append(("{%s}"%name[1:]).format(**info) == format[0])
+					value = ("{%s}"%name[1:]).format(**dict(info, **assigns[-1]))
+					selected.append(any([value == case for case in format]))
 			elif len(format) == 0 or len(format[0]) == 0:
 				# Handle variable assignment. Avoids repeating the same long paths over and over again
 				vname, vval = re.split(r"\s*=\s*", name)
-				info[vname] = vval
+				assigns.append(dict(assigns[-1]))
+				assigns[-1][vname] = vval
 			elif all(selected):
-				tmp = [fmt.format(**info) for fmt in rule["format"]]
-				res[rule["name"]] = tmp if multi else tmp[0]
-		res.id  = id
-		res.tag = tag
-		# Apply override if specified:
-		if self.override and self.override != "none":
-			for tok in self.override.split(","):
-				name, val = tok.split(":")
-				val = val.format(**info)
-				res[name] = [val] if multi else val
-		return res
+				rules.append((name, format, len(assigns)-1))
+		self.plans[key] = (rules, assigns)
+		return self.plans[key]
+	def plan_key(self, info):
+		return tuple([format(info[var]) if var in info else None for var in self.selector_vars])
 	def dump(self):
 		lines = []
 		for rule in self.rules:
 			line = "%s: %s" %(rule["name"], " ".join([pipes.quote(fmt) for fmt in rule["format"]]))
 			lines.append(line)
 		return "\n".join(lines)
+
+def query_many_test(nid=200):
+	"""Check that query_many gives the same results as calling query for
+	each id, with and without an override."""
+	data = """
+root = /data
+@season:s13
+ tod: {root}/s13/{t5}/{id}.zip
+ cal = /cal13
+@else
+ tod: {root}/other/{id}.zip
+ cal = /calx
+@end
+@ar:ar1 ar2
+ gain: {cal}/g_{ar}.txt
+ @season:s14
+  extra: {cal}/x{id}
+ @end
+@else
+ gain: {cal}/default.txt
+@end
+cut: {root}/cuts/{id}.cuts {root}/cuts2/{id}.cuts
+"""
+	funcs = {"id": lambda id: id, "t5": lambda id: id[:5], "ar": lambda id: id.split(".")[-1],
+		"season": lambda id: "s13" if int(id[:10]) < 1300100000 else "s14"}
+	ids = ["%d.%d.ar%d:tag" % (1300000000+i*1000, 1300000007+i*1000, i%4) for i in range(nid)]
+	for override in [None, "tod:{cal}/{id}.o"]:
+		db = FormatDB(data=data, funcs=funcs, override=override)
+		for multi in [True, False]:
+			cols = db.query_many(ids, multi=multi)
+			for j, id in enumerate(ids):
+				a = dict(db.query(id, multi=multi))
+				b = {name: col[j] for name, col in cols.items() if col[j] is not None}
+				assert a == b, "query_many mismatch for %s: %s vs %s" % (id, a, b)
+		# One plan per combination of season and array
+		assert len(db.plans) == 8
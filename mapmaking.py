@@ -37,10 +37,10 @@
 # signal_phase = SignalPhase(..., cut=signal_cut)
 # signals = [signal_cut, signal_map, signal_phase]
 from __future__ import division, print_function
-import numpy as np, h5py, logging, gc
+import numpy as np, h5py, logging, gc, collections
 from . import enmap, dmap, array_ops, pmat, utils, todfilter, pointsrcs, zipper
-from . import config, nmat, bench, gapfill, mpi, sampcut, fft
-from .cg import CG
+from . import config, nmat, bench, gapfill, mpi, sampcut, fft, memory
+from .cg import CG, Checkpoint
 L = logging.getLogger(__name__)
 
 def dump(fname, d):
@@ -66,9 +66,19 @@ class Signal:
 		self.output = output
 	def prepare (self, x): return x.copy()
 	def forward (self, scan, tod, x): pass
+	# Whether forward(scan, tod, x, tmul=0) overwrites every sample in tod.
+	# If so, Eqsys can skip zeroing the tod before projecting.
+	def overwrites(self, scan): return False
 	def backward(self, scan, tod, x): pass
 	def precompute(self, scan): pass
 	def free(self): pass
+	# The per-scan state set up by precompute, so that it can be put back
+	# with restore after free without redoing the precomputation.
+	def precomputed(self): return None
+	def restore(self, state): pass
+	# Whether stats(scan, ...) can compute div, hits and crosslinks for
+	# all our scans in one pass. See calc_map_stats.
+	def supports_stats(self): return False
 	def finish  (self, x, y): x[:] = y
 	def polmat(self): return self.zeros(mat=True)
 	def polinv(self, m): return 1/m
@@ -86,10 +96,11 @@ class Signal:
 
 class SignalMap(Signal):
 	def __init__(self, scans, area, comm, cuts=None, name="main", ofmt="{name}", output=True,
-			ext="fits", pmat_order=None, sys=None, nuisance=False, data=None, extra=[]):
+			ext="fits", pmat_order=None, sys=None, nuisance=False, data=None, extra=[], cache=None):
 		Signal.__init__(self, name, ofmt, output, ext)
 		self.area = area
 		self.cuts = cuts
+		self.cache= cache
 		self.dof  = zipper.ArrayZipper(area, comm=comm)
 		self.dtype= area.dtype
 		if data is not None:
@@ -98,10 +109,22 @@ class SignalMap(Signal):
 			self.data = {scan: pmat.PmatMap(scan, area, order=pmat_order, sys=sys, extra=extra) for scan in scans}
 	def forward(self, scan, tod, work, tmul=1, mmul=1):
 		if scan not in self.data: return
-		self.data[scan].forward(tod, work, tmul=tmul, mmul=mmul)
+		mat = self.data[scan]
+		mat.forward(tod, work, tmul=tmul, mmul=mmul, point=self.get_point(mat))
 	def backward(self, scan, tod, work, tmul=1, mmul=1):
 		if scan not in self.data: return
-		self.data[scan].backward(tod, work, tmul=tmul, mmul=mmul)
+		mat = self.data[scan]
+		mat.backward(tod, work, tmul=tmul, mmul=mmul, point=self.get_point(mat))
+	def overwrites(self, scan): return scan in self.data
+	def get_point(self, mat):
+		"""Look up the precomputed pointing for mat in our pmat.PointingCache, if any."""
+		if self.cache is None or mat.order != 0: return None
+		return self.cache.get(mat)
+	def supports_stats(self):
+		return all([type(mat) is pmat.PmatMap and mat.order == 0 for mat in self.data.values()])
+	def stats(self, scan, div, hits, cmap, cut, dweight=None, wsamp=None):
+		if scan not in self.data: return
+		self.data[scan].stats(div, hits[0], cmap, cut, dweight=dweight, wsamp=wsamp)
 	def finish(self, m, work):
 		self.dof.comm.Allreduce(work, m)
 	def zeros(self, mat=False):
@@ -132,6 +155,9 @@ class SignalMapFast(SignalMap):
 		self.pix, self.phase = self.data[scan].get_pix_phase()
 	def free(self):
 		del self.pix, self.phase
+	def precomputed(self): return (self.pix, self.phase)
+	def restore(self, state): self.pix, self.phase = state
+	def overwrites(self, scan): return False
 	def forward(self, scan, tod, work):
 		if scan not in self.data: return
 		self.data[scan].forward(tod, work, self.pix, self.phase)
@@ -142,10 +168,11 @@ class SignalMapFast(SignalMap):
 config.default("dmap_format","merged","How to store dmaps on disk. 'merged': combine into a single fits file before writing. This is memory intensive. 'tiles': Write the tiles that make up the dmap directly to disk.")
 class SignalDmap(Signal):
 	def __init__(self, scans, subinds, area, cuts=None, name="main", ofmt="{name}", output=True,
-			ext="fits", pmat_order=None, sys=None, nuisance=False, data=None, extra=[]):
+			ext="fits", pmat_order=None, sys=None, nuisance=False, data=None, extra=[], cache=None):
 		Signal.__init__(self, name, ofmt, output, ext)
 		self.area = area
 		self.cuts = cuts
+		self.cache= cache
 		self.dof  = dmap.DmapZipper(area)
 		self.dtype= area.dtype
 		self.subs = subinds
@@ -159,11 +186,22 @@ class SignalDmap(Signal):
 	def forward(self, scan, tod, work, tmul=1, mmul=1):
 		if scan not in self.data: return
 		mat, ind = self.data[scan]
-		mat.forward(tod, work.maps[ind], tmul=tmul, mmul=mmul)
+		mat.forward(tod, work.maps[ind], tmul=tmul, mmul=mmul, point=self.get_point(mat))
 	def backward(self, scan, tod, work, tmul=1, mmul=1):
 		if scan not in self.data: return
 		mat, ind = self.data[scan]
-		mat.backward(tod, work.maps[ind], tmul=tmul, mmul=mmul)
+		mat.backward(tod, work.maps[ind], tmul=tmul, mmul=mmul, point=self.get_point(mat))
+	def overwrites(self, scan): return scan in self.data
+	def get_point(self, mat):
+		"""Look up the precomputed pointing for mat in our pmat.PointingCache, if any."""
+		if self.cache is None or mat.order != 0: return None
+		return self.cache.get(mat)
+	def supports_stats(self):
+		return all([type(mat) is pmat.PmatMap and mat.order == 0 for mat, ind in self.data.values()])
+	def stats(self, scan, div, hits, cmap, cut, dweight=None, wsamp=None):
+		if scan not in self.data: return
+		mat, ind = self.data[scan]
+		mat.stats(div.maps[ind], hits.maps[ind][0], cmap.maps[ind], cut, dweight=dweight, wsamp=wsamp)
 	def finish(self, m, work):
 		m.work2tile(work)
 	def filter(self, work):
@@ -213,6 +251,9 @@ class SignalDmapFast(SignalDmap):
 		self.pix, self.phase = mat.get_pix_phase()
 	def free(self):
 		del self.pix, self.phase
+	def precomputed(self): return (self.pix, self.phase)
+	def restore(self, state): self.pix, self.phase = state
+	def overwrites(self, scan): return False
 	def forward(self, scan, tod, work):
 		if scan not in self.data: return
 		mat, ind = self.data[scan]
@@ -405,6 +446,7 @@ class SignalMapBuddies(SignalMap):
 			pmat.PmatMapMultibeam(scan, area, scan.buddy_offs,
 				scan.buddy_comps, order=pmat_order, sys=sys)
 			] for scan in scans}
+	def overwrites(self, scan): return False
 	def forward(self, scan, tod, work):
 		if scan not in self.data: return
 		for pmat in self.data[scan]:
@@ -504,18 +546,23 @@ class PreconMapBinned:
 		nosie approximation of N". If noise=False, instead computes
 		(P'P)". If hits=True, also computes a hitcount map."""
 		ncomp = signal.area.shape[0]
-		self.div = signal.zeros(mat=True)
-		calc_div_map(self.div, signal, scans, weights, noise=noise)
-		self.idiv = array_ops.eigpow(self.div, -1, axes=[0,1], lim=config.get("eig_limit"), fallback="scalar")
-		#self.idiv[:] = np.eye(3)[:,:,None,None]
-		if hits:
-			# Build hitcount map too
-			self.hits = signal.area.copy()
-			self.hits = calc_hits_map(self.hits, signal, scans)
-		else: self.hits = None
+		if use_map_stats(signal, scans, weights, noise=noise):
+			# Get div and hits in a single pass
+			self.div, self.hits, _ = calc_map_stats(signal, scans, weights, noise=noise)
+			if not hits: self.hits = None
+		else:
+			self.div = signal.zeros(mat=True)
+			calc_div_map(self.div, signal, scans, weights, noise=noise)
+			if hits:
+				# Build hitcount map too
+				self.hits = signal.area.copy()
+				self.hits = calc_hits_map(self.hits, signal, scans)
+			else: self.hits = None
+		# Store the inverse in packed form, which takes 6 instead of 9 numbers per pixel
+		self.ipack, self.imask = array_ops.eigpow_packed(self.div, -1, axes=[0,1], lim=config.get("eig_limit"))
 		self.signal = signal
 	def __call__(self, m):
-		m[:] = array_ops.matmul(self.idiv, m, axes=[0,1])
+		array_ops.matmul_packed(self.ipack, self.imask, m)
 	def write(self, prefix):
 		self.signal.write(prefix, "div", self.div)
 		if self.hits is not None:
@@ -526,20 +573,25 @@ class PreconDmapBinned:
 		"""Binned preconditioner: (P'W"P)", where W" is a white
 		nosie approximation of N". If noise=False, instead computes
 		(P'P)". If hits=True, also computes a hitcount map."""
-		self.div = signal.zeros(mat=True)
-		calc_div_map(self.div, signal, scans, weights, noise=noise)
-		self.idiv = self.div.copy()
-		for dtile in self.idiv.tiles:
-			dtile[:] = array_ops.eigpow(dtile, -1, axes=[0,1], lim=config.get("eig_limit"), fallback="scalar")
-		if hits:
-			# Build hitcount map too
-			self.hits = signal.area.copy()
-			self.hits = calc_hits_map(self.hits, signal, scans)
-		else: self.hits = None
+		if use_map_stats(signal, scans, weights, noise=noise):
+			# Get div and hits in a single pass
+			self.div, self.hits, _ = calc_map_stats(signal, scans, weights, noise=noise)
+			if not hits: self.hits = None
+		else:
+			self.div = signal.zeros(mat=True)
+			calc_div_map(self.div, signal, scans, weights, noise=noise)
+			if hits:
+				# Build hitcount map too
+				self.hits = signal.area.copy()
+				self.hits = calc_hits_map(self.hits, signal, scans)
+			else: self.hits = None
+		self.ipack = []
+		for dtile in self.div.tiles:
+			self.ipack.append(array_ops.eigpow_packed(dtile, -1, axes=[0,1], lim=config.get("eig_limit")))
 		self.signal = signal
 	def __call__(self, m):
-		for idtile, mtile in zip(self.idiv.tiles, m.tiles):
-			mtile[:] = array_ops.matmul(idtile, mtile, axes=[0,1])
+		for (ptile, masktile), mtile in zip(self.ipack, m.tiles):
+			array_ops.matmul_packed(ptile, masktile, mtile)
 	def write(self, prefix):
 		self.signal.write(prefix, "div", self.div)
 		if self.hits is not None:
@@ -700,7 +752,56 @@ def calc_div_map(div, signal, scans, weights, cuts=None, noise=True):
 		prec_div_helper(signal, scans, weights, iwork, owork, cuts=cuts, noise=noise)
 		signal.finish(div[i], owork)
 
+def use_map_stats(signal, scans, weights, noise=True):
+	"""Whether calc_map_stats can replace calc_div_map and calc_hits_map for these
+	arguments. That requires signal.supports_stats(), every weight to be diagonal
+	(a per-sample multiplication that is the same for every detector) and, if noise
+	is used, every scan.noise to have a white_diagonal white noise approximation."""
+	if not signal.supports_stats(): return False
+	if not all([getattr(weight, "diagonal", False) for weight in weights]): return False
+	if noise and not all([getattr(scan.noise, "white_diagonal", False) for scan in scans]): return False
+	return True
+
+def calc_map_stats(signal, scans, weights, cuts=None, noise=True):
+	"""Compute the div, hits and crosslink maps for signal in a single pass over
+	the pointing of each scan, without building any tods. This gives the same
+	result as calc_div_map, calc_hits_map and calc_crosslink_map, but only when
+	use_map_stats(signal, scans, weights, noise) is true. The weights are then
+	evaluated on a single [1,nsamp] profile and the white noise on a [ndet,1]
+	one. Returns div, hits, cmap."""
+	if not use_map_stats(signal, scans, weights, noise=noise):
+		raise ValueError("calc_map_stats requires diagonal weights and white noise. Use calc_div_map instead")
+	if cuts is None: cuts = [scan.cut for scan in scans]
+	div   = signal.zeros(mat=True)
+	hits  = signal.zeros()
+	cmap  = signal.zeros()
+	dwork = signal.prepare(div)
+	hwork = signal.prepare(hits)
+	cwork = signal.prepare(cmap)
+	for si, scan in enumerate(scans):
+		with bench.mark("stats_weight"):
+			dweight = np.ones([scan.ndet,1], signal.dtype)
+			if noise: scan.noise.white(dweight)
+			wsamp = None
+			if len(weights) > 0:
+				wsamp = np.ones([1, scan.nsamp], signal.dtype)
+				for weight in weights: weight(scan, wsamp)
+				for weight in weights[::-1]: weight(scan, wsamp)
+		with bench.mark("stats_" + signal.name):
+			signal.stats(scan, dwork, hwork, cwork, cuts[si], dweight=dweight[:,0], wsamp=wsamp)
+		times = [bench.stats[s]["time"].last for s in ["stats_weight", "stats_" + signal.name]]
+		L.debug("stats %s %6.3f %6.3f %s" % ((signal.name,)+tuple(times)+(scan.id,)))
+	with bench.mark("stats_reduce"):
+		signal.finish(div,  dwork)
+		signal.finish(hits, hwork)
+		signal.finish(cmap, cwork)
+	return div, hits[0].astype(np.int32), cmap
+
 def calc_crosslink_map(signal, scans, weights, cuts=None, noise=True):
+	"""Compute the crosslinking map for signal. When use_map_stats allows it,
+	this is the crosslink output of calc_map_stats, which doesn't need any tods."""
+	if use_map_stats(signal, scans, weights, noise=noise):
+		return calc_map_stats(signal, scans, weights, cuts=cuts, noise=noise)[2]
 	saved_comps = [scan.comps.copy() for scan in scans]
 	if cuts is None: cuts = [scan.cut for scan in scans]
 	for scan in scans: scan.comps[:] = np.array([1,1,0])
@@ -895,10 +996,16 @@ class PriorProjectOut:
 #     weighting. Moving all of these into the noise matrix would be very
 #     messy.
 
+# Filters with diagonal = True multiply each sample by a factor that only depends
+# on the sample index, not the detector or the tod values. When used as weights,
+# these allow the preconditioner to be built with calc_map_stats.
+
 class FilterNull:
+	diagonal = True
 	def __call__(self, scan, tod): pass
 
 class FilterScale:
+	diagonal = True
 	def __init__(self, scale): self.scale = scale
 	def __call__(self, scan, tod): tod *= self.scale
 
@@ -1153,6 +1260,7 @@ class FilterAddSrcs:
 
 class FilterWindow:
 	# Windowing filter tapers the start and end of the TOD
+	diagonal = True
 	def __init__(self, width):
 		self.width = width
 	def __call__(self, scan, tod):
@@ -1367,13 +1475,17 @@ class SourceHandler:
 		self.src_hits = []
 		self.src_maps = []
 		for si, signal in enumerate(self.signals):
-			div = signal.zeros(mat=True)
-			calc_div_map(div, signal, self.scans, weights=[], cuts=cutlist, noise=True)
-			if self.calc_hits:
-				# Build hitcount map too
-				hits = signal.zeros()
-				hits = calc_hits_map(hits, signal, self.scans, cuts=cutlist)
-			else: hits = None
+			if use_map_stats(signal, self.scans, weights=[], noise=True):
+				div, hits, _ = calc_map_stats(signal, self.scans, weights=[], cuts=cutlist, noise=True)
+				if not self.calc_hits: hits = None
+			else:
+				div = signal.zeros(mat=True)
+				calc_div_map(div, signal, self.scans, weights=[], cuts=cutlist, noise=True)
+				if self.calc_hits:
+					# Build hitcount map too
+					hits = signal.zeros()
+					hits = calc_hits_map(hits, signal, self.scans, cuts=cutlist)
+				else: hits = None
 			idiv = signal.polinv(div)
 			map  = signal.polmul(idiv, self.src_rhs[si])
 			self.src_divs.append(div)
@@ -1390,8 +1502,11 @@ class SourceHandler:
 
 ######## Equation system ########
 
+config.default("eqsys_pipeline", 0, "Number of scans to keep in flight in Eqsys.A and Eqsys.calc_b. 0 processes scans strictly one after another. A positive value overlaps the noise step of each scan with the pointing projection of the next ones using a pool of this many threads. The result is identical to the serial one, since the map accumulation still happens in scan order.")
+config.default("eqsys_tod_pool", 2.0, "Maximum number of GB of unused tod work arrays Eqsys keeps around for reuse.")
+
 class Eqsys:
-	def __init__(self, scans, signals, filters=[], filters2=[], weights=[], multiposts=[], dtype=np.float64, comm=None):
+	def __init__(self, scans, signals, filters=[], filters2=[], weights=[], multiposts=[], dtype=np.float64, comm=None, pipeline=None):
 		self.scans   = scans
 		self.signals = signals
 		self.dtype   = dtype
@@ -1400,6 +1515,13 @@ class Eqsys:
 		self.multiposts= multiposts
 		self.weights = weights
 		self.dof     = zipper.MultiZipper([signal.dof for signal in signals], comm=comm)
+		self.comm    = comm
+		self.pipeline= config.get("eqsys_pipeline", pipeline)
+		# Pool of tod work arrays, reused across scans and iterations
+		self.tods    = memory.BufferPool(maxfree=int(config.get("eqsys_tod_pool")*1024**3))
+		# Time spent on each scan in the last serial A, for scanutils.ScanCostModel.
+		# The pipelined loop doesn't update this, since its steps overlap in time.
+		self.scan_times = {}
 		self.b       = None
 	def A(self, x, debug_file=None):
 		"""Apply the A-matrix P'N"P to the zipped vector x, returning the result."""
@@ -1411,39 +1533,27 @@ class Eqsys:
 			iwork = [signal.filter(signal.prepare(map)) for signal, map in zip(self.signals, imaps)]
 			owork = [signal.work() for signal in self.signals]
 			#owork = [signal.prepare(map) for signal, map in zip(self.signals, omaps)]
-		for si, scan in enumerate(self.scans):
-			# Set up a TOD for this scan
-			tod = np.zeros([scan.ndet, scan.nsamp], self.dtype)
-			# Project each signal onto the TOD (P) in reverse order. This is done
-			# so that the cuts can override the other signals.
-			with bench.mark("A_P"):
-				for signal, work in list(zip(self.signals, iwork))[::-1]:
-					with bench.mark("A_Pr_" + signal.name):
-						signal.precompute(scan)
-					with bench.mark("A_P_" + signal.name):
-						signal.forward(scan, tod, work)
-			if debug_file is not None and si == 0:
-				print("Eqsys A dumping debug")
-				with h5py.File(debug_file,"w") as hfile:
-					hfile["tod"]  = tod[:16]
-					hfile["mask"] = scan.cut[:16].to_mask()
-					hfile["dets"] = scan.dets[:16]
-					hfile["id"]   = scan.id
-			# Apply the noise matrix (N")
-			with bench.mark("A_N"):
-				for weight in self.weights: weight(scan, tod)
-				scan.noise.apply(tod)
-				for weight in self.weights[::-1]: weight(scan, tod)
-			# Project the TOD onto each signal (P') in normal order. This is done
-			# to allow the cuts to zero out the relevant TOD samples first
-			with bench.mark("A_PT"):
-				for signal, work in zip(self.signals, owork):
-					with bench.mark("A_PT_" + signal.name):
-						signal.backward(scan, tod, work)
-					with bench.mark("A_Fr_" + signal.name):
-						signal.free()
-			times = [bench.stats[s]["time"].last for s in ["A_P","A_N","A_PT"]]
-			L.debug("A P %5.3f N %5.3f P' %5.3f %s %4d" % (tuple(times)+(scan.id,scan.ndet)))
+		if self.pipeline > 0 and debug_file is None:
+			self.A_pipelined(iwork, owork)
+		else:
+			for si, scan in enumerate(self.scans):
+				# Set up a TOD for this scan. It only needs to start at zero if
+				# the first signal we project doesn't overwrite it anyway.
+				overwrite = self.signals[-1].overwrites(scan)
+				tod = self.get_tod(scan, zero=not overwrite)
+				tP  = self.A_P(scan, tod, iwork, overwrite=overwrite)
+				if debug_file is not None and si == 0:
+					print("Eqsys A dumping debug")
+					with h5py.File(debug_file,"w") as hfile:
+						hfile["tod"]  = tod[:16]
+						hfile["mask"] = scan.cut[:16].to_mask()
+						hfile["dets"] = scan.dets[:16]
+						hfile["id"]   = scan.id
+				tN  = self.A_N(scan, tod)
+				tPT = self.A_PT(scan, tod, owork)
+				self.tods.put(tod)
+				self.scan_times[scan.id] = tP+tN+tPT
+				L.debug("A P %5.3f N %5.3f P' %5.3f %s %4d" % (tP, tN, tPT, scan.id, scan.ndet))
 		# Collect all the results, and flatten them
 		with bench.mark("A_reduce"):
 			for signal, map, work in zip(self.signals, omaps, owork):
@@ -1454,6 +1564,83 @@ class Eqsys:
 			for signal, imap, omap in zip(self.signals, imaps, omaps):
 				signal.prior(self.scans, imap, omap)
 		return self.dof.zip(omaps)
+	def A_P(self, scan, tod, iwork, states=None, overwrite=False):
+		"""Project each signal onto the TOD (P) in reverse order. This is done
+		so that the cuts can override the other signals. If states is a list,
+		the per-scan signal precomputation is moved into it, in signal order,
+		and released, instead of being kept in the signals for A_PT. If overwrite
+		is True, the first signal overwrites tod instead of adding to it. Returns
+		the time taken."""
+		if states is not None: states[:] = [None]*len(self.signals)
+		with bench.mark("A_P") as mark:
+			for i, (signal, work) in list(enumerate(zip(self.signals, iwork)))[::-1]:
+				with bench.mark("A_Pr_" + signal.name):
+					signal.precompute(scan)
+				with bench.mark("A_P_" + signal.name):
+					if overwrite and i == len(self.signals)-1: signal.forward(scan, tod, work, tmul=0)
+					else: signal.forward(scan, tod, work)
+				if states is not None:
+					with bench.mark("A_Fr_" + signal.name):
+						states[i] = signal.precomputed()
+						signal.free()
+		return mark.time
+	def A_N(self, scan, tod):
+		"""Apply the noise matrix (N") to tod in place. Returns the time taken."""
+		with bench.mark("A_N") as mark:
+			for weight in self.weights: weight(scan, tod)
+			scan.noise.apply(tod)
+			for weight in self.weights[::-1]: weight(scan, tod)
+		return mark.time
+	def A_PT(self, scan, tod, owork, states=None):
+		"""Project the TOD onto each signal (P') in normal order. This is done
+		to allow the cuts to zero out the relevant TOD samples first. If states
+		is given, the per-scan signal precomputation saved by A_P is restored
+		first, or redone for signals that couldn't save it. Returns the time
+		taken."""
+		with bench.mark("A_PT") as mark:
+			for i, (signal, work) in enumerate(zip(self.signals, owork)):
+				if states is not None:
+					with bench.mark("A_Pr_" + signal.name):
+						if states[i] is None: signal.precompute(scan)
+						else: signal.restore(states[i])
+				with bench.mark("A_PT_" + signal.name):
+					signal.backward(scan, tod, work)
+				with bench.mark("A_Fr_" + signal.name):
+					signal.free()
+		return mark.time
+	def A_pipelined(self, iwork, owork):
+		"""Pipelined version of the scan loop in A. The noise step for each scan
+		runs in a pool of self.pipeline threads while the main thread moves on
+		to projecting the next scans. The P' step is always performed by the
+		main thread in scan order, so the work maps are accumulated in exactly
+		the same order as in the serial loop.
+
+		Signals only hold the precomputed state of one scan at a time, so the
+		state of each scan in flight is saved after P and restored before P'.
+		This costs the memory of up to self.pipeline+1 scans' worth of state,
+		but precompute still only runs once per scan.
+
+		Since the steps of different scans overlap, the wall times of the
+		steps don't measure the cost of each scan, so self.scan_times is not
+		updated here."""
+		from concurrent.futures import ThreadPoolExecutor
+		pending = collections.deque()
+		def finish(scan, tod, states, tP, future):
+			tN  = future.result()
+			tPT = self.A_PT(scan, tod, owork, states=states)
+			self.tods.put(tod)
+			L.debug("A P %5.3f N %5.3f P' %5.3f %s %4d" % (tP, tN, tPT, scan.id, scan.ndet))
+		with ThreadPoolExecutor(self.pipeline) as pool:
+			for scan in self.scans:
+				overwrite = self.signals[-1].overwrites(scan)
+				tod = self.get_tod(scan, zero=not overwrite)
+				states = []
+				tP  = self.A_P(scan, tod, iwork, states=states, overwrite=overwrite)
+				pending.append((scan, tod, states, tP, pool.submit(self.A_N, scan, tod)))
+				if len(pending) > self.pipeline:
+					finish(*pending.popleft())
+			while len(pending) > 0:
+				finish(*pending.popleft())
 	def M(self, x):
 		"""Apply the preconditioner to the zipped vector x."""
 		with bench.mark("M"):
@@ -1468,87 +1655,15 @@ class Eqsys:
 		maps  = [signal.zeros() for signal in self.signals]
 		owork = [signal.work() for signal in self.signals]
 		#owork = [signal.prepare(map) for signal, map in zip(self.signals,maps)]
-		for scan in self.scans:
-			# Get the actual TOD samples (d)
-			if itod is None:
-				with bench.mark("b_read"):
-					#if config.get("debug_raw"):
-					#	from enact import actscan
-					#	if self.dof.comm.rank == 0: print("debug_raw", self.filters[:-1])
-					#	# Super-hacky. Read off input map at full resolution
-					#	adder = self.filters[0]
-					#	scan_full = actscan.ACTScan(scan.entry, d=scan.d)
-					#	scan_full = scan_full[utils.find(scan_full.dets, scan.dets)]
-					#	padd  = pmat.PmatMap(scan_full, adder.map, sys=adder.sys)
-					#	tod   = np.zeros([scan.d.ndet, scan.d.nsamp],self.dtype)
-					#	padd.forward(tod, adder.map, tmul=adder.tmul, mmul=adder.mul)
-					#	# Deslope, but remember the slope
-					#	slope = tod.copy(); tod = utils.deslope(tod); slope -= tod
-					#	from enact import filters
-					#	# Apply the time constant, MCE filter and gain to go to raw units
-					#	ft     = fft.rfft(tod)
-					#	freqs  = np.linspace(0, scan_full.srate/2, ft.shape[-1])
-					#	butter = filters.mce_filter(freqs, scan_full.d.mce_fsamp, scan_full.d.mce_params)
-					#	ft *= butter
-					#	for di in range(len(ft)):
-					#		ft[di] *= filters.tconst_filter(freqs, scan_full.d.tau[di])
-					#	fft.irfft(ft, tod, normalize=True)
-					#	# Add back the slope
-					#	tod += slope
-					#	del slope
-					#	# And unapply the gain
-					#	tod /= (scan_full.d.gain[:,None]*8)
-					#	tod  = (tod*128).astype(np.int32)
-					#	tod  = scan.get_samples(verbose=False, debug_inject=tod)
-					#else:
-					tod  = scan.get_samples(verbose=False)
-					#tod -= np.copy(tod[:,0,None])
-					tod  = tod.astype(self.dtype)
-			else: tod = itod
-			#FIXME
-			tod = utils.deslope(tod)
-			#dump("dump_getsamples.hdf", tod)
-			#dump("dump_prefilter_mean.hdf", np.mean(tod,0))
-			#dump("dump_prefilter.hdf", tod[:4])
-			#dump("hwp.hdf", scan.hwp)
-			#1/0
-			# Apply all filters (pickup filter, src subtraction, etc)
-			if not config.get("debug_raw"):
-				with bench.mark("b_filter"):
-					for filter in self.filters: filter(scan, tod)
-			#dump("dump_postfilter.hdf", tod)
-			#dump("dump_postfilter_mean.hdf", np.mean(tod,0))
-			#dump("dump_postfilter.hdf", tod[:4])
-			#1/0
-			# Apply the noise model (N")
-			with bench.mark("b_weight"):
-				for weight in self.weights: weight(scan, tod)
-			#dump("dump_postweight.hdf", tod)
-			#dump("dump_prenoise.hdf", tod[:32])
-			with bench.mark("b_N_build"):
-				scan.noise = scan.noise.update(tod, scan.srate)
-				#print "FIXME gapfill const after building noise model", scan.id, scan.cut.ndet, scan.cut.nsamp, tod.shape
-				#sampcut.gapfill_const(scan.cut, tod, 0.0, True)
-			#dump("dump_postupdate.hdf", tod)
-			with bench.mark("b_filter2"):
-				for filter in self.filters2: filter(scan, tod)
-			#dump("dump_prenoise.hdf", tod)
-			with bench.mark("b_N"):
-				scan.noise.apply(tod)
-			#dump("dump_postnoise.hdf", tod)
-			#1/0
-			with bench.mark("b_weight"):
-				for weight in self.weights[::-1]: weight(scan, tod)
-			# Project onto signals
-			with bench.mark("b_PT"):
-				for signal, work in zip(self.signals, owork):
-					with bench.mark("b_PT_" + signal.name):
-						signal.precompute(scan)
-						signal.backward(scan, tod, work)
-						signal.free()
-			del tod
-			times = [bench.stats[s]["time"].last for s in ["b_read","b_filter","b_N_build", "b_N", "b_PT"]]
-			L.debug("b get %5.1f f %5.1f NB %5.3f N %5.3f P' %5.3f %s" % (tuple(times)+(scan.id,)))
+		if self.pipeline > 0 and itod is None:
+			self.b_pipelined(owork)
+		else:
+			for scan in self.scans:
+				tod, times = self.b_read(scan, itod)
+				times += self.b_PT(scan, tod, owork)
+				self.tods.put(tod)
+				del tod
+				L.debug("b get %5.1f f %5.1f NB %5.3f N %5.3f P' %5.3f %s" % (tuple(times)+(scan.id,)))
 		# Collect results
 		with bench.mark("b_reduce"):
 			for signal, map, work in zip(self.signals, maps, owork):
@@ -1556,9 +1671,163 @@ class Eqsys:
 				signal.finish(map, work)
 		with bench.mark("b_zip"):
 			self.b = self.dof.zip(maps)
+	def b_read(self, scan, itod=None):
+		"""Read, filter and weight the TOD for scan, and build its noise model.
+		Returns the tod and the [read,filter,noise build] times."""
+		# Get the actual TOD samples (d)
+		tread = 0
+		if itod is None:
+			with bench.mark("b_read") as mark:
+				#if config.get("debug_raw"):
+				#	from enact import actscan
+				#	if self.dof.comm.rank == 0: print("debug_raw", self.filters[:-1])
+				#	# Super-hacky. Read off input map at full resolution
+				#	adder = self.filters[0]
+				#	scan_full = actscan.ACTScan(scan.entry, d=scan.d)
+				#	scan_full = scan_full[utils.find(scan_full.dets, scan.dets)]
+				#	padd  = pmat.PmatMap(scan_full, adder.map, sys=adder.sys)
+				#	tod   = np.zeros([scan.d.ndet, scan.d.nsamp],self.dtype)
+				#	padd.forward(tod, adder.map, tmul=adder.tmul, mmul=adder.mul)
+				#	# Deslope, but remember the slope
+				#	slope = tod.copy(); tod = utils.deslope(tod); slope -= tod
+				#	from enact import filters
+				#	# Apply the time constant, MCE filter and gain to go to raw units
+				#	ft     = fft.rfft(tod)
+				#	freqs  = np.linspace(0, scan_full.srate/2, ft.shape[-1])
+				#	butter = filters.mce_filter(freqs, scan_full.d.mce_fsamp, scan_full.d.mce_params)
+				#	ft *= butter
+				#	for di in range(len(ft)):
+				#		ft[di] *= filters.tconst_filter(freqs, scan_full.d.tau[di])
+				#	fft.irfft(ft, tod, normalize=True)
+				#	# Add back the slope
+				#	tod += slope
+				#	del slope
+				#	# And unapply the gain
+				#	tod /= (scan_full.d.gain[:,None]*8)
+				#	tod  = (tod*128).astype(np.int32)
+				#	tod  = scan.get_samples(verbose=False, debug_inject=tod)
+				#else:
+				samps= scan.get_samples(verbose=False)
+				#tod -= np.copy(tod[:,0,None])
+				tod  = self.get_tod(scan, zero=False)
+				tod[:] = samps
+				del samps
+			tread = mark.time
+			#FIXME
+			utils.deslope(tod, inplace=True)
+		else:
+			#FIXME
+			tod = utils.deslope(itod)
+		#dump("dump_getsamples.hdf", tod)
+		#dump("dump_prefilter_mean.hdf", np.mean(tod,0))
+		#dump("dump_prefilter.hdf", tod[:4])
+		#dump("hwp.hdf", scan.hwp)
+		#1/0
+		# Apply all filters (pickup filter, src subtraction, etc)
+		tfilter = 0
+		if not config.get("debug_raw"):
+			with bench.mark("b_filter") as mark:
+				for filter in self.filters: filter(scan, tod)
+			tfilter = mark.time
+		#dump("dump_postfilter.hdf", tod)
+		#dump("dump_postfilter_mean.hdf", np.mean(tod,0))
+		#dump("dump_postfilter.hdf", tod[:4])
+		#1/0
+		# Apply the noise model (N")
+		with bench.mark("b_weight"):
+			for weight in self.weights: weight(scan, tod)
+		#dump("dump_postweight.hdf", tod)
+		#dump("dump_prenoise.hdf", tod[:32])
+		with bench.mark("b_N_build") as mark_NB:
+			scan.noise = scan.noise.update(tod, scan.srate)
+			#print "FIXME gapfill const after building noise model", scan.id, scan.cut.ndet, scan.cut.nsamp, tod.shape
+			#sampcut.gapfill_const(scan.cut, tod, 0.0, True)
+		return tod, [tread, tfilter, mark_NB.time]
+	def b_PT(self, scan, tod, owork):
+		"""Apply the second round of filters and the noise model to the output
+		of b_read, and project the result onto the signals. Returns the
+		[noise,projection] times."""
+		#dump("dump_postupdate.hdf", tod)
+		with bench.mark("b_filter2"):
+			for filter in self.filters2: filter(scan, tod)
+		#dump("dump_prenoise.hdf", tod)
+		with bench.mark("b_N") as mark_N:
+			scan.noise.apply(tod)
+		#dump("dump_postnoise.hdf", tod)
+		#1/0
+		with bench.mark("b_weight"):
+			for weight in self.weights[::-1]: weight(scan, tod)
+		# Project onto signals
+		with bench.mark("b_PT") as mark_PT:
+			for signal, work in zip(self.signals, owork):
+				with bench.mark("b_PT_" + signal.name):
+					signal.precompute(scan)
+					signal.backward(scan, tod, work)
+					signal.free()
+		return [mark_N.time, mark_PT.time]
+	def b_pipelined(self, owork):
+		"""Pipelined version of the scan loop in calc_b. The reading, filtering
+		and noise model building of the next self.pipeline scans happen in a
+		background thread while the main thread finishes the current one.
+		filters2 and the projection stay in the main thread, since they may
+		use the signals' per-scan state. Scans are read and projected in order,
+		so the result is the same as for the serial loop."""
+		from concurrent.futures import ThreadPoolExecutor
+		pending = collections.deque()
+		def finish(scan, future):
+			tod, times = future.result()
+			times += self.b_PT(scan, tod, owork)
+			self.tods.put(tod)
+			del tod
+			L.debug("b get %5.1f f %5.1f NB %5.3f N %5.3f P' %5.3f %s" % (tuple(times)+(scan.id,)))
+		# A single reader thread makes sure the filters see the scans in order
+		with ThreadPoolExecutor(1) as pool:
+			for scan in self.scans:
+				pending.append((scan, pool.submit(self.b_read, scan)))
+				if len(pending) > self.pipeline:
+					finish(*pending.popleft())
+			while len(pending) > 0:
+				finish(*pending.popleft())
+	def get_tod(self, scan, zero=True):
+		"""Get a [ndet,nsamp] work array for scan from our tod pool. Its contents
+		are undefined unless zero is True. Hand it back with self.tods.put when done.
+		The tod_alloc and tod_reuse bench categories record the cost of fresh and
+		recycled arrays respectively."""
+		shape = (scan.ndet, scan.nsamp)
+		name  = "tod_reuse" if self.tods.available(shape, self.dtype) else "tod_alloc"
+		with bench.mark(name):
+			return self.tods.get(shape, self.dtype, zero=zero)
 	def dot(self, a, b):
 		with bench.mark("dot"):
 			return self.dof.dot(a,b)
+	def dot_many(self, pairs):
+		with bench.mark("dot"):
+			return self.dof.dot_many(pairs)
+	def dof_layout(self):
+		"""Describes the local degrees of freedom as a [nsignal,{n,shared}]
+		array. Used to check that a checkpoint matches this equation system."""
+		return np.array([[z.n, z.shared] for z in self.dof.zippers], dtype=int)
+	def checkpoint(self, prefix, background=True):
+		"""Returns a Checkpoint for this equation system, with one shard per mpi task."""
+		comm = self.comm if self.comm is not None else mpi.COMM_WORLD
+		return Checkpoint(prefix, comm=comm, layout=self.dof_layout(), background=background)
+	def save_checkpoint(self, ckpt, solver):
+		"""Save the state of the solver, along with our right hand side b, to
+		the Checkpoint ckpt. This returns as soon as the state has been copied."""
+		with bench.mark("checkpoint"):
+			state = solver.get_state()
+			state["b"] = self.b
+			ckpt.save(state)
+	def load_checkpoint(self, ckpt, solver=None):
+		"""Restore b, and optionally the state of the solver, from the Checkpoint
+		ckpt. This makes calc_b unnecessary. Returns the loaded state."""
+		state = ckpt.load()
+		b = state.pop("b")
+		if len(b) != self.dof.n:
+			raise IOError("Checkpoint has %d degrees of freedom, but we have %d" % (len(b), self.dof.n))
+		self.b = b.astype(self.dtype, copy=False)
+		if solver is not None: solver.set_state(state)
+		return state
 	def postprocess(self, x):
 		maps = self.dof.unzip(x)
 		for multipost in self.multiposts:
@@ -1599,3 +1868,78 @@ class Eqsys:
 def write_precons(signals, prefix):
 	for signal in signals:
 		signal.precon.write(prefix)
+
+def sim_eqsys_test(nscan=3, ndet=10, nsamp=4000, pipeline=None, sigtype=None, seed=0):
+	"""Build a small Eqsys with a cut signal and a map signal on simulated
+	scans, for the tests below."""
+	from . import scansim
+	scans, area = scansim.sim_test_scans(nscan, ndet=ndet, nsamp=nsamp, seed=seed)
+	sigtype = sigtype or SignalMap
+	signal= sigtype(scans, area, mpi.COMM_WORLD, pmat_order=0, sys="equ")
+	cut   = SignalCut(scans, area.dtype, mpi.COMM_WORLD)
+	return Eqsys(scans, [cut, signal], pipeline=pipeline)
+
+def eqsys_tod_test():
+	"""Check that Eqsys recycles its tod work arrays between scans."""
+	eqsys = sim_eqsys_test(pipeline=0)
+	scan  = eqsys.scans[0]
+	tod   = eqsys.get_tod(scan)
+	assert tod.shape == (scan.ndet, scan.nsamp) and np.all(tod == 0)
+	tod[:] = 1
+	eqsys.tods.put(tod)
+	assert eqsys.tods.available(tod.shape, eqsys.dtype)
+	size  = eqsys.tods.size
+	tod2  = eqsys.get_tod(eqsys.scans[1])
+	assert np.all(tod2 == 0) and eqsys.tods.size == size
+	eqsys.tods.put(tod2)
+	# A full A application doesn't need more than one array at a time
+	x = np.random.RandomState(1).standard_normal(eqsys.dof.n)
+	eqsys.A(x)
+	assert eqsys.tods.max == size
+
+def eqsys_pipeline_test():
+	"""Check that the pipelined scan loop in Eqsys.A gives the same result as
+	the serial one, and only precomputes each scan once."""
+	ncall = [0]
+	class SignalMapPre(SignalMap):
+		"""SignalMap that precomputes the pointing of one scan at a time,
+		like SignalMapFast."""
+		def precompute(self, scan):
+			ncall[0] += 1
+			self.point = pmat.CachedPointing.build(self.data[scan])
+		def free(self): del self.point
+		def precomputed(self): return self.point
+		def restore(self, state): self.point = state
+		def get_point(self, mat): return self.point
+	eqsys = sim_eqsys_test(pipeline=0, sigtype=SignalMapPre)
+	x     = np.random.RandomState(1).standard_normal(eqsys.dof.n)
+	ref   = eqsys.A(x)
+	times = dict(eqsys.scan_times)
+	assert sorted(times.keys()) == sorted([scan.id for scan in eqsys.scans])
+	for pipeline in [1,2]:
+		ncall[0] = 0
+		eqsys.pipeline = pipeline
+		res = eqsys.A(x)
+		assert np.allclose(res, ref, rtol=0, atol=1e-12*np.max(np.abs(ref)))
+		assert ncall[0] == len(eqsys.scans)
+	# Only the serial loop measures the cost of each scan
+	assert eqsys.scan_times == times
+
+def map_stats_test():
+	"""Check that calc_map_stats gives the same div, hits and crosslink maps as
+	calc_div_map, calc_hits_map and the tod-based calc_crosslink_map."""
+	eqsys  = sim_eqsys_test(pipeline=0)
+	signal, scans = eqsys.signals[1], eqsys.scans
+	for weights in [[], [FilterWindow(2)]]:
+		for noise in [True, False]:
+			assert use_map_stats(signal, scans, weights, noise=noise)
+			div, hits, cmap = calc_map_stats(signal, scans, weights, noise=noise)
+			ref = signal.zeros(mat=True)
+			calc_div_map(ref, signal, scans, weights, noise=noise)
+			assert np.allclose(div, ref, rtol=0, atol=1e-12*np.max(np.abs(ref)))
+			assert np.array_equal(hits, calc_hits_map(signal.zeros(), signal, scans))
+			# Force the tod-based crosslink calculation
+			signal.supports_stats = lambda: False
+			try: ref = calc_crosslink_map(signal, scans, weights, noise=noise)
+			finally: del signal.supports_stats
+			assert np.allclose(cmap, ref, rtol=0, atol=1e-12*np.max(np.abs(ref)))
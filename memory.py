@@ -1 +1,127 @@
 from pixell.memory import *
+import numpy as np, threading, weakref
+
+# All live buffer pools, so that their memory use can be reported
+pools = weakref.WeakSet()
+
+class BufferPool:
+	"""A pool of reusable work arrays. Instead of allocating a new array for
+	each piece of work (and paying for page faults and zeroing every time), ask
+	the pool for one with get(shape, dtype) and hand it back with put(arr) when
+	done. A request is served by the smallest unused buffer that is big enough.
+	New buffer sizes are rounded up to nsub buckets per factor of two, so arrays
+	of similar but not identical shape can share buffers. At most maxfree bytes
+	of unused buffers are kept. Beyond that the least recently returned ones are
+	released. The pool is thread-safe.
+
+	pool.size is the number of bytes currently allocated by the pool, whether
+	in use or not, and pool.max is its high-water mark."""
+	def __init__(self, nsub=4, minsize=4096, maxfree=2*1024**3):
+		self.nsub, self.minsize, self.maxfree = nsub, minsize, maxfree
+		self.free  = [] # unused buffers, least recently returned first
+		self.nfree = 0  # bytes in self.free
+		self.used  = {} # id(buffer) -> buffer handed out by get
+		self.size  = 0
+		self.max   = 0
+		self.lock  = threading.Lock()
+		pools.add(self)
+	def bucket(self, nbytes):
+		"""Returns the buffer size allocated for arrays of nbytes bytes."""
+		if nbytes <= self.minsize: return self.minsize
+		size = int(np.ceil(2**(np.ceil(np.log2(nbytes)*self.nsub)/self.nsub)))
+		return size if size > nbytes else nbytes
+	def find(self, nbytes):
+		"""Returns the index of the smallest free buffer with at least nbytes
+		bytes, or None if there isn't any. Must be called with the lock held."""
+		best = None
+		for i, buf in enumerate(self.free):
+			if buf.size >= nbytes and (best is None or buf.size < self.free[best].size):
+				best = i
+		return best
+	def available(self, shape, dtype):
+		"""Returns whether get(shape, dtype) can be served without allocating."""
+		with self.lock:
+			return self.find(calc_nbytes(shape, dtype)) is not None
+	def get(self, shape, dtype, zero=True):
+		"""Returns an array with the given shape and dtype backed by a pooled
+		buffer. Its contents are undefined unless zero is True."""
+		nbytes = calc_nbytes(shape, dtype)
+		with self.lock:
+			i   = self.find(nbytes)
+			buf = self.free.pop(i) if i is not None else None
+			if buf is not None: self.nfree -= buf.size
+		if buf is None:
+			buf = np.empty(self.bucket(nbytes), np.uint8)
+			with self.lock:
+				self.size += buf.size
+				if self.size > self.max: self.max = self.size
+		arr = buf[:nbytes].view(dtype).reshape(shape)
+		if zero: arr[...] = 0
+		with self.lock:
+			self.used[id(buf)] = buf
+		return arr
+	def put(self, arr):
+		"""Return an array obtained from get to the pool. arr must not be used
+		after this. Arrays that did not come from this pool are ignored."""
+		buf = get_base(arr)
+		with self.lock:
+			if self.used.pop(id(buf), None) is None: return
+			self.free.append(buf)
+			self.nfree += buf.size
+			self.trim(self.maxfree)
+	def trim(self, maxfree):
+		"""Release the least recently returned unused buffers until at most
+		maxfree bytes of them remain. Must be called with the lock held."""
+		while len(self.free) > 0 and self.nfree > maxfree:
+			buf = self.free.pop(0)
+			self.nfree -= buf.size
+			self.size  -= buf.size
+	def clear(self):
+		"""Release all buffers that are not currently in use."""
+		with self.lock:
+			self.trim(0)
+
+def get_base(arr):
+	"""Returns the array that ultimately owns the memory of arr."""
+	while arr.base is not None: arr = arr.base
+	return arr
+
+def calc_nbytes(shape, dtype):
+	return int(np.prod(shape))*np.dtype(dtype).itemsize
+
+def pool_size():
+	"""Returns the total number of bytes currently allocated by all buffer pools."""
+	return sum([pool.size for pool in list(pools)])
+
+def pool_max():
+	"""Returns the sum of the high-water marks of all buffer pools, in bytes."""
+	return sum([pool.max for pool in list(pools)])
+
+def bufferpool_test():
+	"""Check that BufferPool reuses the smallest big enough buffer, and keeps
+	at most maxfree bytes of unused buffers."""
+	pool = BufferPool(maxfree=3*8*1000)
+	a = pool.get((4,100), np.float64)
+	assert a.shape == (4,100) and np.all(a == 0)
+	assert pool.size >= a.nbytes and pool.max == pool.size
+	pool.put(a)
+	# A smaller request reuses the free buffer
+	assert pool.available((2,100), np.float32)
+	b = pool.get((2,100), np.float32)
+	assert pool.size == pool.max and len(pool.free) == 0
+	# A bigger one can't, and gets a new buffer
+	c = pool.get((10,100), np.float64)
+	pool.put(b); pool.put(c)
+	assert len(pool.free) == 2
+	# The smallest sufficient buffer is used
+	d = pool.get((3,100), np.float64)
+	assert get_base(d).size < get_base(c).size
+	pool.put(d)
+	# Returning more than maxfree releases the least recently returned buffers
+	e = pool.get((20,100), np.float64)
+	pool.put(e)
+	assert pool.nfree <= pool.maxfree and pool.size == pool.nfree
+	# Arrays from elsewhere are ignored
+	pool.put(np.zeros(10))
+	pool.clear()
+	assert pool.size == 0 and pool.nfree == 0
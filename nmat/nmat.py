@@ -3,7 +3,7 @@ Individual experiments can inherit from this - other functions
 in enlib will work as long as this interface is followed.
 For performance and memory reasons, the noise matrix
 overwrites its input array."""
-import numpy as np, copy, h5py
+import numpy as np, copy, h5py, collections, threading
 from scipy.optimize import minimize
 from .. import utils, array_ops, fft
 from  . import nmat_core_32, nmat_core_64
@@ -18,6 +18,9 @@ def get_core(dtype):
 		return nmat_core_64.nmat_core
 
 class NoiseMatrix:
+	# Whether white() just multiplies each detector by a constant, so that
+	# it can be evaluated on a [ndet,1] tod.
+	white_diagonal = False
 	def __init__(self, ndet=1): self.ndet = ndet
 	def apply(self, tod):
 		"""Apply the full inverse noise matrix to tod. tod is overwritten,
@@ -61,6 +64,7 @@ class NoiseMatrix:
 		return res, detslice, sampslice
 
 class NmatNull(NoiseMatrix):
+	white_diagonal = True
 	def __init__(self, dets=None):
 		self.dets = dets
 	def apply(self, tod):
@@ -78,6 +82,7 @@ class NmatBinned(NoiseMatrix):
 	"""TOD noise matrices where power is assumed to be constant
 	in a set of bins in frequency. Stores a covariance matrix for
 	each such bin."""
+	white_diagonal = True
 	def __init__(self, icovs, bins, dets=None):
 		"""Construct an NmatBinned given a list of detectors dets[ndet],
 		a list of bins[nbin,{from,to}] in frequency, where bins[-1,-1]
@@ -597,6 +602,123 @@ def apply_window(tod, width, inverse=False):
 	core = get_core(tod.dtype)
 	core.apply_window(tod.T, -width if inverse else width)
 
+def apply_many(nmats, tods):
+	"""Apply each noise matrix in nmats to the corresponding tod in tods,
+	overwriting them. Equivalent to calling nmat.apply(tod) for each pair,
+	but NmatDetvecs-type noise matrices acting on tods with the same length
+	and dtype are stacked along the detector axis and handled together: one
+	forward and one backward fft using cached plans from plan_cache, and a
+	single threaded call that applies the binned woodbury product for all
+	of them. Other noise matrices fall back on their own apply. Returns tods."""
+	groups = collections.OrderedDict()
+	for i, (nmat, tod) in enumerate(zip(nmats, tods)):
+		if isinstance(nmat, NmatDetvecs) and tod.ndim == 2 and tod.size > 0:
+			groups.setdefault((tod.shape[1], tod.dtype), []).append(i)
+		else:
+			nmat.apply(tod)
+	for (nsamp, dtype), inds in groups.items():
+		doffs = utils.cumsum([len(tods[i]) for i in inds], endpoint=True)
+		plan  = plan_cache.get((doffs[-1], nsamp), dtype)
+		try:
+			for i, d1, d2 in zip(inds, doffs[:-1], doffs[1:]):
+				plan.tod[d1:d2] = tods[i]
+			plan.forward()
+			apply_ft_many([nmats[i] for i in inds], plan.ft, doffs, nsamp, dtype)
+			plan.backward()
+			for i, d1, d2 in zip(inds, doffs[:-1], doffs[1:]):
+				tods[i][:] = plan.tod[d1:d2]
+		finally:
+			plan_cache.put(plan)
+	return tods
+
+def apply_ft_many(nmats, ft, doffs, nsamp, dtype, inverse=False):
+	"""Apply the list of NmatDetvecs nmats to the stacked fourier-space
+	tod ft[ndet_tot,nfreq], where nmats[i] covers detectors doffs[i]:doffs[i+1].
+	All the bins of all the noise matrices are processed in parallel."""
+	fft_norm = nsamp
+	bins, ebins, iNu, V, E = [], [], [], [], []
+	for nmat in nmats:
+		if not inverse: D_, V_, E_ = nmat.iD, nmat.iV, nmat.iE
+		else:           D_, V_, E_ = nmat.D,  nmat.V,  nmat.E
+		bins.append(get_ibins(nmat.bins, nsamp))
+		ebins.append(nmat.ebins)
+		iNu.append(D_.reshape(-1)/fft_norm)
+		V.append(V_.reshape(-1))
+		E.append(E_/fft_norm)
+	def offs(arrs): return utils.cumsum([len(a) for a in arrs], endpoint=True).astype(np.int32)
+	rtype = np.zeros(1,dtype).real.dtype
+	get_core(dtype).nmat_detvecs_many(ft.T, np.asarray(doffs, np.int32),
+		np.concatenate(bins).astype(np.int32).T, np.concatenate(ebins).astype(np.int32).T, offs(bins),
+		np.concatenate(iNu).astype(rtype), offs(iNu), np.concatenate(V).astype(rtype), offs(V),
+		np.concatenate(E).astype(rtype), offs(E))
+
+class FFTPlan:
+	"""A pair of forward and backward real fft plans along the last axis
+	of a tod with the given shape and dtype. The plans own their work arrays,
+	so use them by filling self.tod, calling forward(), and so on."""
+	def __init__(self, shape, dtype, flags=None, nthread=0):
+		self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+		self.tod = fft.empty(self.shape, self.dtype)
+		self.ft  = fft.empty(fft.rfft_shape(self.shape), np.result_type(self.dtype,0j))
+		self.engine = fft.get_engine("auto")
+		if self.engine == "intel": return
+		nthread = nthread or fft.nthread_fft
+		FFTW = fft.engines[self.engine].FFTW
+		# Planning may overwrite the work arrays, which is fine since they have
+		# no content yet.
+		self.fplan = FFTW(self.tod, self.ft, flags=flags, threads=nthread, axes=(-1,), direction="FFTW_FORWARD")
+		self.bplan = FFTW(self.ft, self.tod, flags=flags, threads=nthread, axes=(-1,), direction="FFTW_BACKWARD")
+	def forward(self):
+		if self.engine == "intel": fft.rfft(self.tod, self.ft)
+		else: self.fplan()
+		return self.ft
+	def backward(self):
+		"""Unnormalized inverse transform of self.ft into self.tod. self.ft is destroyed."""
+		if self.engine == "intel": fft.irfft(self.ft, self.tod, flags=['FFTW_ESTIMATE','FFTW_DESTROY_INPUT'])
+		else: self.bplan(normalise_idft=False)
+		return self.tod
+	@property
+	def nbytes(self): return self.tod.nbytes + self.ft.nbytes
+
+class FFTPlanCache:
+	"""Keeps FFTPlans around keyed on (shape, dtype), so that repeated
+	transforms of the same shape don't need to be planned again. This
+	makes it affordable to use more expensive planning flags. A plan
+	is checked out with get and must be returned with put when done,
+	so that several threads never share the same work arrays. At most
+	nmax idle plans are kept, least recently used ones are discarded first."""
+	def __init__(self, nmax=16, flags=["FFTW_MEASURE"]):
+		self.nmax  = nmax
+		self.flags = flags
+		self.plans = collections.OrderedDict()
+		self.lock  = threading.Lock()
+	def get(self, shape, dtype):
+		key = (tuple(shape), np.dtype(dtype))
+		with self.lock:
+			if key in self.plans and len(self.plans[key]) > 0:
+				plan = self.plans[key].pop()
+				if len(self.plans[key]) == 0: del self.plans[key]
+				return plan
+		return FFTPlan(shape, dtype, flags=self.flags)
+	def put(self, plan):
+		key = (plan.shape, plan.dtype)
+		with self.lock:
+			self.plans.setdefault(key, []).append(plan)
+			self.plans[key] = self.plans.pop(key)
+			while self.size > self.nmax:
+				okey  = next(iter(self.plans))
+				plans = self.plans[okey]
+				plans.pop(0)
+				if len(plans) == 0: del self.plans[okey]
+	@property
+	def size(self): return sum([len(plans) for plans in self.plans.values()])
+	@property
+	def nbytes(self): return sum([plan.nbytes for plans in self.plans.values() for plan in plans])
+	def clear(self):
+		with self.lock: self.plans.clear()
+
+plan_cache = FFTPlanCache()
+
 def get_ibins(bins, n):
 	nf = n//2+1
 	ibins = (bins*nf/bins[-1,-1]).astype(np.int32)
@@ -608,3 +730,23 @@ def get_ifreqs(freqs, n):
 	res = (freqs*nf/freqs[-1]).astype(np.int32)
 	res[-1] = nf
 	return res
+
+def apply_many_test():
+	"""Check that apply_many gives the same result as applying each noise
+	matrix separately, for a mix of tod lengths and noise matrix types."""
+	from .. import scansim
+	rng   = np.random.RandomState(1)
+	nmats = [scansim.oneoverf_detcorr_noise(6, 1000, 1.0), scansim.oneoverf_noise(4, 1000, 2.0),
+		scansim.oneoverf_detcorr_noise(5, 800, 1.0), NmatNull()]
+	for dtype in [np.float64, np.float32]:
+		tods  = [rng.standard_normal((n,nsamp)).astype(dtype) for n, nsamp in [(6,1000),(4,1000),(5,800),(3,1000)]]
+		ref   = [nmat.apply(tod.copy()) for nmat, tod in zip(nmats, tods)]
+		res   = apply_many(nmats, [tod.copy() for tod in tods])
+		tol   = 1e-10 if dtype == np.float64 else 1e-4
+		for r, t in zip(ref, res):
+			assert np.max(np.abs(r-t)) <= tol*np.max(np.abs(r))
+	# Plans are reused rather than rebuilt
+	plan = plan_cache.get((11,1000), np.float64)
+	plan_cache.put(plan)
+	assert plan_cache.get((11,1000), np.float64) is plan
+	plan_cache.put(plan)
@@ -7,7 +7,7 @@ The reason for allowing the other argument to be modified is to make it easier
 to incrementally project different parts of the signal.
 """
 from __future__ import division, print_function
-import numpy as np, time, sys
+import numpy as np, time, sys, os, tempfile, collections, multiprocessing, hashlib, zlib, h5py
 from .. import enmap, interpol, utils, coordinates, config, errors, array_ops
 from .. import parallax, bunch, pointsrcs
 from .  import pmat_core_32
@@ -25,7 +25,12 @@ config.default("pmat_accuracy",     1.0, "Factor by which to lower accuracy requ
 config.default("pmat_interpol_max_size", 1000000, "Maximum mesh size in pointing interpolation. Worst-case time and memory scale at most proportionally with this.")
 config.default("pmat_interpol_max_time", 50, "Maximum time to spend in pointing interpolation constructor. Actual time spent may be up to twice this.")
 config.default("pmat_interpol_pad", 5.0, "Number of arcminutes to pad the interpolation coordinate system by")
+config.default("pmat_interpol_cache_dir", "", "Directory to cache pointing interpolators in, so that they can be reused by later runs and other tasks. Empty to only cache them in memory.")
+config.default("pmat_interpol_cache_mem", 1.0, "Max memory in GB to spend on caching pointing interpolators in memory.")
+config.default("pmat_dets_tol", 0.01, "Max position error in arcseconds of the batched detector pointing used to build pointing interpolators. Each detector is transformed separately if this is exceeded. 0 always transforms each detector separately.")
 config.default("tod_window",        5.0, "Seconds by which to window each end of the TOD.")
+config.default("pmat_accum",     "auto", "How the map pointing matrix accumulates tod2map projections when running with several threads. 'atomic': atomic updates of a shared work map. 'private': one copy of the work map per thread, summed at the end. 'stripe': each thread owns a stripe of rows of the work map. Only for nearest neighbor projection. 'auto': private if the copies fit in pmat_accum_mem, otherwise stripe if possible, otherwise atomic.")
+config.default("pmat_accum_mem",  1.0, "Max memory in GB to spend on thread-private work maps when pmat_accum is 'auto'.")
 
 class PointingMatrix:
 	def forward(self, tod, m): raise NotImplementedError
@@ -33,7 +38,7 @@ class PointingMatrix:
 
 class PmatMap(PointingMatrix):
 	"""Fortran-accelerated scan <-> enmap pointing matrix implementation."""
-	def __init__(self, scan, template, sys=None, order=None, extra=[]):
+	def __init__(self, scan, template, sys=None, order=None, extra=[], accum=None):
 		sys        = config.get("map_sys", sys)
 		transform  = pos2pix(scan,template,sys, extra=extra)
 		ipol, obox, err = build_interpol(transform, scan.box, id=scan.id)
@@ -45,24 +50,149 @@ class PmatMap(PointingMatrix):
 		self.scan,   self.dtype = scan, template.dtype
 		self.core  = get_core(self.dtype)
 		self.order = config.get("pmat_map_order", order)
+		self.accum = get_accum_method(accum, self.pixbox, self.order, self.dtype)
 		self.err   = err
-	def forward(self, tod, m, tmul=1, mmul=1, times=None):
-		"""m -> tod"""
+	def forward(self, tod, m, tmul=1, mmul=1, times=None, point=None):
+		"""m -> tod. If point is specified, it must be the CachedPointing for
+		this pmat, and will be used instead of recomputing the pointing."""
 		if times is None: times = np.zeros(5)
-		self.core.pmat_map_direct_grid(1, tod.T, tmul, m.T, mmul, 1, self.order, self.scan.boresight.T,
-				self.scan.hwp_phase.T, self.scan.offsets.T, self.scan.comps.T,
-				self.rbox.T, self.nbox, self.yvals.T, self.pixbox.T, self.nphi, times)
-	def backward(self, tod, m, tmul=1, mmul=1, times=None):
-		"""tod -> m"""
+		if point is not None:
+			self.core.pmat_map_use_pix_grid(1, tod.T, tmul, m.T, mmul, point.pix.T, point.phase.T,
+					point.scale, self.scan.comps.T, self.pixbox.T, self.nphi, times)
+		else:
+			self.core.pmat_map_direct_grid(1, tod.T, tmul, m.T, mmul, 1, self.order, self.accum, self.scan.boresight.T,
+					self.scan.hwp_phase.T, self.scan.offsets.T, self.scan.comps.T,
+					self.rbox.T, self.nbox, self.yvals.T, self.pixbox.T, self.nphi, times)
+	def backward(self, tod, m, tmul=1, mmul=1, times=None, point=None):
+		"""tod -> m. See forward for the meaning of point."""
 		if times is None: times = np.zeros(5)
-		self.core.pmat_map_direct_grid(-1, tod.T, tmul, m.T, mmul, 1, self.order, self.scan.boresight.T,
-				self.scan.hwp_phase.T, self.scan.offsets.T, self.scan.comps.T,
-				self.rbox.T, self.nbox, self.yvals.T, self.pixbox.T, self.nphi, times)
+		if point is not None:
+			self.core.pmat_map_use_pix_grid(-1, tod.T, tmul, m.T, mmul, point.pix.T, point.phase.T,
+					point.scale, self.scan.comps.T, self.pixbox.T, self.nphi, times)
+		else:
+			self.core.pmat_map_direct_grid(-1, tod.T, tmul, m.T, mmul, 1, self.order, self.accum, self.scan.boresight.T,
+					self.scan.hwp_phase.T, self.scan.offsets.T, self.scan.comps.T,
+					self.rbox.T, self.nbox, self.yvals.T, self.pixbox.T, self.nphi, times)
+	def get_pix_phase(self):
+		"""Compute the pointing for this scan, returning pix[ndet,nsamp] (flattened
+		1-based indices into the pixbox, with 0 for out-of-bounds samples) and
+		phase[ndet,nsamp,{Q,U}]. Only supported for nearest neighbor projection."""
+		if self.order != 0: raise ValueError("Precomputed pointing requires pmat_map_order 0")
+		ndet, nsamp = self.scan.ndet, self.scan.nsamp
+		pix    = np.zeros([ndet,nsamp],np.int32)
+		phase  = np.zeros([ndet,nsamp,2],self.dtype)
+		self.core.pmat_map_get_pix_grid(pix.T, phase.T, self.scan.boresight.T, self.scan.hwp_phase.T,
+				self.scan.offsets.T, self.scan.comps.T, self.rbox.T, self.nbox, self.yvals.T, self.pixbox.T)
+		return pix, phase
+	def stats(self, div, hits, cmap, cut, dweight=None, wsamp=None):
+		"""Accumulate the white noise pixel covariance div[ncomp,ncomp,ny,nx],
+		the hitcount map hits[ny,nx] and the crosslinking map cmap[ncomp,ny,nx]
+		for this scan in a single pass, without needing any tods. Samples in the
+		Sampcut cut are skipped. Each sample is weighted by dweight[ndet]*wsamp[nsamp],
+		both of which default to one. Only supported for nearest neighbor
+		projection."""
+		if self.order != 0: raise ValueError("Single-pass map statistics require pmat_map_order 0")
+		if dweight is None: dweight = np.ones(self.scan.ndet)
+		if wsamp   is None: wsamp   = np.ones(self.scan.nsamp, self.dtype)
+		dweight = np.asarray(dweight, dtype=np.float64).reshape(-1)
+		wsamp   = np.asarray(wsamp, dtype=self.dtype).reshape(-1)
+		ranges = cut.ranges if len(cut.ranges) > 0 else np.zeros([1,2],np.int32)
+		self.core.pmat_map_stats_grid(div.T, hits.T, cmap.T, dweight, wsamp,
+				ranges.T, cut.detmap, self.scan.boresight.T, self.scan.hwp_phase.T,
+				self.scan.offsets.T, self.scan.comps.T, self.rbox.T, self.nbox, self.yvals.T,
+				self.pixbox.T, self.nphi)
 	def translate(self, bore=None, offs=None, comps=None):
 		"""Perform the coordinate transformation used in the pointing matrix without
 		actually projecting TOD values to a map."""
 		raise NotImplementedError
 
+config.default("pmat_cache_size", 4.0, "Memory budget in GB for each PointingCache. Pointing that doesn't fit is spilled to disk, or recomputed if there is no spill directory.")
+config.default("pmat_cache_spill", "", "Directory to spill evicted PointingCache entries to. Empty to disable spilling.")
+class CachedPointing:
+	"""Compact precomputed pointing for a PmatMap. pix[ndet,nsamp] are flattened
+	pixbox indices and phase[ndet,nsamp,{Q,U}] is the polarization response
+	quantized to int16. The real response is phase*scale."""
+	def __init__(self, pix, phase, scale):
+		self.pix, self.phase, self.scale = pix, phase, scale
+	@staticmethod
+	def build(pmat):
+		pix, phase = pmat.get_pix_phase()
+		scale = max(np.max(np.abs(phase)),1e-30)/32767 if phase.size > 0 else 1.0
+		qphase= np.round(phase/scale).astype(np.int16)
+		return CachedPointing(pix, qphase, float(scale))
+	@property
+	def nbytes(self): return self.pix.nbytes + self.phase.nbytes
+
+class PointingCache:
+	"""Keeps the precomputed pointing of a set of PmatMaps (see PmatMap.get_pix_phase)
+	so that it only needs to be computed once per scan, after which forward and
+	backward projection are just gathers and scatters. The pointing is stored as
+	int32 pixels and int16-quantized Q,U response (8 bytes per sample).
+	Entries are kept in memory up to a budget of size GB. When this is exceeded,
+	the least recently used entries are moved to a spill file in the spill
+	directory, from which they are memory mapped back when needed. Without a spill
+	directory they are simply discarded and recomputed on the next use.
+
+	Usage: cache = PointingCache(); point = cache.get(pmat); pmat.forward(tod, m, point=point)"""
+	def __init__(self, size=None, spill=None):
+		self.size  = int(config.get("pmat_cache_size", size)*1024**3)
+		spill      = config.get("pmat_cache_spill", spill)
+		self.entries = collections.OrderedDict() # pmat -> CachedPointing, in LRU order
+		self.spilled = {} # pmat -> (offset, ndet, nsamp, scale)
+		self.nbytes  = 0
+		self.spill_name = None
+		if spill:
+			utils.mkdir(spill)
+			fd, self.spill_name = tempfile.mkstemp(suffix=".spill", dir=spill)
+			os.close(fd)
+			self.spill_end = 0
+	def get(self, pmat):
+		"""Returns the CachedPointing for pmat, computing or reading it if necessary."""
+		if pmat in self.entries:
+			point = self.entries.pop(pmat)
+			self.entries[pmat] = point
+			return point
+		if pmat in self.spilled:
+			point = self.read_spill(pmat)
+		else:
+			point = CachedPointing.build(pmat)
+		self.entries[pmat] = point
+		self.nbytes += point.nbytes
+		self.evict(keep=pmat)
+		return point
+	def evict(self, keep=None):
+		"""Move least recently used entries out of memory until we are within
+		our budget. The entry keep is never evicted."""
+		while self.nbytes > self.size and len(self.entries) > 1:
+			pmat = next(iter(self.entries))
+			if pmat is keep: break
+			point = self.entries.pop(pmat)
+			self.nbytes -= point.nbytes
+			if self.spill_name and pmat not in self.spilled:
+				self.write_spill(pmat, point)
+	def write_spill(self, pmat, point):
+		with open(self.spill_name, "ab") as f:
+			point.pix.tofile(f)
+			point.phase.tofile(f)
+		self.spilled[pmat] = (self.spill_end,)+point.pix.shape+(point.scale,)
+		self.spill_end += point.nbytes
+	def read_spill(self, pmat):
+		offset, ndet, nsamp, scale = self.spilled[pmat]
+		pix   = np.memmap(self.spill_name, np.int32, "r", offset, (ndet,nsamp))
+		phase = np.memmap(self.spill_name, np.int16, "r", offset+pix.nbytes, (ndet,nsamp,2))
+		return CachedPointing(pix, phase, scale)
+	def close(self):
+		"""Free all entries and remove the spill file."""
+		self.entries.clear()
+		self.spilled.clear()
+		self.nbytes = 0
+		if self.spill_name and os.path.exists(self.spill_name):
+			os.remove(self.spill_name)
+		self.spill_name = None
+	def __del__(self):
+		try: self.close()
+		except Exception: pass
+
 class PmatMapFast(PointingMatrix):
 	"""Fortran-accelerated scan <-> enmap pointing matrix implementation
 	using precomputed pointing and polynomial interpolation."""
@@ -223,11 +353,15 @@ class PolyInterpol:
 		# a severe performance (10x-100x loss of speed) problemI get when
 		# openblas and openmp threads are created rapidly in succession.
 		# The thinning will make it relatively cheap memory-wise anyway.
-		opoints = []
-		for di, offs in enumerate(det_offs):
-			# First evaluate our exact pointing
-			ipoint = bore + offs
-			opoints.append(transfun(ipoint.T))
+		if hasattr(transfun, "dets"):
+			# Evaluate the exact pointing of all the detectors at once
+			opoints = list(transfun.dets(bore, det_offs))
+		else:
+			opoints = []
+			for di, offs in enumerate(det_offs):
+				# First evaluate our exact pointing
+				ipoint = bore + offs
+				opoints.append(transfun(ipoint.T))
 		coeffs = []
 		resids = []
 		for di, opoint in enumerate(opoints):
@@ -258,7 +392,7 @@ class PolyInterpol:
 
 class PmatMapMultibeam(PointingMatrix):
 	"""Like PmatMap, but with multiple, displaced beams."""
-	def __init__(self, scan, template, beam_offs, beam_comps, sys=None, order=None):
+	def __init__(self, scan, template, beam_offs, beam_comps, sys=None, order=None, accum=None):
 		# beam_offs has format [nbeam,ndet,{dt,dra,ddec,}], which allows
 		# each detector to have a separate beam. The dt part is pretty useless.
 		# beam_comps has format [nbeam,ndet,{T,Q,U}].
@@ -277,6 +411,7 @@ class PmatMapMultibeam(PointingMatrix):
 		self.pixbox, self.nphi  = build_pixbox(obox[:,:2], template)
 		self.scan,   self.dtype = scan, template.dtype
 		self.order = config.get("pmat_map_order", order)
+		self.accum = get_accum_method(accum, self.pixbox, self.order, self.dtype)
 		self.err   = err
 	def forward(self, tod, m, tmul=1, mmul=1, times=None):
 		"""m -> tod"""
@@ -286,7 +421,7 @@ class PmatMapMultibeam(PointingMatrix):
 		if self.empty: return
 		core = get_core(tod.dtype)
 		for bi, (boff, bcomp) in enumerate(zip(self.beam_offs, self.beam_comps)):
-			core.pmat_map_direct_grid(1, tod.T, 1.0, m.T, mmul, 1, self.order, self.scan.boresight.T,
+			core.pmat_map_direct_grid(1, tod.T, 1.0, m.T, mmul, 1, self.order, self.accum, self.scan.boresight.T,
 					self.scan.hwp_phase.T, boff.T, bcomp.T, self.rbox.T, self.nbox, self.yvals.T,
 					self.pixbox.T, self.nphi, times)
 	def backward(self, tod, m, tmul=1, mmul=1, times=None):
@@ -296,7 +431,7 @@ class PmatMapMultibeam(PointingMatrix):
 		if self.empty: return
 		core = get_core(tod.dtype)
 		for bi, (boff, bcomp) in enumerate(zip(self.beam_offs, self.beam_comps)):
-			core.pmat_map_direct_grid(-1, tod.T, tmul, m.T, 1.0, 1, self.order, self.scan.boresight.T,
+			core.pmat_map_direct_grid(-1, tod.T, tmul, m.T, 1.0, 1, self.order, self.accum, self.scan.boresight.T,
 					self.scan.hwp_phase.T, boff.T, bcomp.T, self.rbox.T, self.nbox, self.yvals.T,
 					self.pixbox.T, self.nphi, times)
 
@@ -461,6 +596,23 @@ class pos2pix:
 		# boresight, since we don't really want boresight-centered coordinates, we want detector
 		# centered coordinates.
 		opos = coordinates.transform(self.scan.sys, self.sys, ipos[1:], time=time, site=self.scan.site, pol=True, bore=ipos[1:])
+		return self.opos2pix(opos, time, shape)
+	def dets(self, bore, det_offs):
+		"""Evaluate self((bore+off).T) for each detector offset off[{t,az,el}] in
+		det_offs[ndet], where bore is [nsamp,{t,az,el}]. Returns opix[ndet,{y,x,c,s},nsamp].
+		All the detectors are transformed at once using coordinates.transform_dets
+		when possible. If that is less accurate than pmat_dets_tol, each detector
+		is transformed separately."""
+		bore, det_offs = np.asarray(bore), np.asarray(det_offs)
+		tol  = config.get("pmat_dets_tol")*utils.arcsec
+		if tol <= 0 or np.any(det_offs[:,0] != 0) or coordinates.is_bore_relative(self.scan.sys) or coordinates.is_bore_relative(self.sys):
+			return np.array([self((bore+off).T) for off in det_offs])
+		time = self.scan.mjd0 + bore[:,0]/utils.day2sec
+		opos = coordinates.transform_dets(self.scan.sys, self.sys, bore[:,1:].T, det_offs[:,1:], time=time, site=self.scan.site, pol=True, tol=tol)
+		return np.array([self.opos2pix(opos[:,di], time, time.shape) for di in range(len(det_offs))])
+	def opos2pix(self, opos, time, shape):
+		"""Apply the extra transformations and parallax correction to the
+		output coordinates opos[{ra,dec,ang},nsamp], and turn them into opix[{y,x,c,s},...]."""
 		# Apply any extra transformations
 		for trf in self.extra:
 			opos = trf(opos, time)
@@ -473,7 +625,7 @@ class pos2pix:
 			# This looks wrong: opos is {ra,dec}, so it doesn't need flipping
 			opos[1::-1] = parallax.earth2sun_mixed(opos[1::-1], sundist, self.scan.mjd0)
 
-		opix = np.zeros((4,)+ipos.shape[1:])
+		opix = np.zeros((4,)+opos.shape[1:])
 		if self.template is not None:
 			opix[:2] = self.template.sky2pix(opos[1::-1],safe=2)
 			# When mapping the full sky, angle wraps can't be hidden
@@ -568,12 +720,114 @@ def build_interpol(transform, box, id="none", posunit=1.0, sys=None, pad=None):
 	acc = config.get("pmat_accuracy")
 	ip_size = config.get("pmat_interpol_max_size")
 	ip_time = config.get("pmat_interpol_max_time")
-	# Build pointing interpolator
 	errlim = np.array([1e-3*posunit,1e-3*posunit,utils.arcmin,utils.arcmin])*acc
+	# Reuse a cached interpolator if possible
+	key = interpol_cache_key(transform, id, errlim, ip_size)
+	if key is not None:
+		res = interpol_cache.get(key, box)
+		if res is not None: return res
+	# Build pointing interpolator
 	ipol, obox, ok, err = interpol.build(transform, interpol.ip_linear, box, errlim, maxsize=ip_size, maxtime=ip_time, return_obox=True, return_status=True)
 	if not ok and np.any(err>errlim): print("Warning: Accuracy %g was specified, but only reached %g for tod %s" % (acc, np.max(err/errlim)*acc, id))
+	if key is not None: interpol_cache.put(key, ipol, obox, err)
 	return ipol, obox, err
 
+def interpol_cache_key(transform, id, errlim, ip_size):
+	"""Returns a string describing everything the pointing interpolator
+	build_interpol makes for transform depends on, apart from its bounding box,
+	or None if it can't be cached."""
+	if not isinstance(transform, pos2pix) or len(transform.extra) > 0 or id == "none": return None
+	scan, tmpl = transform.scan, transform.template
+	geo  = None if tmpl is None else (tuple(tmpl.shape[-2:]), tmpl.wcs.to_header_string())
+	site = [(key, repr(scan.site[key])) for key in sorted(scan.site)]
+	return repr((id, scan.sys, transform.sys, repr(scan.mjd0), site, geo, repr(transform.ref_phi),
+		repr(config.get("pmat_parallax_au")), [repr(e) for e in errlim], ip_size))
+
+class InterpolCache:
+	"""A cache of the pointing interpolators built by build_interpol. They
+	are kept in memory, least recently used first out, up to maxmem bytes, and
+	optionally stored in the directory dir, where other tasks and later runs
+	can find them. An interpolator is reused when its key matches and its box
+	covers the one requested. maxmem and dir default to the pmat_interpol_cache_mem
+	and pmat_interpol_cache_dir settings."""
+	def __init__(self, maxmem=None, dir=None):
+		self.maxmem, self.dir = maxmem, dir
+		self.data   = collections.OrderedDict()
+		self.nbytes = 0
+	def get(self, key, box):
+		"""Returns (ipol, obox, err) for key if we have one covering box, otherwise None."""
+		try:
+			res = self.data.pop(key)
+			self.data[key] = res
+		except KeyError:
+			res = self.read(key)
+			if res is not None: self.remember(key, res)
+		if res is None or not box_covers(res[0].box, box): return None
+		return res
+	def put(self, key, ipol, obox, err):
+		self.remember(key, (ipol, obox, err))
+		self.write(key, (ipol, obox, err))
+	def remember(self, key, res):
+		maxmem = self.maxmem if self.maxmem is not None else config.get("pmat_interpol_cache_mem")*1024**3
+		if key in self.data: self.nbytes -= interpol_nbytes(self.data.pop(key)[0])
+		nbytes = interpol_nbytes(res[0])
+		if nbytes > maxmem: return
+		self.data[key] = res
+		self.nbytes   += nbytes
+		while self.nbytes > maxmem:
+			_, old = self.data.popitem(last=False)
+			self.nbytes -= interpol_nbytes(old[0])
+	def fname(self, key):
+		dir = self.dir if self.dir is not None else config.get("pmat_interpol_cache_dir")
+		if not dir: return None
+		return os.path.join(dir, "ipol_%s.hdf" % hashlib.sha1(key.encode()).hexdigest())
+	def read(self, key):
+		"""Read the interpolator for key from disk. The key and a checksum of
+		the interpolation mesh are verified, and None is returned if they don't
+		match, or there is no cache file."""
+		fname = self.fname(key)
+		if fname is None or not os.path.isfile(fname): return None
+		try:
+			with h5py.File(fname, "r") as hfile:
+				fkey = hfile.attrs["key"]
+				if isinstance(fkey, bytes): fkey = fkey.decode()
+				if fkey != key: return None
+				box, y, obox, err = [hfile[name][()] for name in ["box","y","obox","err"]]
+				if hfile.attrs["checksum"] != zlib.crc32(y.tobytes()) & 0xffffffff: return None
+		except (IOError, OSError, KeyError): return None
+		return interpol.ip_linear(box, y), obox, err
+	def write(self, key, res):
+		"""Write the interpolator for key to disk, if we have a cache directory.
+		Failure to do so is not an error."""
+		fname = self.fname(key)
+		if fname is None: return
+		ipol, obox, err = res
+		# Write atomically, since other tasks may be reading it
+		tmpname = "%s.tmp%d" % (fname, os.getpid())
+		try:
+			utils.mkdir(os.path.dirname(fname))
+			with h5py.File(tmpname, "w") as hfile:
+				hfile.attrs["key"] = key
+				hfile.attrs["checksum"] = zlib.crc32(np.ascontiguousarray(ipol.y).tobytes()) & 0xffffffff
+				hfile["box"], hfile["y"], hfile["obox"], hfile["err"] = ipol.box, ipol.y, obox, err
+			os.rename(tmpname, fname)
+		except (IOError, OSError):
+			try: os.remove(tmpname)
+			except OSError: pass
+	def clear(self):
+		self.data.clear()
+		self.nbytes = 0
+
+def box_covers(box1, box2):
+	"""Returns whether the bounding box box1[{from,to},:] contains box2."""
+	return np.all(box1[0] <= box2[0]) and np.all(box1[1] >= box2[1])
+
+def interpol_nbytes(ipol):
+	return sum([getattr(ipol, name).nbytes for name in ["y","ys"] if hasattr(ipol, name)])
+
+# The interpolator cache used by build_interpol
+interpol_cache = InterpolCache()
+
 def build_pos_transform(scan, sys):
 	# Set up pointing interpolation
 	box = np.array(scan.box)
@@ -649,6 +903,28 @@ def build_pixbox(obox, template, margin=10):
 		res[:,1] = [0,template.shape[-1]]
 	return res, nphi
 
+def get_nthread():
+	"""The number of OpenMP threads the fortran code will use."""
+	try: return int(os.environ["OMP_NUM_THREADS"])
+	except (KeyError, ValueError): return multiprocessing.cpu_count()
+
+def get_accum_method(method, pixbox, order, dtype, nthread=None):
+	"""Translate a pmat_accum method name into the code expected by
+	pmat_map_direct_grid. For 'auto', the choice is based on the size of
+	the pixbox compared to the number of threads."""
+	method = config.get("pmat_accum", method)
+	if method == "auto":
+		if nthread is None: nthread = get_nthread()
+		nbyte = nthread*np.prod(pixbox[1]-pixbox[0])*3*np.dtype(dtype).itemsize
+		if   nthread <= 1: method = "atomic"
+		elif nbyte <= config.get("pmat_accum_mem")*1024**3: method = "private"
+		elif order == 0: method = "stripe"
+		else: method = "atomic"
+	if method == "stripe" and order != 0:
+		raise ValueError("pmat_accum 'stripe' only supports nearest neighbor projection")
+	try: return {"atomic":1, "private":2, "stripe":3}[method]
+	except KeyError: raise ValueError("Unrecognized pmat_accum method '%s'" % method)
+
 def pmat_phase(dir, tod, map, az, dets, az0, daz):
 	core = get_core(tod.dtype)
 	core.pmat_phase(dir, tod.T, map.T, az, dets, az0, daz)
@@ -712,3 +988,95 @@ class PmatNoiseRect(PointingMatrix):
 		core = get_core(tod.dtype)
 		core.pmat_noise_rect(-1, tod.T, tmul, m.T, mmul, self.bore.T, self.off.T, self.comps.T,
 				self.box.T, self.scandir)
+
+def pointing_cache_test(nscan=3):
+	"""Check that projecting with the pointing from a PointingCache matches the
+	direct projection, also when the entries are spilled to disk and read back."""
+	import shutil
+	from .. import scansim
+	scans, area = scansim.sim_test_scans(nscan)
+	pmats = [PmatMap(scan, area, order=0, sys="equ") for scan in scans]
+	rng   = np.random.RandomState(1)
+	m     = enmap.enmap(rng.standard_normal(area.shape), area.wcs)
+	spill = tempfile.mkdtemp()
+	try:
+		# Room for about one scan, so the others are spilled
+		cache = PointingCache(size=1.5*scans[0].ndet*scans[0].nsamp*8/1024**3, spill=spill)
+		for rep in range(2):
+			for pmat in pmats:
+				point = cache.get(pmat)
+				ref   = np.zeros((pmat.scan.ndet, pmat.scan.nsamp), area.dtype)
+				tod   = ref.copy()
+				pmat.forward(ref, m)
+				pmat.forward(tod, m, point=point)
+				# The Q,U response is quantized to 16 bits
+				assert np.max(np.abs(tod-ref)) <= 1e-4*np.max(np.abs(ref))
+				mref, mtest = area*0, area*0
+				pmat.backward(ref, mref)
+				pmat.backward(ref, mtest, point=point)
+				assert np.max(np.abs(mtest-mref)) <= 1e-4*np.max(np.abs(mref))
+		assert len(cache.spilled) > 0 and len(cache.entries) < nscan
+		cache.close()
+		assert os.listdir(spill) == []
+	finally: shutil.rmtree(spill)
+
+def accum_test():
+	"""Check that the atomic, private and stripe accumulation methods of
+	PmatMap.backward give the same map."""
+	from .. import scansim
+	scans, area = scansim.sim_test_scans(ndet=30)
+	scan = scans[0]
+	tod  = np.random.RandomState(1).standard_normal((scan.ndet, scan.nsamp)).astype(area.dtype)
+	for order, methods in [(0, ["atomic","private","stripe"]), (1, ["atomic","private"])]:
+		maps = []
+		for method in methods:
+			maps.append(area*0)
+			PmatMap(scan, area, order=order, sys="equ", accum=method).backward(tod, maps[-1])
+		for method, m in zip(methods[1:], maps[1:]):
+			assert np.max(np.abs(m-maps[0])) <= 1e-10*np.max(np.abs(maps[0])), "%s differs for order %d" % (method, order)
+
+def interpol_cache_test():
+	"""Check that build_interpol reuses cached interpolators from memory and
+	from disk, that corrupted cache files are rejected, and that failed writes
+	don't leave temporary files behind."""
+	import shutil
+	from .. import scansim
+	scans, area = scansim.sim_test_scans()
+	scan = scans[0]
+	dir  = tempfile.mkdtemp()
+	def build(box=scan.box): return build_interpol(pos2pix(scan, area, "equ"), box, id=scan.id)
+	try:
+		with config.override("pmat_interpol_cache_dir", dir):
+			interpol_cache.clear()
+			r1 = build()
+			assert build()[0] is r1[0]
+			assert len(os.listdir(dir)) == 1
+			# Read back from disk
+			interpol_cache.clear()
+			r2 = build()
+			assert r2[0] is not r1[0] and np.array_equal(r2[0].y, r1[0].y)
+			assert np.array_equal(r2[0].box, r1[0].box) and np.array_equal(r2[1], r1[1])
+			# Boxes inside the cached one are also served by it
+			sub = scan.box.copy(); sub[1,1:] = np.mean(scan.box[:,1:],0)
+			assert build(sub)[0] is r2[0]
+			# A different id is a miss
+			assert build_interpol(pos2pix(scan, area, "equ"), scan.box, id="other")[0] is not r2[0]
+			assert len(os.listdir(dir)) == 2
+			# Corrupt the file for our scan
+			key = list(interpol_cache.data.keys())[0]
+			with h5py.File(interpol_cache.fname(key), "r+") as hfile: hfile["y"][0,0,0] += 1
+			assert interpol_cache.read(key) is None
+			interpol_cache.clear()
+			assert np.array_equal(build()[0].y, r1[0].y)
+		# Entries larger than maxmem are not kept in memory
+		cache = InterpolCache(maxmem=0, dir="")
+		cache.put("a", *r1)
+		assert len(cache.data) == 0 and cache.nbytes == 0
+		# Failed writes are ignored and cleaned up
+		cache = InterpolCache(dir=dir)
+		os.mkdir(cache.fname("b")); open(os.path.join(cache.fname("b"), "x"), "w").close()
+		cache.write("b", r1)
+		assert not any([".tmp" in name for name in os.listdir(dir)])
+	finally:
+		interpol_cache.clear()
+		shutil.rmtree(dir)
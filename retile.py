@@ -1,9 +1,12 @@
 from __future__ import division, print_function
-import numpy as np, glob, re, sys, os
-from . import utils, enmap, bunch
+import numpy as np, glob, re, sys, os, json, collections
+from . import utils, enmap, bunch, config, wcsutils
+from astropy.io import fits
 
 default_pathformat = "tile%(y)03d_%(x)03d.fits"
 
+config.default("retile_cache_mem", 1.0, "Max GB of decoded tiles kept in the tile cache shared by TileStores.")
+
 def leaftile(idir, odir, tsize=675, comm=None, verbose=False, lrange=[0,-6],
 		monolithic=False, slice=None):
 	"""Given a input directory containing a tiled dmap in standard
@@ -22,12 +25,89 @@ def leaftile(idir, odir, tsize=675, comm=None, verbose=False, lrange=[0,-6],
 			"%s/%d/%s" % (odir,lrange[0],otilename),
 			ocorner=(np.pi/2,-np.pi), otilesize=(-tsize,tsize),
 			comm=comm, verbose=verbose, itile1=itile1, itile2=itile2, slice=slice)
-	# Then loop over the smaller levels
-	for level in range(lrange[0]-1,lrange[1],-1):
-		if comm: comm.barrier()
-		combine_tiles("%s/%d/%s" % (odir, level+1, otilename),
-				"%s/%d/%s" % (odir, level, otilename), tyflip=True,
-				pad_to=tsize, comm=comm, verbose=verbose)
+	# Then build the smaller levels from them
+	if comm: comm.barrier()
+	build_pyramid("%s/%%(level)d/%s" % (odir, otilename), lrange, pad_to=tsize,
+			tyflip=True, comm=comm, verbose=verbose)
+
+def build_pyramid(pathfmt, lrange, pad_to=None, tyflip=False, txflip=False, comm=None, verbose=False):
+	"""Given the tiles of level lrange[0] on disk at pathfmt % {"level":...,"y":...,"x":...},
+	build levels lrange[0]-1 down to lrange[1]+1 of a tile pyramid, where each tile
+	is made from 2x2 tiles from the level above downsampled by 2, like combine_tiles does.
+
+	Instead of going through the levels one by one, each task builds whole subtrees
+	depth-first, so every input tile is read once and the intermediate levels are
+	built in memory and written as they are finished. Subtrees are rooted at the
+	coarsest level that still has a tile for each task. The levels coarser than
+	that are built the same way from the subtree roots after a single barrier."""
+	rank, size = (comm.rank, comm.size) if comm is not None else (0, 1)
+	pad_to = np.zeros(2,int)+pad_to if pad_to is not None else None
+	top    = lrange[1]+1
+	# Find the tile range of each level
+	ranges = {lrange[0]: find_tile_range(pathfmt.replace("%(level)d", str(lrange[0])))}
+	for level in range(lrange[0]-1, top-1, -1):
+		t1, t2 = ranges[level+1]
+		ranges[level] = (t1//2, (t2-1)//2+1)
+	def ntile(level): return np.product(ranges[level][1]-ranges[level][0])
+	def build(level, ty, tx, leaf):
+		"""Returns tile (ty,tx) of the given level. It is read from disk if it is
+		at the leaf level. Otherwise it is built from the level above and written."""
+		fname = pathfmt % {"level":level, "y":ty, "x":tx}
+		if level == leaf: return enmap.read_map(fname)
+		(t1, t2), rows = ranges[level+1], []
+		for iy in range(2*ty, min(2*ty+2, t2[0])):
+			rows.append([build(level+1, iy, ix, leaf) if iy >= t1[0] and ix >= t1[1] else (iy,ix)
+				for ix in range(2*tx, min(2*tx+2, t2[1]))])
+		# Tiles before the start of the range are missing on disk, but logically
+		# part of the tiling. Replace them with zeros.
+		rows = fill_missing_tiles(rows, tyflip=tyflip, txflip=txflip)
+		if txflip: rows = [cols[::-1] for cols in rows]
+		if tyflip: rows = rows[::-1]
+		omap = enmap.downgrade(enmap.tile_maps(rows), 2)
+		if pad_to is not None:
+			padding = np.array([[0,0],[pad_to[0]-omap.shape[-2],pad_to[1]-omap.shape[-1]]])
+			if tyflip: padding[:,0] = padding[::-1,0]
+			if txflip: padding[:,1] = padding[::-1,1]
+			omap = enmap.pad(omap, padding)
+		utils.mkdir(os.path.dirname(fname))
+		enmap.write_map(fname, omap)
+		if verbose: print(fname)
+		return omap
+	leaf = lrange[0]
+	while leaf > top:
+		enough = [level for level in range(leaf-1, top-1, -1) if ntile(level) >= size]
+		root   = enough[-1] if len(enough) > 0 else top
+		t1, t2 = ranges[root]
+		tyx    = [(ty,tx) for ty in range(t1[0],t2[0]) for tx in range(t1[1],t2[1])]
+		for i in range(rank, len(tyx), size):
+			build(root, tyx[i][0], tyx[i][1], leaf)
+		if comm and root > top: comm.barrier()
+		leaf = root
+
+def fill_missing_tiles(rows, tyflip=False, txflip=False):
+	"""Replace the (ty,tx) placeholders in the 2d list of tiles rows with zero
+	tiles with the correct geometry, based on one of the real tiles."""
+	ref, rpos = None, None
+	for cols in rows:
+		for tile in cols:
+			if not isinstance(tile, tuple): ref = tile
+	for iy, cols in enumerate(rows):
+		for ix, tile in enumerate(cols):
+			if tile is ref: rpos = (iy, ix)
+	res = []
+	for iy, cols in enumerate(rows):
+		res.append([])
+		for ix, tile in enumerate(cols):
+			if isinstance(tile, tuple):
+				# Pixel offset of this tile relative to the reference tile
+				off = np.array([iy-rpos[0],ix-rpos[1]])*ref.shape[-2:]
+				if tyflip: off[0] = -off[0]
+				if txflip: off[1] = -off[1]
+				wcs = ref.wcs.deepcopy()
+				wcs.wcs.crpix -= off[::-1]
+				tile = enmap.zeros(ref.shape, wcs, ref.dtype)
+			res[-1].append(tile)
+	return res
 
 def combine_tiles(ipathfmt, opathfmt, combine=2, downsample=2,
 		itile1=(None,None), itile2=(None,None), tyflip=False, txflip=False,
@@ -140,7 +220,7 @@ def retile(ipathfmt, opathfmt, itile1=(None,None), itile2=(None,None),
 	otile1, otile2 = np.minimum(otile1,otile2), np.maximum(otile1,otile2)
 	otile2 += 1
 	# We can now loop over output tiles
-	cache = [None,None,None]
+	cache = get_store(ipathfmt, slice=slice)
 	oyx = [(oy,ox) for oy in range(otile1[0],otile2[0]) for ox in range(otile1[1],otile2[1])]
 	for i in range(rank, len(oyx), size):
 		otile = np.array(oyx[i])
@@ -230,30 +310,18 @@ def find_tile_range(pathfmt, tile1=(None,None), tile2=(None,None)):
 	return ranges[:,0], ranges[:,1]
 
 def read_tileset_geometry(ipathfmt, itile1=(None,None), itile2=(None,None)):
-	itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
-	mfile1 = ipathfmt % {"y":itile1[0],"x":itile1[1]}
-	mfile2 = ipathfmt % {"y":itile2[0]-1,"x":itile2[1]-1}
-	m1 = enmap.read_map(mfile1)
-	m2 = m1 if mfile1 == mfile2 else enmap.read_map(mfile2)
-	wy,wx  = m1.shape[-2:]
-	oshape = tuple(np.array(m1.shape[-2:])*(itile2-itile1-1) + np.array(m2.shape[-2:]))
-	return bunch.Bunch(shape=m1.shape[:-2]+oshape, wcs=m1.wcs, dtype=m1.dtype,
-			tshape=m1.shape[-2:])
+	return get_store(ipathfmt).geometry(itile1, itile2)
 
 def read_area(ipathfmt, opix, itile1=(None,None), itile2=(None,None), verbose=False,
 		cache=None, slice=None, wrap=True):
 	"""Given a set of tiles on disk with locations ipathfmt % {"y":...,"x":...},
 	read the data corresponding to the pixel range opix[{from,to},{y,x}] in
-	the full map."""
-	opix = np.asarray(opix)
-	# Find the range of input tiles
-	itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
-	# To fill in the rest of the information we need to know more
-	# about the input tiling, so read the first tile
-	if cache is None or cache[2] is None:
-		geo = read_tileset_geometry(ipathfmt, itile1=itile1, itile2=itile2)
-	else: geo = cache[2]
-	if cache is not None: cache[2] = geo
+	the full map. The tiles are read through the TileStore cache, which can
+	be passed explicitly. Other values of cache are ignored."""
+	opix  = np.asarray(opix)
+	store = cache if isinstance(cache, TileStore) else get_store(ipathfmt, slice=slice)
+	itile1, itile2 = store.tile_range(itile1, itile2)
+	geo   = store.geometry(itile1, itile2)
 	# Determine tile wrapping
 	npix_phi  = np.abs(360./geo.wcs.wcs.cdelt[0])
 	ntile_phi = utils.nint(npix_phi/geo.tshape[-1])
@@ -274,29 +342,20 @@ def read_area(ipathfmt, opix, itile1=(None,None), itile2=(None,None), verbose=Fa
 		oy1,oy2 = overlap-opix[0,0]
 		iy1,iy2 = overlap-ipy1
 		for itx in range(it1[1],it2[1]):
-			if wrap: itx_wrap = itx % ntile_phi
+			itx_wrap = itx % ntile_phi if wrap else itx
 			if itx_wrap < itile1[1] or itx_wrap >= itile2[1]: continue
 			ipx1, ipx2 = itx*isize[1], (itx+1)*isize[1]
 			overlap = range_overlap(opix[:,1],[ipx1,ipx2])
 			ox1,ox2 = overlap-opix[0,1]
 			ix1,ix2 = overlap-ipx1
-			# Read the input tile and copy over
-			iname = ipathfmt % {"y":ity,"x":itx_wrap}
-			if cache is None or cache[0] != iname:
-				imap  = enmap.read_map(iname)
-				if slice: imap = eval("imap"+slice)
-			else: imap = cache[1]
-			if cache is not None:
-				cache[0], cache[1] = iname, imap
-			if verbose: print(iname)
 			# Edge input tiles may be smaller than the standard
-			# size.
-			ysub = isize[0]-imap.shape[-2]
-			xsub = isize[1]-imap.shape[-1]
-			# If the input map is too small, there may actually be
-			# zero overlap.
-			if oy2-ysub <= oy1 or ox2-xsub <= ox1: continue
-			omap[...,oy1:oy2-ysub,ox1:ox2-xsub] = imap[...,iy1:iy2-ysub,ix1:ix2-xsub]
+			# size, so there may actually be zero overlap.
+			tshape = store.tile_shape(ity, itx_wrap)
+			ny, nx = min(iy2,tshape[0])-iy1, min(ix2,tshape[1])-ix1
+			if ny <= 0 or nx <= 0: continue
+			# Read just the part of the input tile we need and copy over
+			omap[...,oy1:oy1+ny,ox1:ox1+nx] = store.read(ity, itx_wrap, [[iy1,ix1],[iy1+ny,ix1+nx]])
+			if verbose: print(store.tile_name(ity, itx_wrap))
 			noverlap += 1
 	if noverlap == 0:
 		raise IOError("No tiles for tiling %s in range %s" % (ipathfmt, ",".join([":".join([str(p) for p in r]) for r in opix.T])))
@@ -328,9 +387,9 @@ def retile_iterator(ipathfmt, otilesize=None, pixoff=(0,0), margin=0,
 		itile1=(None,None), itile2=(None,None), comm=None, verbose=False):
 	"""Iterator that yields a series of tiles from the tileset given by
 	ipathfmt. See read_retile for how margin, otilesize and pixoff
-	allow you to iterate over a modified tiling. This currently just
-	calls read_area repeatedly, so it is not as efficient as it could have
-	been."""
+	allow you to iterate over a modified tiling. The input tiles are
+	read through the shared TileStore cache, so tiles that are needed by
+	several output tiles due to the margins are usually only read once."""
 	# Handle mpi
 	rank, nproc = (0,1) if comm is None else (comm.rank, comm.size)
 	# Find the number of tiles to iterate over
@@ -343,3 +402,204 @@ def retile_iterator(ipathfmt, otilesize=None, pixoff=(0,0), margin=0,
 		tpos = tyx[i]
 		yield tpos, read_retile(ipathfmt, tpos, otilesize=otilesize, pixoff=pixoff,
 				margin=margin, itile1=itile1, itile2=itile2)
+
+class TileCache:
+	"""A least-recently-used cache of decoded tiles that holds at most
+	maxmem bytes. If maxmem is None, the retile_cache_mem setting is used."""
+	def __init__(self, maxmem=None):
+		self.maxmem = maxmem
+		self.data   = collections.OrderedDict()
+		self.nbytes = 0
+	def get(self, key):
+		"""Returns the tile for key, or None if it isn't cached."""
+		try: val = self.data.pop(key)
+		except KeyError: return None
+		self.data[key] = val
+		return val
+	def put(self, key, val):
+		maxmem = self.maxmem if self.maxmem is not None else config.get("retile_cache_mem")*1024**3
+		if key in self.data: self.nbytes -= self.data.pop(key).nbytes
+		if val.nbytes > maxmem: return
+		self.data[key] = val
+		self.nbytes   += val.nbytes
+		while self.nbytes > maxmem:
+			_, old = self.data.popitem(last=False)
+			self.nbytes -= old.nbytes
+	def clear(self):
+		self.data.clear()
+		self.nbytes = 0
+
+# The tile cache shared by all TileStores by default
+tile_cache = TileCache()
+
+class TileStore:
+	"""Access to a set of tiles on disk with locations pathfmt % {"y":...,"x":...}.
+	It has three parts:
+	 * An index of the tile range, the tiles that exist and the geometry of the
+	   tiling, which is built from the file names and tile headers once and
+	   persisted next to the tiles (see build_tile_index).
+	 * A cache of decoded tiles, by default the byte-limited LRU tile_cache that
+	   is shared between all stores.
+	 * Reads of parts of tiles that only decode the rows that are needed, for
+	   tiles that aren't cached.
+	slice is a string like "[0]" that is applied to each tile after reading, as
+	in read_area. Only whole tiles are read when it is used."""
+	def __init__(self, pathfmt, slice=None, cache=None, persist=True, full_frac=0.5):
+		self.pathfmt, self.slice = pathfmt, slice
+		self.cache     = cache if cache is not None else tile_cache
+		self.full_frac = full_frac
+		self.index     = read_tile_index(pathfmt, persist=persist)
+		self.exists    = set([tuple(yx) for yx in self.index["tiles"]])
+		self.wcs       = wcsutils.WCS(fits.Header.fromstring(self.index["wcs"])).sub(2)
+		self.pre, self.dtype = tuple(self.index["pre"]), np.dtype(self.index["dtype"])
+		if slice:
+			# Find the effect of the slice on the non-pixel dimensions
+			tile = eval("enmap.read_map(self.tile_name(*self.index['tile1']))"+slice)
+			self.pre, self.dtype = tile.shape[:-2], tile.dtype
+	def tile_name(self, ty, tx): return self.pathfmt % {"y":ty,"x":tx}
+	def tile_range(self, tile1=(None,None), tile2=(None,None)):
+		"""Like find_tile_range, but using our index."""
+		if tile1 is None: tile1 = (None,None)
+		if tile2 is None: tile2 = (None,None)
+		t1 = np.array([i if i is not None else d for i,d in zip(tile1,self.index["tile1"])])
+		t2 = np.array([i if i is not None else d for i,d in zip(tile2,self.index["tile2"])])
+		return t1, t2
+	def geometry(self, tile1=(None,None), tile2=(None,None)):
+		"""Like read_tileset_geometry, but using our index."""
+		tile1, tile2 = self.tile_range(tile1, tile2)
+		tshape = tuple(self.index["tshape"])
+		lshape = self.tile_shape(tile2[0]-1, tile2[1]-1)
+		oshape = tuple(np.array(tshape)*(tile2-tile1-1) + np.array(lshape))
+		return bunch.Bunch(shape=self.pre+oshape, wcs=self.wcs.deepcopy(), dtype=self.dtype, tshape=tshape)
+	def tile_shape(self, ty, tx):
+		"""The pixel shape of tile (ty,tx). Tiles in the last row and column
+		of the tiling may be smaller than the others."""
+		res = list(self.index["tshape"])
+		for i, t in enumerate([ty,tx]):
+			if t == self.index["tile2"][i]-1: res[i] = self.index["lshape"][i]
+		return tuple(res)
+	def read(self, ty, tx, pixbox=None, cache=True):
+		"""Read tile (ty,tx), or only the part pixbox[{from,to},{y,x}] of it
+		if specified. Whole tiles are read and cached if they are cached already,
+		if pixbox covers at least full_frac of the tile, or if a slice is used.
+		Otherwise only the requested rows are read. The result may be a view of
+		the cached tile, so it must not be modified."""
+		if (ty,tx) not in self.exists:
+			raise IOError("Tile %s does not exist" % self.tile_name(ty,tx))
+		fname = self.tile_name(ty,tx)
+		key   = (fname, self.slice)
+		tile  = self.cache.get(key)
+		if pixbox is not None:
+			pixbox = np.asarray(pixbox)
+			sel    = (Ellipsis, slice(pixbox[0,0],pixbox[1,0]), slice(pixbox[0,1],pixbox[1,1]))
+			frac   = np.product(pixbox[1]-pixbox[0])/float(np.product(self.tile_shape(ty,tx)))
+		if tile is None and pixbox is not None and not self.slice and frac < self.full_frac:
+			return enmap.read_map(fname, sel=sel, sel_threshold=0)
+		if tile is None:
+			tile = enmap.read_map(fname)
+			if self.slice: tile = eval("tile"+self.slice)
+			if cache: self.cache.put(key, tile)
+		return tile if pixbox is None else tile[sel]
+
+
+# Stores used by read_area etc., so their indices only need to be set up once
+stores = {}
+def get_store(pathfmt, slice=None):
+	"""Returns the shared TileStore for the given path format and slice."""
+	key = (pathfmt, slice)
+	if key not in stores: stores[key] = TileStore(pathfmt, slice=slice)
+	return stores[key]
+
+def tile_index_name(pathfmt):
+	"""Where the index for the tiles pathfmt is persisted, or None if it can't be."""
+	dirname, fmt = os.path.split(pathfmt)
+	if "%" in dirname or "%" not in fmt: return None
+	return os.path.join(dirname, ".tileindex_" + re.sub(r"[^\w.]", "_", fmt) + ".json")
+
+def build_tile_index(pathfmt):
+	"""Find the tiles matching pathfmt on disk and read the geometry of the tiling from
+	the headers of its first and last tile. Returns a dict that can be stored as json."""
+	gstr  = utils.format_to_glob(pathfmt)
+	regex = utils.format_to_regex(pathfmt)
+	tiles = []
+	for file in glob.glob(gstr):
+		m = re.match(regex, file)
+		if not m: continue
+		try: tiles.append([int(m.group(name)) for name in ["y","x"]])
+		except IndexError: tiles.append([0,0])
+	if len(tiles) == 0:
+		raise ValueError("Found no files matching path format!")
+	tiles  = sorted(tiles)
+	tile1  = np.min(tiles,0)
+	tile2  = np.max(tiles,0)+1
+	fname1 = pathfmt % {"y":tile1[0],"x":tile1[1]}
+	fname2 = pathfmt % {"y":tile2[0]-1,"x":tile2[1]-1}
+	shape1, wcs = enmap.read_map_geometry(fname1)
+	shape2, _   = enmap.read_map_geometry(fname2)
+	return {"pathfmt": os.path.basename(pathfmt), "tiles": tiles,
+		"tile1": [int(t) for t in tile1], "tile2": [int(t) for t in tile2],
+		"pre": list(shape1[:-2]), "tshape": list(shape1[-2:]), "lshape": list(shape2[-2:]),
+		"dtype": np.dtype(enmap.read_map_dtype(fname1)).name, "wcs": wcs.to_header_string(relax=True),
+		"stamp": tile_index_stamp(pathfmt, tiles)}
+
+def tile_index_stamp(pathfmt, tiles):
+	"""What a tile index is valid for: the set of tiles, and the
+	sizes and modification times of the ones the geometry was read from."""
+	stamp = [len(tiles)]
+	for yx in [tiles[0], tiles[-1]]:
+		st = os.stat(pathfmt % {"y":yx[0],"x":yx[1]})
+		stamp += [st.st_size, st.st_mtime]
+	return stamp
+
+def read_tile_index(pathfmt, persist=True):
+	"""Returns the index for the tiles pathfmt. A persisted index is used if
+	it is still valid, and otherwise a new one is built and saved if possible."""
+	iname = tile_index_name(pathfmt) if persist else None
+	if iname is not None:
+		try:
+			with open(iname, "r") as f: index = json.load(f)
+			if index["pathfmt"] == os.path.basename(pathfmt) and index["stamp"] == tile_index_stamp(pathfmt, index["tiles"]) \
+					and len(glob.glob(utils.format_to_glob(pathfmt))) == len(index["tiles"]):
+				return index
+		except (IOError, OSError, ValueError, KeyError): pass
+	index = build_tile_index(pathfmt)
+	if iname is not None:
+		# Write atomically, since several tasks may be doing this at the same time
+		tmpname = "%s.tmp%d" % (iname, os.getpid())
+		try:
+			with open(tmpname, "w") as f: json.dump(index, f)
+			os.rename(tmpname, iname)
+		except (IOError, OSError):
+			try: os.remove(tmpname)
+			except OSError: pass
+	return index
+
+def tilestore_test(tshape=(17,20)):
+	"""Check that read_area gives the same result as slicing the full map,
+	for areas that cross short edge tiles and wrap around the sky, both for
+	cached and uncached tiles, and that the tile index is persisted. Wrapping
+	requires the tile width to divide the width of the sky."""
+	import tempfile, shutil
+	shape, wcs = enmap.fullsky_geometry(res=2*utils.degree)
+	ref   = enmap.enmap(np.random.RandomState(1).standard_normal((3,)+shape), wcs)
+	dirname = tempfile.mkdtemp()
+	try:
+		pathfmt = os.path.join(dirname, default_pathformat)
+		for ty in range((shape[0]+tshape[0]-1)//tshape[0]):
+			for tx in range((shape[1]+tshape[1]-1)//tshape[1]):
+				enmap.write_map(pathfmt % {"y":ty,"x":tx}, ref[:,ty*tshape[0]:(ty+1)*tshape[0],tx*tshape[1]:(tx+1)*tshape[1]])
+		geo = read_tileset_geometry(pathfmt)
+		assert geo.shape == ref.shape and tuple(geo.tshape) == tshape
+		assert os.path.isfile(tile_index_name(pathfmt))
+		for cache in [TileStore(pathfmt, cache=TileCache(0)), TileStore(pathfmt, cache=TileCache())]:
+			for rep in range(2):
+				for box in [[[3,5],[40,70]], [[0,0],shape], [[80,100],[90,179]], [[5,-10],[20,15]]]:
+					box = np.array(box)
+					res = read_area(pathfmt, box, cache=cache)
+					exp = np.roll(ref, -box[0,1], -1)[:,box[0,0]:box[1,0],:box[1,1]-box[0,1]]
+					assert np.array_equal(res, exp)
+		assert cache.cache.nbytes > 0
+		# The slice argument
+		res = read_area(pathfmt, [[3,5],[40,70]], slice="[1]")
+		assert np.array_equal(res, ref[1,3:40,5:70])
+	finally: shutil.rmtree(dirname)
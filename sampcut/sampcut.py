@@ -272,3 +272,27 @@ def gapfill_linear(cut, tod, context=1, inplace=False, transpose=False):
 	if cut.ndet == 1 and tod.shape[0] > 1: cut = cut.repeat(tod.shape[0])
 	get_core(tod.dtype).gapfill_linear(cut.ranges.T, cut.detmap, tod.T, context, transpose)
 	return tod.reshape(ishape)
+
+def flatten_blocks(blocks):
+	"""Turn a list of detector blocks[nblock][dets] into the flattened
+	dets[:] and block start offsets bstart[nblock+1] the fortran code uses.
+	The blocks are processed in parallel there, so no detector may appear
+	more than once."""
+	dets   = np.concatenate([np.zeros(0, np.int32)]+[np.asarray(block, np.int32) for block in blocks])
+	bstart = np.concatenate([[0],np.cumsum([len(block) for block in blocks])]).astype(np.int32)
+	if len(np.unique(dets)) != len(dets): raise ValueError("Detector blocks must not overlap")
+	return dets.astype(np.int32), bstart
+def fit_common_blocks(cut, tod, blocks, weight, niter=3, context=1):
+	"""Fit and subtract a weighted common mode from each block of detectors
+	blocks[nblock][dets] in tod[ndet,nsamp], gapfilling the cut samples linearly
+	in each of the niter iterations. tod must be contiguous, and is modified in
+	place. The blocks are processed in parallel."""
+	assert tod.flags["C_CONTIGUOUS"], "fit_common_blocks requires a contiguous tod"
+	dets, bstart = flatten_blocks(blocks)
+	get_core(tod.dtype).fit_common_blocks(cut.ranges.T, cut.detmap, tod.T, dets, bstart, weight, niter, context)
+def fit_phase_blocks(cut, tod, blocks, weight, az, az0, daz, naz, niter=3, context=1):
+	"""Like fit_common_blocks, but fits a signal that depends on the azimuth az[nsamp]
+	and scanning direction, in naz bins of width daz starting at az0."""
+	assert tod.flags["C_CONTIGUOUS"], "fit_phase_blocks requires a contiguous tod"
+	dets, bstart = flatten_blocks(blocks)
+	get_core(tod.dtype).fit_phase_blocks(cut.ranges.T, cut.detmap, tod.T, dets, bstart, weight, az, az0, daz, naz, niter, context)
@@ -139,18 +139,20 @@ class Scan:
 		return res
 
 config.default("downsample_method", "fft", "Method to use when downsampling the TOD")
+config.default("scan_mmap", True, "Whether H5Scan should memory-map the tod when the file layout allows it, so that only the selected detectors and samples are read.")
 class H5Scan(Scan):
-	def __init__(self, fname):
+	def __init__(self, fname, mmap=None):
 		self.fname = fname
+		self.mmap  = config.get("scan_mmap", mmap)
 		with h5py.File(fname, "r") as hfile:
 			for k in ["boresight","offsets","comps","sys","mjd0","dets"]:
-				setattr(self, k, hfile[k].value)
+				setattr(self, k, hfile[k][()])
 			n = self.boresight.shape[0]
-			ranges, detmap, nsamp = [hfile["cut/%s" % name].value for name in ["ranges","detmap","nsamp"]]
+			ranges, detmap, nsamp = [hfile["cut/%s" % name][()] for name in ["ranges","detmap","nsamp"]]
 			self.cut  = sampcut.Sampcut(ranges, detmap, nsamp)
 			self.cut_noiseest = self.cut.copy()
 			self.noise= nmat.read_nmat(hfile, "noise")
-			self.site = bunch.Bunch({k:hfile["site/"+k].value for k in hfile["site"]})
+			self.site = bunch.Bunch({k:hfile["site/"+k][()] for k in hfile["site"]})
 			self.subdets = np.arange(self.ndet)
 			self.hwp = np.zeros(n)
 			self.hwp_phase = np.zeros([n,2])
@@ -159,16 +161,41 @@ class H5Scan(Scan):
 			self.entry = bunch.Bunch(id=self.id)
 	def get_samples(self, verbose=False):
 		"""Return the actual detector samples. Slow! Data is read from disk,
-		so store the result if you need to reuse it."""
-		with h5py.File(self.fname, "r") as hfile:
-			tod = hfile["tod"].value[self.subdets]
+		so store the result if you need to reuse it. If the tod can be
+		memory-mapped, only the selected detectors are read, and leading
+		sample slices without downsampling are applied before reading."""
+		sampslices = self.sampslices
+		tod = open_tod_mmap(self.fname) if self.mmap else None
+		if tod is not None:
+			while len(sampslices) > 0 and np.abs(sampslices[0].step or 1) == 1:
+				tod = tod[:,sampslices[0]]
+				sampslices = sampslices[1:]
+			tod = tod[self.subdets]
+		else:
+			tod = read_tod(self.fname)[self.subdets]
 		method = config.get("downsample_method")
-		for s in self.sampslices:
+		for s in sampslices:
 			tod = resample.resample(tod, 1.0/np.abs(s.step or 1), method=method)
 			s = slice(s.start, s.stop, np.sign(s.step) if s.step else None)
 			tod = tod[:,s]
 		res = np.ascontiguousarray(tod)
 		return res
+	def get_samples_view(self):
+		"""Return a read-only view of the detector samples in the memory-mapped
+		tod, without reading anything. This requires the tod to be memory-mappable,
+		the detector selection to be regularly spaced and no downsampling to have
+		been applied, and memory-mapping to be enabled. Returns None if this is
+		not the case."""
+		if not self.mmap: return None
+		if any([np.abs(s.step or 1) != 1 for s in self.sampslices]): return None
+		detslice = inds2slice(self.subdets)
+		if detslice is None: return None
+		tod = open_tod_mmap(self.fname)
+		if tod is None: return None
+		tod = tod[detslice]
+		for s in self.sampslices:
+			tod = tod[:,s]
+		return tod
 	def __repr__(self):
 		return self.__class__.__name__ + "[ndet=%d,nsamp=%d,name=%s]" % (self.ndet,self.nsamp,self.fname)
 	def __getitem__(self, sel):
@@ -177,7 +204,52 @@ class H5Scan(Scan):
 		res.subdets = res.subdets[detslice]
 		return res
 
-def write_scan(fname, scan):
+def get_tod_file(fname, hfile):
+	"""Return the path of the sidecar .npy file holding the tod of the scan
+	file fname, with open hdf file hfile, or None if the tod is stored in
+	the hdf file itself."""
+	if "tod_file" not in hfile.attrs: return None
+	return os.path.join(os.path.dirname(fname), hfile.attrs["tod_file"])
+
+def read_tod(fname):
+	"""Read the whole tod of the scan file fname into memory, wherever it is stored."""
+	with h5py.File(fname, "r") as hfile:
+		tname = get_tod_file(fname, hfile)
+		if tname is not None: return np.load(tname)
+		return hfile["tod"][()]
+
+def open_tod_mmap(fname):
+	"""Return a read-only memory map of the tod in the scan file fname, or None
+	if the tod is not stored in a way that allows this. This is the case for
+	tods written to a sidecar .npy file, and for tods stored as contiguous,
+	unfiltered hdf datasets, which is the default layout in write_scan."""
+	with h5py.File(fname, "r") as hfile:
+		tname = get_tod_file(fname, hfile)
+		if tname is not None: return np.load(tname, mmap_mode="r")
+		dset = hfile["tod"]
+		if dset.chunks is not None or dset.compression is not None or not dset.dtype.isnative:
+			return None
+		offset = dset.id.get_offset()
+		if offset is None: return None
+		dtype, shape = dset.dtype, dset.shape
+	return np.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+def inds2slice(inds):
+	"""Return a slice equivalent to indexing with the integer array inds,
+	or None if inds is not regularly spaced."""
+	inds = np.asarray(inds)
+	if len(inds) == 0: return None
+	if len(inds) == 1: return slice(inds[0], inds[0]+1)
+	step = inds[1]-inds[0]
+	if step == 0 or np.any(inds[1:]-inds[:-1] != step): return None
+	stop = inds[-1]+step
+	return slice(inds[0], stop if stop >= 0 else None, step)
+
+def write_scan(fname, scan, sidecar=False):
+	"""Write scan to the hdf file fname. The tod is written as a contiguous,
+	unfiltered dataset, which H5Scan can memory-map. If sidecar is True, it
+	is instead written to a .npy file next to fname, which keeps the hdf file
+	small and works even where the hdf library would add filters."""
 	with h5py.File(fname, "w") as hfile:
 		for k in ["boresight","offsets","comps","sys","mjd0","dets"]:
 			hfile[k] = getattr(scan, k)
@@ -189,7 +261,13 @@ def write_scan(fname, scan):
 		nmat.write_nmat(hfile.create_group("noise"), scan.noise)
 		for k in scan.site:
 			hfile["site/"+k] = scan.site[k]
-		hfile["tod"]       = scan.get_samples()
+		tod = scan.get_samples()
+		if sidecar:
+			tname = os.path.splitext(fname)[0] + ".tod.npy"
+			np.save(tname, tod)
+			hfile.attrs["tod_file"] = os.path.basename(tname)
+		else:
+			hfile.create_dataset("tod", data=tod, chunks=None)
 
 def read_scan(fname):
 	return H5Scan(fname)
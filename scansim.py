@@ -1,6 +1,6 @@
 from __future__ import division, print_function
 import numpy as np, copy, warnings
-from . import scan, coordinates, utils, nmat, pmat, array_ops, enmap, bunch, sampcut
+from . import scan, coordinates, utils, nmat, pmat, array_ops, enmap, bunch, sampcut, config
 from scipy import ndimage
 warnings.filterwarnings("ignore")
 
@@ -54,7 +54,7 @@ def oneoverf_detcorr_noise(ndet, nsamp, sigma, fknee=0.2, alpha=1):
 	Nu    = np.zeros([nbin,ndet])+sigma**2
 	E     = (freq/fknee)**-alpha * sigma**2
 	V     = np.zeros([nbin,ndet])+1
-	ebins = build_bins_linear(nbin,nbin)
+	ebins = build_bins_linear(nbin,nbin).astype(int)
 	return nmat.NmatDetvecs(Nu, V, E, bins, ebins)
 
 def scan_ceslike(nsamp, box, mjd0=55500, sys="hor", srate=100, azrate=1.5*utils.degree):
@@ -106,6 +106,25 @@ def dets_scattered(nmul, nper=3, rad=0.5*np.pi/180, seed=0):
 def nocut(ndet, nsamp):
 	return sampcut.empty(ndet, nsamp)
 
+def sim_test_scans(nscan=1, ndet=10, nsamp=4000, res=5*utils.arcmin, seed=0):
+	"""Build nscan small simulated ces scans with 3*ndet detectors, 1/f noise
+	and some cuts, and an equatorial [3,ny,nx] map covering them at resolution
+	res, for the module tests. Returns scans, area."""
+	box   = np.array([[150,40],[152,41]])*utils.degree
+	scans = []
+	for i in range(nscan):
+		pat  = scan_ceslike(nsamp, box, mjd0=55500+i*0.002)
+		dets = dets_scattered(ndet, seed=seed+i)
+		sc   = SimPlain(pat, dets, oneoverf_noise(len(dets.comps), nsamp, 1.0))
+		mask = np.zeros((sc.ndet,sc.nsamp),bool)
+		mask[::3,nsamp//4:nsamp//3] = True
+		sc.cut = sampcut.from_mask(mask)
+		sc.id  = "sim%d" % i
+		sc.hwp = None
+		scans.append(sc)
+	shape, wcs = enmap.geometry(pos=np.array([[-62,24],[-58,16]])*utils.degree, res=res)
+	return scans, enmap.zeros((3,)+shape, wcs)
+
 class SimPlain(scan.Scan):
 	def __init__(self, scanpattern, dets, noise, simsys="equ", cache=False, seed=0, noise_scale=1):
 		# Set up the telescope
@@ -165,14 +184,18 @@ class SimSrcs(SimPlain):
 			return self._tod.copy()
 		tod = SimPlain.get_samples(self)
 		tod = tod.astype(np.float64)
-		# And add the point sources
-		for di in range(self.ndet):
-			for i, (pos,amp,beam) in enumerate(zip(self.srcs.pos,self.srcs.amps,self.srcs.beam)):
-				point = (self.boresight+self.offsets[di,None,:])[:,1:]
-				point = coordinates.transform(self.sys, self.simsys, point.T, time=self.boresight[:,0]+self.mjd0, site=self.site).T
-				r2 = np.sum((point-pos[None,:])**2,1)/beam**2
-				I  = np.where(r2 < self.nsigma**2)[0]
-				tod[di,I] += np.exp(-0.5*r2[I])*np.sum(amp*self.comps[di])
+		# And add the point sources. The pointing is computed for a block of
+		# detectors at a time, to share work without using too much memory
+		dblock = max(1, int(config.get("transform_dets_bsize"))//self.nsamp)
+		for d1 in range(0, self.ndet, dblock):
+			d2     = min(d1+dblock, self.ndet)
+			points = coordinates.transform_dets(self.sys, self.simsys, self.boresight[:,1:].T, self.offsets[d1:d2,1:], time=self.boresight[:,0]+self.mjd0, site=self.site, pol=False)
+			for di in range(d1, d2):
+				point = points[:,di-d1].T
+				for i, (pos,amp,beam) in enumerate(zip(self.srcs.pos,self.srcs.amps,self.srcs.beam)):
+					r2 = np.sum((point-pos[None,:])**2,1)/beam**2
+					I  = np.where(r2 < self.nsigma**2)[0]
+					tod[di,I] += np.exp(-0.5*r2[I])*np.sum(amp*self.comps[di])
 		if hasattr(self, "_tod"):
 			self._tod = tod.copy()
 		return tod
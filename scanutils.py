@@ -1,9 +1,12 @@
 from __future__ import division, print_function
-import numpy as np, logging, h5py, sys
-from . import scan as enscan, errors, utils, coordinates, dmap
+import numpy as np, logging, h5py, sys, threading, collections, os
+from . import scan as enscan, errors, utils, coordinates, dmap, config, bunch
 from enact import actdata, filedb
 L = logging.getLogger(__name__)
 
+config.default("scan_prefetch", 0, "Number of scans scan_iterator reads ahead in a background thread. 0 disables prefetching.")
+config.default("scan_prefetch_mem", 4.0, "Max GB of scans scan_iterator keeps in its prefetch queue.")
+
 try: basestring
 except: basestring = str
 
@@ -11,7 +14,7 @@ def calc_sky_bbox_scan(scan, osys, nsamp=100):
 	"""Compute the bounding box of the scan in the osys coordinate system.
 	Returns [{from,to},{dec,ra}]."""
 	ipoints = utils.box2contour(scan.box, nsamp)
-	opoints = np.array([coordinates.transform(scan.sys,osys,b[1:,None],time=scan.mjd0+b[0,None]/3600/24,site=scan.site)[::-1,0] for b in ipoints])
+	opoints = coordinates.transform(scan.sys,osys,ipoints[:,1:].T,time=scan.mjd0+ipoints[:,0]/3600/24,site=scan.site)[1::-1].T
 	# Take care of angle wrapping along the ra direction
 	opoints[...,1] = utils.rewind(opoints[...,1], ref="auto")
 	obox = utils.bounding_box(opoints)
@@ -74,6 +77,119 @@ def distribute_scans2(inds, costs, comm, boxes=None):
 		mybbox = [utils.bounding_box([boxes[i] for i in group]) if len(group) > 0 else boxes[0] for group in mygroups]
 		return myinds, mysubs, mybbox
 
+def scan_cost_features(scan):
+	"""Returns the properties of scan that ScanCostModel predicts its cost from:
+	[ndet*nsamp, ndet*nsamp*log2(nsamp), ncut_range, ndet*nbin]. These roughly
+	track the pointing and projection, the noise model ffts, the cut handling
+	and the binned noise model application respectively."""
+	ntot = scan.ndet*scan.nsamp
+	try: ncut = scan.cut.nrange
+	except AttributeError: ncut = 0
+	try: nbin = len(scan.noise.bins)
+	except (AttributeError, TypeError): nbin = 0
+	return np.array([ntot, ntot*np.log2(max(scan.nsamp,2)), ncut, scan.ndet*nbin], float)
+
+class ScanCostModel:
+	"""Predicts how long Eqsys.A takes for each scan. Scans we have timings for
+	(see Eqsys.scan_times, which only the serial scan loop measures) use their
+	measured cost directly, while other scans get a nonnegative linear fit in
+	scan_cost_features to the measured ones.
+	Without any measurements ndet*nsamp is used, like the costs passed to
+	distribute_scans usually are.
+
+	The measurements can be written to and read from a file of [id cost]
+	lines, meant to be kept next to the scan list, so later runs can start
+	out balanced."""
+	def __init__(self, measured=None):
+		self.measured = dict(measured) if measured is not None else {}
+		self.weights  = None
+	def update(self, times):
+		"""Add the measured costs in the {id: seconds} dict times."""
+		self.measured.update(times)
+	def fit(self, scans, comm=None):
+		"""Fit the model weights to the measured costs of the given scans.
+		If comm is passed, scans are the local scans of each task, and the fit
+		uses all of them."""
+		used  = [scan for scan in scans if scan.id in self.measured]
+		feats = np.array([scan_cost_features(scan) for scan in used]).reshape(-1,4)
+		times = np.array([self.measured[scan.id] for scan in used])
+		if comm is not None:
+			feats = utils.allgatherv(feats, comm)
+			times = utils.allgatherv(times, comm)
+		if len(times) == 0: return self
+		# Normalize the features to make the fit better conditioned
+		norm  = np.max(np.abs(feats),0)
+		norm[norm==0] = 1
+		from scipy import optimize
+		weights, _ = optimize.nnls(feats/norm, times)
+		self.weights = weights/norm
+		return self
+	def predict(self, scans):
+		"""Returns the predicted cost of each of the given scans."""
+		costs = np.zeros(len(scans))
+		for i, scan in enumerate(scans):
+			if scan.id in self.measured:   costs[i] = self.measured[scan.id]
+			elif self.weights is not None: costs[i] = scan_cost_features(scan).dot(self.weights)
+			else:                          costs[i] = scan.ndet*scan.nsamp
+		return costs
+	def write(self, fname, comm=None):
+		"""Write the measured costs to fname. If comm is passed, the measurements
+		of all tasks are merged and written by the first one."""
+		measured = self.measured
+		if comm is not None:
+			measured = {}
+			for part in comm.allgather(self.measured): measured.update(part)
+			if comm.rank != 0: return
+		with open(fname, "w") as f:
+			for id in sorted(measured):
+				f.write("%s %10.5f\n" % (id, measured[id]))
+	@classmethod
+	def read(cls, fname):
+		"""Construct a model from the measured costs in fname."""
+		measured = {}
+		with open(fname, "r") as f:
+			for line in f:
+				toks = line.split()
+				if len(toks) < 2 or line.startswith("#"): continue
+				measured[toks[0]] = float(toks[1])
+		return cls(measured)
+
+def rebalance_scans(myinds, myscans, mycosts, myboxes, comm, tol=0.1):
+	"""Given our scans, their indices into the global scan list, their
+	predicted costs (for example from ScanCostModel.predict) and their bounding
+	boxes[nmyscan,2,2], redistribute the scans between tasks to even out the
+	costs while keeping each task's scans local on the sky, like distribute_scans2
+	does. Nothing is done unless the most loaded task has more than (1+tol) times
+	the mean load, and the new distribution is predicted to be better.
+
+	Returns None if nothing was done, and otherwise the new myinds, myscans,
+	mysubs and mybbox, with the scan objects moved to their new tasks. Anything
+	built from the old distribution, such as the signals' workspaces and
+	the Eqsys itself, must be rebuilt by the caller."""
+	loads = np.array(comm.allgather(np.sum(mycosts)))
+	if np.max(loads) <= (1+tol)*np.mean(loads): return None
+	all_inds  = utils.allgatherv(np.array(myinds,int), comm)
+	all_costs = utils.allgatherv(np.array(mycosts,float), comm)
+	all_boxes = utils.allgatherv(np.array(myboxes,float).reshape(-1,2,2), comm)
+	newinds, mysubs, mybbox = distribute_scans2(all_inds, all_costs, comm, boxes=all_boxes)
+	cost_of  = dict(zip(all_inds, all_costs))
+	newloads = np.array(comm.allgather(np.sum([cost_of[i] for i in newinds])))
+	if np.max(newloads) >= np.max(loads): return None
+	return newinds, migrate_scans(myinds, myscans, newinds, comm), mysubs, mybbox
+
+def migrate_scans(myinds, myscans, newinds, comm):
+	"""Move scan objects between tasks. myscans are our current scans, with
+	indices myinds into the global scan list, and newinds are the indices of
+	the scans we should have afterwards. Returns our new list of scans."""
+	owner = {}
+	for rank, inds in enumerate(comm.allgather(list(newinds))):
+		for ind in inds: owner[ind] = rank
+	send = [[] for i in range(comm.size)]
+	for ind, scan in zip(myinds, myscans):
+		send[owner[ind]].append((ind, scan))
+	got = {ind: scan for part in comm.alltoall(send) for ind, scan in part}
+	return [got[ind] for ind in newinds]
+
 def get_scan_bounds(myscans, ref=0):
 	bounds = np.array([[np.min(scan.boresight[:,2:0:-1],0),np.max(scan.boresight[:,2:0:-1],0)] for scan in myscans])
 	# Resolve az wrap, assuming no scans crossing straight north or south. We also make
@@ -99,46 +215,133 @@ def classify_scanning_patterns(myscans, tol=0.5*utils.degree, comm=None):
 		pids = pids[rank==comm.rank]
 	return pboxes, pids
 
-def scan_iterator(filelist, inds, reader, db=None, dets=None, quiet=False, downsample=1, hwp_resample=False):
+def scan_iterator(filelist, inds, reader, db=None, dets=None, quiet=False, downsample=1, hwp_resample=False, prefetch=None, prefetch_mem=None):
 	"""Given a set of ids/files and a set of indices into that list. Try
-	to read each of these scans. Returns a list of successfully read scans
-	and a list of their indices."""
-	for ind in inds:
+	to read each of these scans. Yields (ind, scan) for each successfully
+	read scan. If prefetch > 0, reading happens in a background thread that
+	stays up to prefetch scans ahead of the consumer, but never queues more
+	than prefetch_mem GB of scans. Prefetching is opt-in, through the
+	prefetch argument or the scan_prefetch config setting."""
+	prefetch     = config.get("scan_prefetch", prefetch)
+	prefetch_mem = config.get("scan_prefetch_mem", prefetch_mem)
+	entries      = lookup_entries(db, filelist, inds)
+	def read(ind):
+		return read_scan_single(filelist, ind, reader, db=db, dets=dets, quiet=quiet, downsample=downsample, hwp_resample=hwp_resample, entry=entries.get(ind))
+	if prefetch > 0:
+		work = prefetch_iterator(read, inds, depth=prefetch, maxmem=prefetch_mem*1024**3, nbytes=scan_nbytes)
+	else:
+		work = ((ind, read(ind)) for ind in inds)
+	for ind, d in work:
+		if d is not None: yield ind, d
+
+def lookup_entries(db, filelist, inds):
+	"""Look up the db entries of the ids filelist[inds] in one go, if db supports
+	that (see filedb.FormatDB.query_many). Returns {ind:entry}, which omits files
+	and anything that could not be looked up, so these are left to db[id]."""
+	inds = [ind for ind in inds if isinstance(filelist[ind],basestring) and not os.path.exists(filelist[ind])]
+	if db is None or not hasattr(db, "query_many") or len(inds) == 0: return {}
+	# If any id fails, let db[id] report it for that id only when it's reached
+	try: cols = db.query_many([filelist[ind] for ind in inds])
+	except Exception: return {}
+	res = {}
+	for i, ind in enumerate(inds):
+		res[ind] = bunch.Bunch({name: col[i] for name, col in cols.items() if col[i] is not None or name in ["id","tag"]})
+	return res
+
+def read_scan_single(filelist, ind, reader, db=None, dets=None, quiet=False, downsample=1, hwp_resample=False, entry=None):
+	"""Read, detector-select and downsample the scan filelist[ind]. Returns None
+	if the scan has no usable data. If the db entry for filelist[ind] has already
+	been looked up, it can be passed as entry."""
+	try:
+		if not isinstance(filelist[ind],basestring): raise IOError
+		d = enscan.read_scan(filelist[ind])
+		#actdata.read(filedb.data[filelist[ind]])
+	except (IOError, OSError):
+		try:
+			if entry is None: entry = db[filelist[ind]]
+			d = reader(entry)
+			if d.ndet == 0 or d.nsamp == 0:
+				raise errors.DataMissing("Tod contains no valid data")
+		except errors.DataMissing as e:
+			if not quiet: L.debug("Skipped %s (%s)" % (str(filelist[ind]), e.args[0]))
+			return None
+	if dets:
+		if dets.startswith("@"):
+			uids = [int(line.split()[0]) for line in open(dets[1:],"r")]
+			_, duids = actdata.split_detname(d.dets)
+			_,det_inds = utils.common_inds([uids,duids])
+			d = d[det_inds]
+		else:
+			d = eval("d[%s]" % dets)
+	hwp_active = np.any(d.hwp_phase[0] != 0)
+	if hwp_resample and hwp_active:
+		mapping = enscan.build_hwp_sample_mapping(d.hwp)
+		d = d.resample(mapping)
+	d = d[:,::downsample]
+	if not quiet: L.debug("Read %s" % str(filelist[ind]))
+	return d
+
+def scan_nbytes(d):
+	"""Approximate memory use of scan d, counting its array members."""
+	if d is None: return 0
+	return sum([v.nbytes for v in vars(d).values() if isinstance(v, np.ndarray)])
+
+def prefetch_iterator(func, items, depth=1, maxmem=np.inf, nbytes=None):
+	"""Yields (item, func(item)) for each item in items, in order, while
+	evaluating func for the following items in a background thread. At most
+	depth results are kept waiting, and no new evaluation is started while
+	the waiting results take up maxmem bytes or more, as measured by nbytes.
+	Exceptions in func are reraised in the caller when their item is reached.
+	If the caller stops early, the background thread is stopped too, after
+	finishing the evaluation it is busy with."""
+	cond  = threading.Condition()
+	queue = collections.deque()
+	state = {"mem": 0, "done": False, "stop": False}
+	def worker():
 		try:
-			if not isinstance(filelist[ind],basestring): raise IOError
-			d = enscan.read_scan(filelist[ind])
-			#actdata.read(filedb.data[filelist[ind]])
-		except (IOError, OSError):
-			try:
-				entry = db[filelist[ind]]
-				d = reader(entry)
-				if d.ndet == 0 or d.nsamp == 0:
-					raise errors.DataMissing("Tod contains no valid data")
-			except errors.DataMissing as e:
-				if not quiet: L.debug("Skipped %s (%s)" % (str(filelist[ind]), e.args[0]))
-				continue
-		if dets:
-			if dets.startswith("@"):
-				uids = [int(line.split()[0]) for line in open(dets[1:],"r")]
-				_, duids = actdata.split_detname(d.dets)
-				_,det_inds = utils.common_inds([uids,duids])
-				d = d[det_inds]
-			else:
-				d = eval("d[%s]" % dets)
-		hwp_active = np.any(d.hwp_phase[0] != 0)
-		if hwp_resample and hwp_active:
-			mapping = enscan.build_hwp_sample_mapping(d.hwp)
-			d = d.resample(mapping)
-		d = d[:,::downsample]
-		if not quiet: L.debug("Read %s" % str(filelist[ind]))
-		yield ind, d
-
-def read_scans(filelist, inds, reader, db=None, dets=None, quiet=False, downsample=1, hwp_resample=False):
+			for item in items:
+				with cond:
+					while not state["stop"] and len(queue) > 0 and (len(queue) >= depth or state["mem"] >= maxmem):
+						cond.wait()
+					if state["stop"]: return
+				try: res, error = func(item), None
+				except Exception as e: res, error = None, e
+				size = nbytes(res) if nbytes is not None else 0
+				with cond:
+					queue.append((item, res, error, size))
+					state["mem"] += size
+					cond.notify_all()
+				if error is not None: return
+		finally:
+			with cond:
+				state["done"] = True
+				cond.notify_all()
+	thread = threading.Thread(target=worker)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			with cond:
+				while len(queue) == 0 and not state["done"]:
+					cond.wait()
+				if len(queue) == 0: break
+				item, res, error, size = queue.popleft()
+				state["mem"] -= size
+				cond.notify_all()
+			if error is not None: raise error
+			yield item, res
+	finally:
+		with cond:
+			state["stop"] = True
+			cond.notify_all()
+		thread.join()
+
+def read_scans(filelist, inds, reader, db=None, dets=None, quiet=False, downsample=1, hwp_resample=False, prefetch=None, prefetch_mem=None):
 	"""Given a set of ids/files and a set of indices into that list. Try
 	to read each of these scans. Returns a list of successfully read scans
 	and a list of their indices."""
 	myinds, myscans  = [], []
-	for ind, scan in scan_iterator(filelist, inds, reader, db=db, dets=dets, quiet=quiet, downsample=downsample, hwp_resample=hwp_resample):
+	for ind, scan in scan_iterator(filelist, inds, reader, db=db, dets=dets, quiet=quiet, downsample=downsample, hwp_resample=hwp_resample, prefetch=prefetch, prefetch_mem=prefetch_mem):
 		myinds.append(ind)
 		myscans.append(scan)
 	return myinds, myscans
@@ -157,3 +360,47 @@ def get_tod_groups(ids, samelen=True):
 		nsub = np.max(np.bincount(labels))
 		groups = [g for g in groups if len(g) == nsub]
 	return groups
+
+def prefetch_iterator_test():
+	"""Check that prefetch_iterator keeps the order, respects its depth and
+	memory limits, reraises errors and stops its thread when abandoned."""
+	import time
+	counts = {"eval": 0}
+	def func(i):
+		time.sleep(0.002)
+		if i == 7: raise ValueError("bad item")
+		counts["eval"] += 1
+		return np.zeros(i+1)
+	# Order, and the depth limit. The number of results evaluated beyond the
+	# ones we have received can't exceed depth
+	counts["eval"] = 0
+	res = []
+	for i, r in prefetch_iterator(func, range(7), depth=2):
+		assert counts["eval"] - (len(res)+1) <= 2
+		res.append((i, len(r)))
+		time.sleep(0.005)
+	assert res == [(i, i+1) for i in range(7)]
+	# The memory limit. Each result takes 100 bytes here, so at most 3 can be queued
+	counts["eval"] = 0
+	for n, (i, r) in enumerate(prefetch_iterator(func, range(7), depth=10, maxmem=250, nbytes=lambda r: 100)):
+		assert counts["eval"] - (n+1) <= 3
+		time.sleep(0.005)
+	# Errors are raised when their item is reached
+	res = []
+	try:
+		for i, r in prefetch_iterator(func, range(10), depth=3): res.append(i)
+	except ValueError: pass
+	else: raise AssertionError("error in func was not raised")
+	assert res == list(range(7))
+	# Stopping early stops the background thread
+	counts["eval"] = 0
+	nthread = threading.active_count()
+	work = prefetch_iterator(func, range(100), depth=2)
+	for i, r in work:
+		if i == 2: break
+	work.close()
+	assert threading.active_count() == nthread
+	n = counts["eval"]
+	assert n <= 3+2+1
+	time.sleep(0.02)
+	assert counts["eval"] == n
@@ -4,11 +4,18 @@ For example query("deep56,night,ar2,in(bounds,Moon)") woult return a
 set of ids with the tags deep56, night and ar2, and where th Moon[2]
 array is in the polygon specified by the bounds [:,2] array."""
 from __future__ import division, print_function
-import re, numpy as np, h5py, shlex, copy, warnings, time, os
-from . import utils
+import re, numpy as np, h5py, shlex, copy, warnings, time, os, ast, json, hashlib
+from . import utils, bunch, config
+
+config.default("tagdb_cache_dir", "", "Directory to keep the binary caches of text tag databases in. Empty to keep each one next to its top-level tag file.")
 
 try: basestring
 except: basestring = str
+try: from collections.abc import Mapping
+except ImportError: from collections import Mapping
+
+# The base scope queries are evaluated in
+np_scope = np.__dict__.copy()
 
 class Tagdb:
 	def __init__(self, data=None, sort="id", default_fields=[], default_query=""):
@@ -65,28 +72,71 @@ class Tagdb:
 			res = self.copy()
 			res.data = odata
 			return res
-	def query(self, query=None, apply_default_query=True):
+	def query(self, query=None, apply_default_query=True, comm=None):
 		"""Query the database. The query takes the form
 		tag,tag,tag,...:sort[slice], where all tags must be satisfied for an id to
 		be returned. More general syntax is also available. For example,
 		(a+b>c)|foo&bar,cow. This follows standard python and numpy syntax,
-		except that , is treated as a lower-priority version of &."""
-		# Make a copy of self.data so we can't modify it without changing ourself
-		data = self.data.copy()
+		except that , is treated as a lower-priority version of &.
+
+		The query is parsed once and the result cached (see compile_query).
+		If comm is passed, the query is only evaluated on the first task,
+		and the resulting ids are broadcast to the others."""
+		if comm is not None:
+			res = None
+			if comm.rank == 0:
+				try: res = self.query(query, apply_default_query=apply_default_query)
+				except Exception as e: res = e
+			res = comm.bcast(res)
+			if isinstance(res, Exception): raise res
+			return res
+		plan = self.compile_query(query, apply_default_query=apply_default_query)
+		if plan.override_file is not None:
+			return load_ids(plan.override_file)
+		# Evaluate our fields one by one. This is done so that function
+		# fields can inspect the current state at that point. Only the
+		# fields and functors a field refers to are set up for it.
+		data = QueryData(self.data)
+		for code, names in plan.fields:
+			scope = np_scope.copy()
+			for name in names:
+				if name in self.functors: scope[name] = self.functors[name](data)
+				elif name in data:        scope[name] = data[name]
+			with utils.nowarn():
+				hits = eval(code, scope)
+			# Restrict all fields to the result
+			data = data.restrict(hits)
+		if plan.sort:
+			# Evaluate sorting field
+			field = data[plan.sort]
+			field = eval("field" + plan.fsel)
+			data  = data.restrict(np.argsort(field))
+		# Finally apply the data slice
+		inds = np.arange(data.nrow)
+		inds = eval("inds" + plan.dsel)
+		data = data.restrict(inds)
+		return data["id"]
+	def compile_query(self, query=None, apply_default_query=True):
+		"""Parse a query into a plan for evaluating it, with the fields compiled
+		and the names they refer to found. Plans are cached by query string
+		until our ids change."""
+		if query is None: query = ""
+		ids = self.data["id"]
+		if getattr(self, "query_cache_ids", None) is not ids:
+			self.query_cache, self.query_cache_ids, self.id_index = {}, ids, None
+		key = (query, apply_default_query, self.default_query, self.sort)
+		if key in self.query_cache: return self.query_cache[key]
 		# Hack: Support id fields as tags, even if they contain
 		# illegal characters..
-		t1 = time.time()
-		if query is None: query = ""
-		for id in data["id"]:
-			if id not in query: continue
-			query = re.sub(r"""(?<!['"])\b%s\b""" % id, "(id=='%s')" % id, query)
+		if self.id_index is None: self.id_index = build_id_index(ids)
+		query = substitute_ids(query, self.id_index)
 		# Split off any sorting field or slice
 		toks = utils.split_outside(query,":")
 		query, rest = toks[0], ":".join(toks[1:])
 		# Split into ,-separated fields.
 		toks = utils.split_outside(query,",")
 		fields = []
-		override_ids = None
+		override_file = None
 		for tok in toks:
 			# We don't support subid tags any more. These were used to handle both
 			# frequency selection and arbitrary array subsets. We now handle frequency
@@ -103,7 +153,7 @@ class Tagdb:
 				# Normal field. Perform a few convenience transformations first.
 				if tok.startswith("@@"):
 					# Hack. *Force* the given ids to be returned, even if they aren't in the database.
-					override_ids = load_ids(tok[2:])
+					override_file = tok[2:]
 					continue
 				elif tok.startswith("@"):
 					# Restrict dataset to those in the given file
@@ -111,40 +161,21 @@ class Tagdb:
 				elif tok.startswith("~@"):
 					tok = "~file_contains('%s',id)" % tok[2:]
 				fields.append(tok)
-		if override_ids is not None:
-			return override_ids
 		# Apply our default queries here. These are things that we almost always
 		# want in our queries, and that it's tedious to have to specify manually
 		# each time. For example, this would be "selected" for act todinfo queries
 		if apply_default_query:
-			fields = fields + utils.split_outside(self.default_query,",")
-		# Now evaluate our fields one by one. This is done so that
-		# function fields can inspect the current state at that point
-		for field in fields:
-			scope = np.__dict__.copy()
-			scope.update(data)
-			for name, functor in self.functors.items():
-				scope[name] = functor(data)
-			with utils.nowarn():
-				hits = eval(field, scope)
-			# Restrict all fields to the result
-			data = dslice(data, hits)
+			fields = fields + [field for field in utils.split_outside(self.default_query,",") if field]
+		fields = [(compile(field, "<query>", "eval"), field_names(field)) for field in fields]
 		# Split the rest into a sorting field and a slice
 		toks = rest.split("[")
 		if   len(toks) == 1: sort, fsel, dsel = toks[0], "", ""
 		elif len(toks) == 2: sort, fsel, dsel = toks[0], "", "["+toks[1]
 		else: sort, fsel, dsel = toks[0], "["+toks[1], "["+"[".join(toks[2:])
 		if self.sort and not sort: sort = self.sort
-		if sort:
-			# Evaluate sorting field
-			field = data[sort]
-			field = eval("field" + fsel)
-			data  = dslice(data, np.argsort(field))
-		# Finally apply the data slice
-		inds = np.arange(len(data["id"]))
-		inds = eval("inds" + dsel)
-		data = dslice(data, inds)
-		return data["id"]
+		plan = bunch.Bunch(fields=fields, sort=sort, fsel=fsel, dsel=dsel, override_file=override_file)
+		self.query_cache[key] = plan
+		return plan
 	def __add__(self, other):
 		"""Produce a new tagdb which contains the union of the
 		tag info from each."""
@@ -154,26 +185,45 @@ class Tagdb:
 	def write(self, fname, type=None):
 		write(fname, self, type=type)
 	@classmethod
-	def read(cls, fname, type=None, vars={}):
+	def read(cls, fname, type=None, vars={}, comm=None):
 		"""Read a Tagdb from in either the hdf or text format. This is
-		chosen automatically based on the file extension."""
+		chosen automatically based on the file extension. See read_txt
+		for the meaning of comm."""
 		if type is None:
 			if fname.endswith(".hdf"): type = "hdf"
 			else: type = "txt"
-		if type == "txt":   return cls.read_txt(fname, vars=vars)
+		if type == "txt":   return cls.read_txt(fname, vars=vars, comm=comm)
 		elif type == "hdf": return cls.read_hdf(fname)
 		else: raise ValueError("Unknown Tagdb file type: %s" % fname)
 	@classmethod
-	def read_txt(cls, fname, vars={}):
-		"""Read a Tagdb from text files. Only supports boolean tags."""
+	def read_txt(cls, fname, vars={}, cache=True, comm=None):
+		"""Read a Tagdb from text files. Only supports boolean tags.
+		If cache is True, the result is also stored in a binary cache file
+		(see tag_cache_name), which is used instead of the text files as long
+		as none of them have changed. With cache="read" an existing cache is
+		used, but not written. If comm is passed, only its first task writes
+		the cache, and the others wait for it and then read the cache."""
+		if cache and comm is not None:
+			if comm.rank == 0: res = cls.read_txt(fname, vars=vars, cache=True)
+			comm.Barrier()
+			if comm.rank != 0: res = cls.read_txt(fname, vars=vars, cache="read")
+			return res
+		entries = parse_tagfile_top(fname, vars=vars)
+		if cache:
+			cname = tag_cache_name(fname)
+			stamp = tag_cache_stamp(entries)
+			data  = read_tag_cache(cname, stamp)
+			if data is not None: return cls(data)
 		datas = []
-		for subfile, tags in parse_tagfile_top(fname, vars=vars):
-			ids = parse_tagfile_idlist(subfile)
+		for subfile, tags in entries:
+			ids = np.array(parse_tagfile_idlist(subfile))
 			data = {"id":ids}
 			for tag in tags:
 				data[tag] = np.full(len(ids), True, dtype=bool)
 			datas.append(data)
-		return cls(merge(datas))
+		data = merge(datas)
+		if cache and cache != "read": write_tag_cache(cname, data, stamp)
+		return cls(data)
 	@classmethod
 	def read_hdf(cls, fname):
 		"""Read a Tagdb from an hdf file."""
@@ -200,6 +250,62 @@ class Tagdb:
 def dslice(data, inds):
 	return {key:val[...,inds] for key, val in data.items()}
 
+class QueryData(Mapping):
+	"""A read-only view of the rows inds of a tagdb data dict. Fields are
+	only sliced when they are looked up, and are then kept."""
+	def __init__(self, data, inds=None):
+		self.data, self.inds, self.cache = data, inds, {}
+	def __getitem__(self, key):
+		if key not in self.cache:
+			val = self.data[key]
+			self.cache[key] = val if self.inds is None else val[...,self.inds]
+		return self.cache[key]
+	def __iter__(self): return iter(self.data)
+	def __len__(self): return len(self.data)
+	def __contains__(self, key): return key in self.data
+	def copy(self): return {key: self[key] for key in self}
+	@property
+	def nrow(self): return len(self.data["id"]) if self.inds is None else len(self.inds)
+	def restrict(self, hits):
+		"""Returns a view of only the rows selected by hits, which can be
+		anything that can index the last axis of a field."""
+		inds = np.arange(self.nrow) if self.inds is None else self.inds
+		return QueryData(self.data, inds[hits])
+
+def field_names(field):
+	"""Returns the names the query field expression refers to."""
+	return sorted(set([node.id for node in ast.walk(ast.parse(field, mode="eval")) if isinstance(node, ast.Name)]))
+
+def build_id_index(ids):
+	"""Returns a hash set of the given ids and their lengths, longest first,
+	for finding ids in query strings with substitute_ids."""
+	idset = set([id for id in ids if isinstance(id, basestring)])
+	return idset, sorted(set([len(id) for id in idset]))[::-1]
+
+def substitute_ids(query, id_index):
+	"""Replace every id in query that isn't quoted and is bounded by word
+	boundaries with the expression (id=='id'), so that ids can be used as
+	tags. This is a single pass over query, using the index from
+	build_id_index, rather than one regex per id."""
+	idset, lens = id_index
+	def isword(c): return c.isalnum() or c == "_"
+	def boundary(i): return (i > 0 and isword(query[i-1])) != (i < len(query) and isword(query[i]))
+	res, last, i = [], 0, 0
+	while i < len(query):
+		end = None
+		if boundary(i) and (i == 0 or query[i-1] not in "'\""):
+			for n in lens:
+				if query[i:i+n] in idset and i+n <= len(query) and boundary(i+n):
+					end = i+n
+					break
+		if end is None:
+			i += 1
+			continue
+		res += [query[last:i], "(id=='%s')" % query[i:end]]
+		i = last = end
+	res.append(query[last:])
+	return "".join(res)
+
 # We want a way to build a dtype from file. Two main ways will be handy:
 # 1: The tag fileset.
 #    Consists of a main file with lines like
@@ -208,8 +314,8 @@ def dslice(data, inds):
 #    (though in practice there may be other stuff on the lines that needs cleaning...)
 # 2: An hdf file
 
-def read(fname, type=None, vars={}): return Tagdb.read(fname, type=type, vars=vars)
-def read_txt(fname, vars={}): return Tagdb.read_txt(fname, vars=vars)
+def read(fname, type=None, vars={}, comm=None): return Tagdb.read(fname, type=type, vars=vars, comm=comm)
+def read_txt(fname, vars={}, cache=True, comm=None): return Tagdb.read_txt(fname, vars=vars, cache=cache, comm=comm)
 def read_hdf(fname): return Tagdb.read_hdf(fname)
 
 def write(fname, tagdb, type=None): return tagdb.write(fname, type=type)
@@ -279,9 +385,196 @@ def parse_tagfile_idlist(fname):
 			res.append(line.split()[0])
 	return res
 
+# The binary cache for text tag databases. It consists of a magic line, a line
+# with a json header, and then the raw id array followed by the tag matrix with
+# one bit per id, at the offsets given in the header. Both can be memory mapped.
+tag_cache_magic = b"#tagdb-cache 1\n"
+
+def tag_cache_name(fname, dir=None):
+	"""Returns the name of the binary cache file for the tag file fname. This
+	is a hidden file next to fname, unless a cache directory is given by dir
+	or the tagdb_cache_dir setting. There the name includes a hash of the full
+	path of fname, so that tag files with the same name don't collide."""
+	dir = config.get("tagdb_cache_dir", dir)
+	dirname, basename = os.path.split(fname)
+	if not dir: return os.path.join(dirname, "." + basename + ".tagcache")
+	key = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()[:16]
+	return os.path.join(dir, "%s.%s.tagcache" % (basename, key))
+
+def tag_cache_stamp(entries):
+	"""Returns a hash identifying the contents of the tag database given by the
+	[(fname, tags),...] entries of its top-level file, and the size and
+	modification time of each of the id files it refers to."""
+	h = hashlib.sha1()
+	for subfile, tags in entries:
+		stat = os.stat(subfile)
+		h.update(repr((subfile, sorted(tags), stat.st_size, stat.st_mtime)).encode())
+	return h.hexdigest()
+
+def tag_cache_offsets(hlen, idbytes, align=64):
+	"""Returns the offsets of the ids and tag bits in a cache file with the given
+	header and id array lengths in bytes."""
+	id_off  = (hlen+align-1)//align*align
+	bit_off = (id_off+idbytes+align-1)//align*align
+	return id_off, bit_off
+
+def write_tag_cache(cname, data, stamp):
+	"""Write the tag data to the cache file cname. Only boolean tags are
+	supported. Failure to write the cache is not an error."""
+	ids  = np.ascontiguousarray(data["id"])
+	tags = sorted([key for key in data if key != "id"])
+	if any([data[tag].dtype != bool or data[tag].shape != ids.shape for tag in tags]): return
+	bits = np.packbits(np.array([data[tag] for tag in tags], bool).reshape(len(tags),len(ids)), axis=-1)
+	header = {"stamp": stamp, "nid": len(ids), "dtype": ids.dtype.str, "tags": tags}
+	hbytes = tag_cache_magic + json.dumps(header).encode() + b"\n"
+	id_off, bit_off = tag_cache_offsets(len(hbytes), ids.nbytes)
+	# Write atomically, since other tasks or programs may be reading it
+	tmpname = "%s.tmp%d" % (cname, os.getpid())
+	try:
+		utils.mkdir(os.path.dirname(cname))
+		with open(tmpname, "wb") as f:
+			f.write(hbytes)
+			f.write(b"\0"*(id_off-len(hbytes)))
+			f.write(ids.tobytes())
+			f.write(b"\0"*(bit_off-id_off-ids.nbytes))
+			f.write(bits.tobytes())
+		os.rename(tmpname, cname)
+	except (IOError, OSError):
+		try: os.remove(tmpname)
+		except OSError: pass
+
+def read_tag_cache(cname, stamp=None):
+	"""Read tag data from the cache file cname. Returns None if it does not
+	exist, or if stamp is specified and does not match the one it was written with."""
+	try:
+		with open(cname, "rb") as f:
+			if f.readline() != tag_cache_magic: return None
+			header = json.loads(f.readline().decode())
+			hlen   = f.tell()
+	except (IOError, OSError, ValueError): return None
+	if stamp is not None and header["stamp"] != stamp: return None
+	nid, tags = header["nid"], header["tags"]
+	dtype  = np.dtype(str(header["dtype"]))
+	id_off, bit_off = tag_cache_offsets(hlen, nid*dtype.itemsize)
+	nbyte  = (nid+7)//8
+	data   = {"id": np.zeros(0, dtype)}
+	if nid > 0:
+		data["id"] = np.array(np.memmap(cname, dtype=dtype, mode="r", offset=id_off, shape=(nid,)))
+	if nid > 0 and len(tags) > 0:
+		bits = np.memmap(cname, dtype=np.uint8, mode="r", offset=bit_off, shape=(len(tags),nbyte))
+		flags= np.unpackbits(bits, axis=-1)[:,:nid].view(bool)
+	else: flags = np.zeros((len(tags),nid),bool)
+	for i, tag in enumerate(tags):
+		data[tag] = flags[i]
+	return data
+
+def read_txt_bench(dirname, nid=1000000, nfile=20, ntag=5, seed=0):
+	"""Compare the time to read a synthetic text tag database with nid ids
+	spread over nfile id files with up to ntag tags each, with and without
+	the binary cache. The files are written to dirname. Returns
+	{"nocache": t, "cold": t, "warm": t}, where cold includes writing the cache."""
+	rng = np.random.RandomState(seed)
+	ids = np.char.add(np.char.add("%d." % 1500000000, np.arange(nid).astype(str)), ".ar1")
+	utils.mkdir(dirname)
+	with open(os.path.join(dirname, "top.txt"), "w") as top:
+		for fi in range(nfile):
+			sub  = os.path.join(dirname, "ids%03d.txt" % fi)
+			mask = rng.uniform(size=nid) < 2.0/nfile
+			with open(sub, "w") as f:
+				f.write("\n".join(ids[mask]) + "\n")
+			tags = ["tag%d" % ti for ti in range(ntag) if rng.uniform() < 0.5] or ["tag0"]
+			top.write("%s %s\n" % (sub, " ".join(tags)))
+	fname = os.path.join(dirname, "top.txt")
+	try: os.remove(tag_cache_name(fname))
+	except OSError: pass
+	res, dbs = {}, {}
+	for name, cache in [("nocache",False),("cold",True),("warm",True)]:
+		t1 = time.time()
+		dbs[name] = Tagdb.read_txt(fname, cache=cache)
+		res[name] = time.time()-t1
+	# Make sure the cache gives the same result
+	for name in ["cold","warm"]:
+		assert sorted(dbs[name].data) == sorted(dbs["nocache"].data)
+		for key in dbs[name].data:
+			assert np.all(dbs[name].data[key] == dbs["nocache"].data[key])
+	return res
+
+def query_test(n=2000, seed=0):
+	"""Check that queries select the same ids as the equivalent numpy
+	expressions, and that compiled queries are reused until the ids change."""
+	import tempfile
+	rng  = np.random.RandomState(seed)
+	ids  = np.array(["%010d.%010d.ar%d" % (1500000000+i, 1500000000+i*7, i%3+1) for i in range(n)])
+	night, ar2 = rng.uniform(size=n) > 0.5, np.char.endswith(ids, "ar2")
+	pwv, el, bounds = rng.uniform(0,3,n), rng.uniform(30,60,n), rng.uniform(size=(2,n))
+	db   = Tagdb({"id":ids, "night":night, "ar2":ar2, "pwv":pwv, "el":el, "bounds":bounds}, default_query="pwv<2.5")
+	sel  = pwv < 2.5
+	def check(query, mask, order=None):
+		exp = ids[mask] if order is None else ids[mask][np.argsort(order[mask])]
+		assert np.array_equal(db.query(query), exp), query
+	check("night,ar2", night&ar2&sel)
+	check("night,ar2:pwv", night&ar2&sel, pwv)
+	check("(pwv>1)|night,el>40", ((pwv>1)|night)&(el>40)&sel)
+	check("night,/all", night)
+	check("bounds[0]>0.5,sum(bounds,0)<1", (bounds[0]>0.5)&(np.sum(bounds,0)<1)&sel)
+	inds = np.arange(n)
+	check(ids[5]+"|"+ids[8], ((inds==5)|(inds==8))&sel)
+	assert np.array_equal(db.query("night:pwv[5:10]"), ids[night&sel][np.argsort(pwv[night&sel])][5:10])
+	with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+		f.write("\n".join(ids[::7])+"\n"); f.flush()
+		infile = inds%7 == 0
+		check("@%s,night" % f.name, infile&night&sel)
+		check("~@%s,ar2,/all" % f.name, ~infile&ar2)
+	# Compiled queries are cached until the ids change
+	plan = db.compile_query("night,ar2")
+	assert db.compile_query("night,ar2") is plan
+	sub  = db.select("night")
+	assert np.array_equal(sub.query("el>50"), ids[night&(el>50)&sel])
+	assert sub.compile_query("night,ar2") is not plan
+
+def tag_cache_test():
+	"""Check where read_txt puts its cache, that it is used, and that failing
+	to write it leaves no temporary files behind."""
+	import tempfile, shutil
+	from . import mpi
+	dirname = tempfile.mkdtemp()
+	try:
+		fname = os.path.join(dirname, "top.txt")
+		with open(os.path.join(dirname, "ids.txt"), "w") as f: f.write("a\nb\nc\n")
+		with open(fname, "w") as f: f.write("%s foo bar\n" % os.path.join(dirname, "ids.txt"))
+		ref   = Tagdb.read_txt(fname, cache=False)
+		# In a separate cache directory
+		cdir  = os.path.join(dirname, "cache")
+		cname = tag_cache_name(fname, dir=cdir)
+		assert os.path.dirname(cname) == cdir
+		with config.override("tagdb_cache_dir", cdir):
+			db = Tagdb.read_txt(fname, comm=mpi.COMM_WORLD)
+			assert os.path.isfile(cname)
+			assert sorted(db.query("foo")) == sorted(ref.query("foo"))
+			# The cache is what's read the next time
+			assert read_tag_cache(cname) is not None
+			assert sorted(Tagdb.read_txt(fname).query("bar")) == sorted(ref.query("bar"))
+		# Failing to write the cache is not an error, and cleans up
+		cname = tag_cache_name(fname)
+		os.mkdir(cname)
+		with open(os.path.join(cname, "junk"), "w") as f: pass
+		db = Tagdb.read_txt(fname)
+		assert sorted(db.query("foo")) == sorted(ref.query("foo"))
+		assert not any([".tmp" in name for name in os.listdir(dirname)])
+	finally: shutil.rmtree(dirname)
+
 def file_contains(fname, ids):
-	lines = [line.split()[0] for line in open(fname,"r") if not line.startswith("#")]
-	return utils.contains(ids, lines)
+	return utils.contains(ids, read_id_file(fname))
+
+# Contents of the id files used in queries, by file name and modification time
+id_files = {}
+def read_id_file(fname):
+	"""Returns the ids listed in fname. These are cached until the file changes."""
+	stat = os.stat(fname)
+	key  = (fname, stat.st_mtime, stat.st_size)
+	if key not in id_files:
+		id_files[key] = [line.split()[0] for line in open(fname,"r") if not line.startswith("#")]
+	return id_files[key]
 
 def load_ids(fname):
 	lines = [line.split()[0] for line in open(fname,"r") if not line.startswith("#")]
@@ -1,7 +1,7 @@
 from __future__ import division, print_function
 import numpy as np, time, h5py
 from scipy import signal
-from . import config, fft, utils, gapfill, todops, pmat
+from . import config, fft, utils, gapfill, todops, pmat, sampcut
 
 config.default("gfilter_jon_naz", 16, "The number of azimuth modes to fit/subtract in Jon's polynomial ground filter.")
 config.default("gfilter_jon_nt",  10, "The number of time modes to fit/subtract in Jon's polynomial ground filter.")
@@ -118,36 +118,77 @@ def deproject_vecs_smooth(tods, dark, nmode=50, cuts=None, deslope=True, inplace
 
 def filter_common_blockwise(tods, blocks, cuts=None, niter=None,
 		deslope=True, inplace=True, weight="auto", nmin=5):
-	# Loop over and filter each block
-	#np.savetxt("comtod0.txt", tods[0])
+	"""Given a tod[ndet,nsamp], fit for a common mode per block in blocks[nblock][dets]
+	with at least nmin detectors, and subtract it, like todops.fit_common. The
+	blocks are filtered in parallel, in place, so they must not overlap."""
 	if not inplace: tods = tods.copy()
-	for bi, block in enumerate(blocks):
-		if len(block) < nmin: continue
-		btod = np.ascontiguousarray(tods[block])
-		bcut = None if cuts is None else cuts[block]
-		common = todops.fit_common(btod, cuts=bcut, niter=niter, clean_tod=True, weight=weight)
-		tods[block] = btod
-		#if 0 in block: np.savetxt("comcom.txt", common)
+	blocks = [block for block in blocks if len(block) >= nmin]
+	work   = get_block_work(tods)
+	sampcut.fit_common_blocks(get_block_cuts(cuts, work), work, blocks, get_block_weight(work, weight),
+			niter=todops.default_niter if niter is None else niter, context=config.get("gapfill_context"))
+	if work is not tods: tods[:] = work
 	if deslope: utils.deslope(tods, w=8, inplace=True)
-	#np.savetxt("comtod1.txt", tods[0])
-	#1/0
 	return tods
 
 def filter_phase_blockwise(tods, blocks, az, daz=None, cuts=None, niter=None,
 		deslope=True, inplace=True, weight="auto"):
 	"""Given a tod[ndet,nsamp], fit for a common azimuth phase signal
-	per block in blocks[nblock][dets], and subtract it. The binning size
-	is given in arc minutes."""
-	# Loop over and filter each block
-	#np.savetxt("moo0.txt", tods[0])
+	per block in blocks[nblock][dets], and subtract it, like todops.fit_phase_flat.
+	The binning size is given in radians. The blocks are filtered in parallel,
+	in place, so they must not overlap."""
 	if not inplace: tods = tods.copy()
-	for bi, block in enumerate(blocks):
-		btod = np.ascontiguousarray(tods[block])
-		bcut = None if cuts is None else cuts[block]
-		phase = todops.fit_phase_flat(btod, az, daz=daz, cuts=bcut, niter=niter,
-				clean_tod=True, weight=weight)
-		tods[block] = btod
+	if daz is None: daz = 1*utils.arcmin
+	amin, amax = np.min(az), np.max(az)
+	naz    = int((amax-amin)/daz)+1
+	work   = get_block_work(tods)
+	sampcut.fit_phase_blocks(get_block_cuts(cuts, work), work, blocks, get_block_weight(work, weight),
+			az, amin, daz, naz, niter=todops.default_niter if niter is None else niter, context=config.get("gapfill_context"))
+	if work is not tods: tods[:] = work
 	if deslope: utils.deslope(tods, w=8, inplace=True)
-	#np.savetxt("moo.txt", tods[0])
-	#1/0
 	return tods
+
+def get_block_work(tods):
+	"""The blockwise filters work in place on contiguous tods. Returns tods
+	itself if it is contiguous, and otherwise a contiguous copy."""
+	return tods if tods.flags["C_CONTIGUOUS"] else np.ascontiguousarray(tods)
+
+def get_block_cuts(cuts, tods):
+	return sampcut.empty(*tods.shape) if cuts is None else cuts
+
+def get_block_weight(tods, weight):
+	"""Per-detector weights for the blockwise filters. weight can be None for
+	uniform weights, "auto" to weight by the white noise level, or an array."""
+	if weight is None: return np.full(len(tods), 1.0, tods.dtype)
+	elif isinstance(weight, str) and weight == "auto":
+		weight = 1/todops.estimate_white_noise(tods)
+		return weight/np.mean(weight)
+	else: return np.asarray(weight)
+
+def blockwise_test(ndet=60, nsamp=20000, nblock=5, seed=1):
+	"""Check that filter_common_blockwise and filter_phase_blockwise give the
+	same result as todops.fit_common and todops.fit_phase_flat on each block."""
+	rng   = np.random.RandomState(seed)
+	az    = 0.5*np.arcsin(np.sin(np.arange(nsamp)*1e-3))
+	perm  = rng.permutation(ndet)
+	blocks= [perm[i::nblock] for i in range(nblock)]
+	for dtype, tol in [(np.float64, 1e-12), (np.float32, 1e-5)]:
+		tod   = (rng.standard_normal((ndet,nsamp)).cumsum(1)*0.01 + rng.standard_normal((ndet,nsamp))*rng.uniform(0.5,2,ndet)[:,None]).astype(dtype)
+		mask  = np.zeros((ndet,nsamp),bool)
+		for di in range(0,ndet,2): mask[di,rng.randint(0,nsamp-500):][:300] = True
+		cuts  = sampcut.from_mask(mask)
+		for name in ["common", "phase"]:
+			ref = tod.copy()
+			for block in blocks:
+				btod = np.ascontiguousarray(ref[block])
+				if name == "common": todops.fit_common(btod, cuts=cuts[block], clean_tod=True, weight="auto")
+				else: todops.fit_phase_flat(btod, az, cuts=cuts[block], clean_tod=True, weight="auto")
+				ref[block] = btod
+			res = tod.copy()
+			if name == "common": filter_common_blockwise(res, blocks, cuts=cuts, deslope=False)
+			else: filter_phase_blockwise(res, blocks, az, cuts=cuts, deslope=False)
+			err = np.max(np.abs(res-ref))/np.std(ref)
+			assert err < tol, "%s %s err %g" % (dtype.__name__, name, err)
+	# Overlapping blocks would make the threads race
+	try: filter_common_blockwise(tod, [blocks[0], blocks[0][:1]], nmin=1)
+	except ValueError: pass
+	else: raise AssertionError("overlapping blocks were accepted")
@@ -4,6 +4,10 @@ arrays. This is useful for cleaning TODs of unwanted signals, for example."""
 import numpy as np, scipy.signal
 from . import utils, pmat, sampcut, gapfill, fft
 
+# Number of gapfill-fit-subtract iterations used by the common mode and
+# phase fits when niter is not specified
+default_niter = 3
+
 def estimate_white_noise(tod, nchunk=10, chunk_size=1000):
 	"""Robust time-domain estimation of white noise level."""
 	vs = []
@@ -41,7 +45,7 @@ def project(tod, basis, weight=1):
 def fit_common(tods, cuts=None, niter=None, overlap=None, clean_tod=False, weight=None):
 	# for the given tods[ndet,nsamp], cuts (multirange[ndet,nsamp]) and az[nsamp],
 	if not clean_tod: tods = tods.copy()
-	if niter is None: niter = 3
+	if niter is None: niter = default_niter
 	if weight is None:
 		weight = np.full(len(tods), 1.0, dtype=tods.dtype)
 	elif weight is "auto":
@@ -65,7 +69,7 @@ def fit_phase_flat(tods, az, daz=1*utils.arcmin, cuts=None, niter=None,
 	# for the given tods[ndet,nsamp], cuts (multirange[ndet,nsamp]) and az[nsamp],
 	if not clean_tod: tods = tods.copy()
 	if daz is None: daz = 1*utils.arcmin
-	if niter is None: niter = 3
+	if niter is None: niter = default_niter
 	if weight is None:
 		weight = np.full(len(tods), 1.0, dtype=tods.dtype)
 	elif weight is "auto":
@@ -112,23 +116,62 @@ def fit_phase_flat(tods, az, daz=1*utils.arcmin, cuts=None, niter=None,
 # the part with good correlation?
 
 def fit_basis(tods, basis, highpass=50, cuts=None, clean_tod=True):
+	"""Fit each of tods[ndet,nsamp] with the basis vectors basis[nbasis,nsamp]
+	after highpassing both, ignoring the lowest highpass fourier modes, and
+	subtract the fit. For each detector the basis is gapfilled using its cuts.
+	Gapfilling only changes the basis in the cut samples, so this is done by
+	correcting the normal equations and fit for the uncut basis in those
+	samples, once per distinct cut pattern."""
 	if not clean_tod: tods = tods.copy()
 	def hpass(a, n):
 		f = fft.rfft(a)
 		f[...,:n] = 0
 		return fft.ifft(f,a.copy(),normalize=True)
 	hdark = hpass(basis, highpass)
-	for di in range(len(tods)):
-		htod = hpass(tods[di], highpass)
-		dark_tmp = hdark.copy()
-		if cuts is not None:
-			for ddi in range(len(hdark)):
-				gapfill.gapfill(dark_tmp[ddi], cuts[di], inplace=True)
-		fit = project(htod[None], dark_tmp)[0]
-		# Subtract from original tod
-		tods[di] -= fit
+	htods = hpass(tods, highpass)
+	nbasis= len(hdark)
+	# Normal equations for the uncut basis, for all detectors at once
+	divs  = np.repeat(hdark.dot(hdark.T)[None], len(tods), 0)
+	rhss  = htods.dot(hdark.T)
+	fills = []
+	if cuts is not None:
+		work = hdark.copy()
+		for dets, cut in group_cuts(cuts):
+			# Find the change gapfilling makes to the basis in the cut samples
+			for bi in range(nbasis):
+				gapfill.gapfill(work[bi], cut, inplace=True)
+			bcut  = cut.repeat(nbasis)
+			hcut  = bcut.extract_samples(hdark).reshape(nbasis,-1)
+			dfill = bcut.extract_samples(work).reshape(nbasis,-1) - hcut
+			work[:] = hdark
+			# And update the normal equations accordingly
+			dcut  = cut.repeat(len(dets))
+			tcut  = dcut.extract_samples(htods[dets]).reshape(len(dets),-1)
+			divs[dets] += (hcut+dfill).dot((hcut+dfill).T) - hcut.dot(hcut.T)
+			rhss[dets] += tcut.dot(dfill.T)
+			fills.append((dets, dcut, dfill))
+	del htods
+	amps = np.linalg.solve(divs, rhss[:,:,None])[:,:,0]
+	# Subtract from original tod
+	tods -= amps.dot(hdark).astype(tods.dtype)
+	for dets, dcut, dfill in fills:
+		sub = tods[dets]
+		dcut.insert_samples(sub, dcut.extract_samples(sub) - amps[dets].dot(dfill).reshape(-1).astype(tods.dtype))
+		tods[dets] = sub
 	return tods
 
+def group_cuts(cuts):
+	"""Group the detectors in the Sampcut cuts by their cut pattern. Returns
+	[(dets,cut),...] where cut is the single-detector Sampcut shared by the
+	detectors dets. Detectors without cuts are left out."""
+	groups = {}
+	for di, ranges in enumerate(cuts.to_list()):
+		if len(ranges) == 0: continue
+		key = ranges.tobytes()
+		if key not in groups: groups[key] = []
+		groups[key].append(di)
+	return [(np.array(dets), cuts[dets[0]:dets[0]+1]) for dets in sorted(groups.values())]
+
 def smooth_basis_fourier(ftod, fbasis, bsize=100, mincorr=0.1,
 		nsigma=5, highpass=10, nmin=1):
 	"""This function attemps to smooth out irrelevant fourier modes
@@ -162,3 +205,39 @@ def smooth_basis_fourier(ftod, fbasis, bsize=100, mincorr=0.1,
 	fbasis[:,:highpass] = 0
 	fbasis = fbasis[ngood>=nmin]
 	return fbasis
+
+def fit_basis_test(ndet=30, nsamp=8000, nbasis=4, seed=0):
+	"""Check that fit_basis matches fitting each detector separately with its
+	own gapfilled basis, with and without cuts, in single and double precision."""
+	def hpass(a, n):
+		f = fft.rfft(a)
+		f[...,:n] = 0
+		return fft.ifft(f,a.copy(),normalize=True)
+	def fit_basis_ref(tods, basis, cuts=None, highpass=50):
+		hdark = hpass(basis, highpass)
+		for di in range(len(tods)):
+			dark = hdark.copy()
+			if cuts is not None:
+				for bi in range(nbasis):
+					gapfill.gapfill(dark[bi], cuts[di:di+1], inplace=True)
+			tods[di] -= project(hpass(tods[di], highpass)[None], dark)[0]
+		return tods
+	rng = np.random.RandomState(seed)
+	for dtype, tol in [(np.float64, 1e-10), (np.float32, 1e-5)]:
+		basis = rng.standard_normal((nbasis,nsamp)).cumsum(1).astype(dtype)
+		tods  = (rng.standard_normal((ndet,nbasis)).dot(basis) + rng.standard_normal((ndet,nsamp))).astype(dtype)
+		# Uncut detectors, a shared cut pattern and individual cuts
+		mask  = np.zeros((ndet,nsamp),bool)
+		mask[1::3,1000:1500] = True; mask[1::3,5000:5100] = True
+		for di in range(2, ndet, 3):
+			for i in range(3):
+				i1 = rng.randint(nsamp-200); mask[di,i1:i1+rng.randint(1,200)] = True
+		cuts = sampcut.from_mask(mask)
+		assert len(group_cuts(cuts)) == len(range(2,ndet,3)) + 1
+		for c in [None, cuts]:
+			ref = fit_basis_ref(tods.copy(), basis, cuts=c)
+			res = fit_basis(tods, basis, cuts=c, clean_tod=False)
+			assert res.dtype == dtype
+			assert np.max(np.abs(res-ref)) <= tol*np.max(np.abs(tods-ref)), "%s cuts %s" % (dtype.__name__, c is not None)
+			tmp = tods.copy()
+			assert fit_basis(tmp, basis, cuts=c) is tmp and np.array_equal(tmp, res)
@@ -25,6 +25,12 @@ class SingleZipper:
 		if not self.shared: res = self.comm.allreduce(res)
 		return res
 	def dot(self, x, y): return self.sum(x*y)
+	def dot_many(self, pairs):
+		"""Computes the dot product of each (x,y) pair in pairs, using
+		a single reduction for all of them."""
+		res = np.array([np.sum(x*y) for x,y in pairs])
+		if not self.shared: res = self.comm.allreduce(res)
+		return res
 	n = 0
 	shared = True
 
@@ -69,3 +75,29 @@ class MultiZipper:
 			s[z.shared] += np.sum(x[b[0]:b[1]])
 		return self.comm.allreduce(s[0]) + s[1]
 	def dot(self, x, y): return self.sum(x*y)
+	def dot_many(self, pairs):
+		"""Computes the dot product of each (x,y) pair in pairs. The
+		distributed parts of all of them are reduced together."""
+		s = np.zeros([2,len(pairs)], np.result_type(*[x.dtype for pair in pairs for x in pair]))
+		for i, (x,y) in enumerate(pairs):
+			for z,b in zip(self.zippers, self.bins):
+				s[int(z.shared),i] += np.sum(x[b[0]:b[1]]*y[b[0]:b[1]])
+		if not self.allshared: s[0] = self.comm.allreduce(s[0])
+		return s[0]+s[1]
+
+def dot_many_test():
+	"""Check that MultiZipper.dot_many gives the same result as separate dot calls,
+	for a mix of shared and distributed zippers."""
+	from . import mpi
+	rng = np.random.RandomState(1)
+	zippers = [ArrayZipper(np.zeros((3,4))), ArrayZipper(np.zeros(5), shared=False),
+		ArrayZipper(np.zeros(7), mask=np.arange(7)%2==0, shared=False)]
+	zipper  = MultiZipper(zippers, comm=mpi.COMM_WORLD)
+	vecs    = [rng.standard_normal(zipper.n) for i in range(3)]
+	pairs   = [(vecs[0],vecs[1]), (vecs[1],vecs[2]), (vecs[2],vecs[2])]
+	res     = zipper.dot_many(pairs)
+	ref     = np.array([zipper.dot(x,y) for x,y in pairs])
+	assert np.allclose(res, ref, rtol=1e-14, atol=0)
+	for z in zippers:
+		x, y = rng.standard_normal(z.n), rng.standard_normal(z.n)
+		assert np.allclose(z.dot_many([(x,y),(y,y)]), [z.dot(x,y), z.dot(y,y)], rtol=1e-14, atol=0)